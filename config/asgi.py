@@ -13,4 +13,9 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# 静的ファイルは Django のミドルウェアの前で返す（同期専用の WhiteNoiseMiddleware をチェーンに入れないため）
+from products.middleware import StaticFilesApplication  # noqa: E402  アプリの読み込み後に import する
+
+application = StaticFilesApplication(django_application)
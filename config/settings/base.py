@@ -37,8 +37,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # 計測対象にすべてのミドルウェアを含めるため先頭に置く（REQUEST_TIMING_SAMPLE_RATE が 0 なら読み込まれない）
+    'products.middleware.RequestTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    # 静的ファイル（WhiteNoise）。ASGI では config/asgi.py の StaticFilesApplication が返すので読み込まれない
+    'products.middleware.StaticFilesMiddleware',
+    # レプリカを設定している場合、書き込みをしたブラウザの読み取りをしばらくプライマリに固定する
+    'products.middleware.ReplicaStickinessMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -60,6 +65,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'products.context_processors.cart_count',
+                'products.context_processors.catalog_cache',
             ],
         },
     },
@@ -68,6 +75,55 @@ TEMPLATES = [
 WSGI_APPLICATION = 'config.wsgi.application'
 
 
+# Database
+# https://docs.djangoproject.com/en/4.2/ref/settings/#databases
+# 接続先（DATABASES）は local.py / production.py で DATABASE_URL から設定する
+
+
+def replica_databases():
+    """
+    DATABASE_REPLICA_URLS（カンマ区切りのURL）から、読み取り用レプリカの DATABASES の設定を作る。
+    テスト時はレプリカ用のDBを作らず、default をそのまま使う（MIRROR）。
+    """
+    return {
+        f'replica{number}': {**env.db_url_config(url), 'TEST': {'MIRROR': 'default'}}
+        for number, url in enumerate(env.list('DATABASE_REPLICA_URLS', default=[]), start=1)
+    }
+
+
+# 商品・注文の読み取りをレプリカに振り分ける（レプリカが無い場合はすべて default）
+DATABASE_ROUTERS = ['products.routers.ReplicaRouter']
+
+# 書き込みをしたブラウザの読み取りをプライマリに固定しておく時間（秒）。レプリカの反映遅れより長くする
+REPLICA_STICKY_SECONDS = 10
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# デフォルトはプロセス内メモリ。CACHE_URL で Redis 等に切り替えられる
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+
+# 商品カード・商品詳細のフラグメントキャッシュの有効期限（秒）
+CATALOG_CACHE_TIMEOUT = 60 * 60
+
+# カートに入れた商品の在庫を確保しておく時間（秒）
+CART_RESERVATION_SECONDS = 15 * 60
+
+# 購入手続きが処理中のまま、この時間（秒）を過ぎた冪等キーは、処理が中断したとみなして同じキーでの再送を受け付ける
+CHECKOUT_KEY_TIMEOUT_SECONDS = 60
+
+# 商品一覧・商品詳細・カートに非同期版のビュー（products/async_views.py）を使うかどうか
+# ASGI サーバー（uvicorn）で動かす場合に True にする
+ASYNC_VIEWS = env.bool('ASYNC_VIEWS', default=False)
+
+# リクエストごとのSQL・処理時間を計測する割合（0〜1）
+# 計測したリクエストには Server-Timing ヘッダーを付け、products.timing ロガーに出力する。0 で無効
+REQUEST_TIMING_SAMPLE_RATE = env.float('REQUEST_TIMING_SAMPLE_RATE', default=0)
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -133,3 +189,33 @@ MESSAGE_TAGS = {
 }
 
 DEFAULT_FROM_EMAIL = 'onboarding@resend.dev'
+
+# メールのアウトボックス（send_outbox_emails コマンド）
+# 送信に失敗した場合の再送間隔（秒）。失敗するたびに倍になる
+OUTBOX_RETRY_BASE_SECONDS = 60
+# この回数失敗したら送信失敗として諦める
+OUTBOX_MAX_ATTEMPTS = 5
+# ワーカーが取り出したメールを他のワーカーが拾わないようにしておく時間（秒）
+OUTBOX_LEASE_SECONDS = 5 * 60
+
+
+# Logging
+# https://docs.djangoproject.com/en/4.2/topics/logging/
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        # リクエストの計測結果（1リクエスト1行のJSON）
+        'products.timing': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
@@ -15,6 +15,8 @@ ALLOWED_HOSTS = ['*']
 
 DATABASES = {
     'default': env.db(),
+    # 読み取り用レプリカ（DATABASE_REPLICA_URLS）
+    **replica_databases(),
 }
 
 MEDIA_URL = '/media/'
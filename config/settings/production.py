@@ -15,6 +15,8 @@ ALLOWED_HOSTS = ['.herokuapp.com']
 
 DATABASES = {
     'default': env.db(),
+    # 読み取り用レプリカ（DATABASE_REPLICA_URLS）
+    **replica_databases(),
 }
 
 STORAGES['default'] = {
@@ -35,3 +37,15 @@ EMAIL_USE_SSL = True
 EMAIL_HOST_USER = 'resend'
 # HerokuのConfig Varsから読み込み
 EMAIL_HOST_PASSWORD = os.environ.get('RESEND_API_KEY')
+
+# 本番環境は ASGI（Procfile の uvicorn ワーカー）で動かすので非同期版のビューを使う
+ASYNC_VIEWS = env.bool('ASYNC_VIEWS', default=True)
+
+# セッションは共有キャッシュ（CACHE_URL で指定した Redis 等）から読み、DBには書き込み時のバックアップとしてのみ保存する
+# プロセス内メモリのキャッシュはワーカー間で共有されず古いセッションを読んでしまうため、CACHE_URL が無い場合はDBに保存する
+# DBを使わずキャッシュだけに保存する場合は SESSION_ENGINE=django.contrib.sessions.backends.cache を指定する
+SESSION_ENGINE = env(
+    'SESSION_ENGINE',
+    default='django.contrib.sessions.backends.cached_db' if 'CACHE_URL' in os.environ
+    else 'django.contrib.sessions.backends.db',
+)
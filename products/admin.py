@@ -1,7 +1,25 @@
 from django.contrib import admin
+from django.db import transaction
+from .forms import ProductForm
 from .models import Product, Category, Cart, CartItem, Order, OrderItem, PromoCode
+from .stock import record_adjustment
+
+
+@admin.register(Product)
+class ProductAdmin(admin.ModelAdmin):
+    # 管理画面（ManageProductCreate / ManageProductUpdate）と同じフォームで、画像の検証と縮小画像の作成を行う
+    form = ProductForm
+
+    def save_model(self, request, obj, form, change):
+        # 管理画面（ManageProductCreate / ManageProductUpdate）と同じく、在庫数の変更を増減の履歴に記録する
+        with transaction.atomic():
+            previous = 0
+            if change:
+                previous = Product.objects.select_for_update().values_list('stock', flat=True).get(pk=obj.pk)
+            super().save_model(request, obj, form, change)
+            record_adjustment(obj, obj.stock - previous)
+
 
-admin.site.register(Product)
 admin.site.register(Category)
 admin.site.register(Cart)
 admin.site.register(CartItem)
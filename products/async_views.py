@@ -0,0 +1,145 @@
+"""
+ASGI サーバー（uvicorn）で動かすための非同期版のビュー。
+ASYNC_VIEWS が True の場合に urls.py / cart_urls.py から使われる。
+
+読み取りだけのビューは非同期ORM（aget / aaggregate / async for）で実装している。
+カートを変更するビューと購入手続きは行ロックとトランザクション（transaction.atomic）を使うため、
+同期ビューをそのままスレッドで実行する。Django はリクエストごとに別のスレッドを使うので、
+遅いクライアントやDB待ちのリクエストがあっても、他のリクエストの処理は止まらない。
+"""
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.http import Http404
+from django.shortcuts import render
+from django.views import View
+from . import cart_views
+from .cart_session import aget_cart_count, get_applied_promo
+from .conditional import add_validators, aproduct_list_state, make_etag, not_modified, product_detail_state
+from .forms import OrderForm
+from .idempotency import new_checkout_key
+from .models import Category, CartItem, Product
+from .pagination import KeysetPaginationMixin, OffsetPaginationMixin
+from .related import get_related_products
+from .search import search_products
+from .views import PRODUCT_CARD_FIELDS
+
+
+class ProductList(KeysetPaginationMixin, View):
+    template_name = 'product_list.html'
+    paginate_by = 20
+
+    async def get(self, request):
+        queryset = Product.objects.only(*PRODUCT_CARD_FIELDS)
+        # ?category=<slug> でカテゴリーの絞り込み
+        slug = request.GET.get('category')
+        category = None
+        if slug:
+            category = await _aget_object_or_404(Category.objects.all(), slug=slug)
+            queryset = queryset.filter(category=category)
+
+        # 内容が変わっていなければ、一覧を取得せずに 304 を返す
+        # 表示するページと同じシーク・件数で、ページに並ぶ商品の ID と更新日時だけを読む
+        await aget_cart_count(request)
+        state = await aproduct_list_state(self._seek(queryset, self.paginate_by)[0])
+        etag = make_etag(request, (category.pk, category.name) if category else None, state)
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        paginator, page, products, is_paginated = await self.apaginate_queryset(queryset, self.paginate_by)
+        return add_validators(render(request, self.template_name, {
+            'products': products,
+            'page_obj': page,
+            'is_paginated': is_paginated,
+            'category': category,
+        }), etag)
+
+
+class ProductSearch(OffsetPaginationMixin, View):
+    template_name = 'product_list.html'
+    paginate_by = 20
+
+    async def get(self, request):
+        query = request.GET.get('q', '').strip()
+        queryset = await sync_to_async(search_products)(query, Product.objects.only(*PRODUCT_CARD_FIELDS))
+        paginator, page, products, is_paginated = await self.apaginate_queryset(queryset, self.paginate_by)
+        await aget_cart_count(request)
+        return render(request, self.template_name, {
+            'products': products,
+            'page_obj': page,
+            'is_paginated': is_paginated,
+            'query': query,
+        })
+
+
+class ProductDetail(View):
+    template_name = 'product_detail.html'
+
+    async def get(self, request, pk):
+        session_key = request.session.session_key
+        # 内容が変わっていなければ、商品や関連商品を取得せずに 304 を返す
+        await aget_cart_count(request)
+        state = await product_detail_state(pk, session_key).afirst()
+        etag = make_etag(request, *state) if state else None
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+
+        # 他のカートに確保されている分を除いた販売可能数を available_stock として表示する
+        product = await _aget_object_or_404(
+            Product.objects.with_available_stock(exclude_session_key=session_key), pk=pk
+        )
+        related_products = await sync_to_async(get_related_products)(product)
+        return add_validators(render(request, self.template_name, {
+            'product': product,
+            'related_products': related_products,
+        }), etag)
+
+
+class CartItemList(View):
+    template_name = 'cart.html'
+
+    async def get(self, request):
+        # セッション未作成のユーザーはカートも持っていないので、セッションを作らずに空のカートを表示する
+        session_key = request.session.session_key
+        if session_key:
+            cart_items = CartItem.objects.filter(cart__session_key=session_key).with_prices()
+        else:
+            cart_items = CartItem.objects.none()
+
+        # 適用中のプロモコードはセッションに保持した検証済みの内容を使う
+        await aget_cart_count(request)
+        applied_promo = await sync_to_async(get_applied_promo)(request)
+        discount = applied_promo['discount_amount'] if applied_promo else 0
+        totals = await cart_items.atotals(discount=discount)
+
+        return render(request, self.template_name, {
+            'cart_items': [item async for item in cart_items],
+            'form': OrderForm(),
+            'discount': discount,
+            'applied_promo': applied_promo,
+            'total_price': totals['discounted_total'],
+            'checkout_key': new_checkout_key(),
+        })
+
+
+def _in_thread(view):
+    # 同期ビューをリクエスト用のスレッドで実行する非同期ビューにする
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        return await sync_to_async(view)(request, *args, **kwargs)
+    return wrapper
+
+
+add_to_cart = _in_thread(cart_views.add_to_cart)
+update_cart = _in_thread(cart_views.update_cart)
+delete_cart_item = _in_thread(cart_views.delete_cart_item)
+apply_promo = _in_thread(cart_views.apply_promo)
+checkout = _in_thread(cart_views.checkout)
+
+
+async def _aget_object_or_404(queryset, **kwargs):
+    try:
+        return await queryset.aget(**kwargs)
+    except queryset.model.DoesNotExist:
+        raise Http404(f'{queryset.model._meta.object_name} が見つかりません')
@@ -0,0 +1,182 @@
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from .models import Category, Product, PromoCode
+
+# 購入手続きで送信するフォームの内容（ダミー）
+CHECKOUT_FORM = {
+    'last_name': '山田',
+    'first_name': '太郎',
+    'email': 'bench@example.com',
+    'tel': '09012345678',
+    'zip_code': '1000001',
+    'address': '東京都千代田区',
+    'cc_name': 'TARO YAMADA',
+    'cc_number': '4111111111111111',
+    'cc_expiration': '12/34',
+    'cc_cvv2': '123',
+}
+
+
+class Catalog:
+    """
+    seed_catalog で作成したベンチマーク用データのIDをまとめたもの。
+    """
+    def __init__(self, product_ids, promo_codes):
+        self.product_ids = product_ids
+        self.promo_codes = promo_codes
+
+    def random_product_id(self):
+        return random.choice(self.product_ids)
+
+
+def seed_catalog(products=200, categories=5, promo_codes=500):
+    """
+    ベンチマーク用の商品・カテゴリー・プロモコードを作成する。
+    必ずテスト用のDBに対して実行すること。
+    """
+    category_list = Category.objects.bulk_create([
+        Category(name=f'ベンチマーク{i}', slug=f'bench-{i}') for i in range(categories)
+    ])
+    Product.objects.bulk_create([
+        Product(
+            name=f'ベンチマーク商品{i}',
+            category=category_list[i % categories],
+            price=random.randint(100, 9999),
+            sku=f'BENCH-{i}',
+            # 一部はセール中にして価格計算の分岐も通るようにする
+            sale=i % 4 == 0,
+            sale_price=random.randint(50, 99) if i % 4 == 0 else None,
+            stock=99,
+            description='ベンチマーク用の商品です',
+        )
+        for i in range(products)
+    ], batch_size=1000)
+    PromoCode.objects.bulk_create([
+        PromoCode(promo_code=f'B{i:06d}', discount_amount=100) for i in range(promo_codes)
+    ], batch_size=1000)
+    return Catalog(
+        list(Product.objects.values_list('pk', flat=True)),
+        list(PromoCode.objects.values_list('promo_code', flat=True)),
+    )
+
+
+# 各シナリオは、計測対象外の下準備をしたうえで、計測するリクエストの (メソッド, パス, 送信データ) を返す
+def _product_list(client, catalog):
+    return 'get', reverse('product_list'), None
+
+
+def _product_detail(client, catalog):
+    return 'get', reverse('product_detail', args=[catalog.random_product_id()]), None
+
+
+def _add_to_cart(client, catalog):
+    return 'post', reverse('add_to_cart', args=[catalog.random_product_id()]), {'quantity': 1}
+
+
+def _apply_promo(client, catalog):
+    # カートが空（セッションが無い）だとプロモコードは適用されないので、先に商品を入れておく
+    if settings.SESSION_COOKIE_NAME not in client.cookies:
+        client.post(reverse('add_to_cart', args=[catalog.random_product_id()]), {'quantity': 1})
+    return 'post', reverse('apply_promo'), {'promo_code': random.choice(catalog.promo_codes)}
+
+
+def _checkout(client, catalog):
+    client.post(reverse('add_to_cart', args=[catalog.random_product_id()]), {'quantity': 1})
+    return 'post', reverse('checkout'), CHECKOUT_FORM
+
+
+SCENARIOS = {
+    'product_list': _product_list,
+    'product_detail': _product_detail,
+    'add_to_cart': _add_to_cart,
+    'apply_promo': _apply_promo,
+    'checkout': _checkout,
+}
+
+
+def run_scenario(name, catalog, requests=200, concurrency=4):
+    """
+    シナリオ name を concurrency 個のスレッドから合計 requests 回実行し、集計結果を返す。
+    スレッドごとに1つのクライアント（＝1人の買い物客のセッション）を使う。
+    """
+    scenario = SCENARIOS[name]
+    latencies, query_counts = [], []
+    errors = 0
+    lock = threading.Lock()
+    counts = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+
+    def worker(count):
+        nonlocal errors
+        # 500 エラーも例外にせずレスポンスとして受け取り、エラーとして数える
+        client = Client(raise_request_exception=False)
+        try:
+            for _ in range(count):
+                try:
+                    method, path, data = scenario(client, catalog)
+                except Exception:
+                    # 下準備に失敗した場合は、計測せずにエラーとして数える
+                    with lock:
+                        errors += 1
+                    continue
+                # レプリカを設定している場合も含め、すべての接続のクエリを数える
+                with ExitStack() as stack:
+                    captured = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections]
+                    started = time.perf_counter()
+                    response = getattr(client, method)(path, data)
+                    elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+                    query_counts.append(sum(len(queries) for queries in captured))
+                    errors += response.status_code >= 400
+        finally:
+            # スレッドごとに開いたDB接続を閉じる
+            connections.close_all()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, [count for count in counts if count]))
+    wall_time = time.perf_counter() - started
+
+    return {
+        'endpoint': name,
+        'requests': requests,
+        'errors': errors,
+        'concurrency': concurrency,
+        'wall_time_s': round(wall_time, 3),
+        'throughput_rps': round(len(latencies) / wall_time, 1) if wall_time else None,
+        'latency_ms': _latency_summary(latencies),
+        'queries_per_request': {
+            'mean': round(statistics.fmean(query_counts), 1) if query_counts else None,
+            'max': max(query_counts, default=None),
+        },
+    }
+
+
+def _latency_summary(latencies):
+    if not latencies:
+        return {}
+    ms = sorted(latency * 1000 for latency in latencies)
+    return {
+        'mean': round(statistics.fmean(ms), 2),
+        'p50': round(_percentile(ms, 50), 2),
+        'p95': round(_percentile(ms, 95), 2),
+        'p99': round(_percentile(ms, 99), 2),
+        'max': round(ms[-1], 2),
+    }
+
+
+def _percentile(sorted_values, percent):
+    # 線形補間によるパーセンタイル（件数が少なくても計算できるようにしている）
+    position = (len(sorted_values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
@@ -0,0 +1,143 @@
+from django.db import transaction
+from django.utils import timezone
+from .models import Cart, CartItem, Product, StockReservation
+from .reservations import reservation_expires_at
+
+# 1回のリクエストで受け付ける操作の数の上限
+MAX_CART_OPERATIONS = 100
+MODE_ADD = 'add'
+MODE_SET = 'set'
+
+
+class CartOperationError(ValueError):
+    """
+    リクエストの形式が不正な場合（どの行も処理しない）に送出する例外。
+    """
+
+
+def parse_operations(raw_operations):
+    """
+    [{'product_id', 'quantity', 'mode'}, ...] の形式を検証し、(product_id, quantity, mode) のリストにする。
+    mode は add（今の数量に足す）または set（数量を置き換える。0 はカートから削除）で、省略時は set。
+    """
+    if not isinstance(raw_operations, list) or not raw_operations:
+        raise CartOperationError('operations に1件以上の操作を指定してください')
+    if len(raw_operations) > MAX_CART_OPERATIONS:
+        raise CartOperationError(f'一度に指定できる操作は{MAX_CART_OPERATIONS}件までです')
+
+    operations = []
+    for raw in raw_operations:
+        if not isinstance(raw, dict):
+            raise CartOperationError('操作は product_id と quantity を持つオブジェクトで指定してください')
+        mode = raw.get('mode') or MODE_SET
+        if mode not in (MODE_ADD, MODE_SET):
+            raise CartOperationError('mode には add または set を指定してください')
+        try:
+            product_id = int(raw['product_id'])
+            quantity = int(raw['quantity'])
+        except (KeyError, TypeError, ValueError):
+            raise CartOperationError('product_id と quantity は半角数字で指定してください')
+        operations.append((product_id, quantity, mode))
+    return operations
+
+
+def apply_cart_operations(session, operations):
+    """
+    カートに複数の商品の追加・数量変更・削除をまとめて反映し、(カート, 行ごとの結果のリスト) を返す。
+    結果は {'product_id', 'ok', 'quantity', 'error'} の辞書で、エラーになった行は反映しない（他の行は反映する）。
+    カートの行数に関係なく、発行するクエリ数が一定になるようにしている。
+      1. 商品の販売可能数の取得（行ロック）
+      2. カートと既存の明細の取得
+      3. 明細の一括作成・一括更新・一括削除
+      4. 在庫確保の一括作成・更新（INSERT ... ON CONFLICT）
+    セッションとカートは、カートに商品が入るときまで作らない。
+    """
+    session_key = session.session_key
+    product_ids = sorted({product_id for product_id, quantity, mode in operations})
+
+    with transaction.atomic():
+        # add_to_cart と同じく商品行をロックして、他のカートの確保を除いた販売可能数で確認する
+        # デッドロックを防ぐため、ロックは常に商品IDの昇順で取得する
+        products = {
+            product.pk: product
+            for product in Product.objects.select_for_update()
+            .with_available_stock(exclude_session_key=session_key)
+            .filter(pk__in=product_ids)
+            .order_by('pk')
+            .only('id', 'name', 'stock')
+        }
+        cart = Cart.objects.filter(session_key=session_key).first() if session_key else None
+        items = {
+            item.product_id: item
+            for item in (CartItem.objects.filter(cart=cart, product_id__in=product_ids) if cart else [])
+        }
+
+        # 同じ商品への操作が複数ある場合は、指定された順に適用する
+        quantities = {product_id: item.quantity for product_id, item in items.items()}
+        applied = set()
+        results = []
+        for product_id, quantity, mode in operations:
+            result = {'product_id': product_id, 'ok': False, 'quantity': quantities.get(product_id, 0), 'error': None}
+            results.append(result)
+            product = products.get(product_id)
+            if product is None:
+                result['error'] = '商品が見つかりません'
+                continue
+            if quantity < (1 if mode == MODE_ADD else 0):
+                result['error'] = '数量は1以上を指定してください' if mode == MODE_ADD else '数量は0以上を指定してください'
+                continue
+            target = quantities.get(product_id, 0) + quantity if mode == MODE_ADD else quantity
+            if target > product.available_stock:
+                result['error'] = f'{product.name} の在庫数（{max(product.available_stock, 0)}個）を超えています'
+                continue
+            quantities[product_id] = target
+            applied.add(product_id)
+            result.update(ok=True, quantity=target)
+
+        created, updated, deleted, reserved = [], [], [], []
+        now = timezone.now()
+        for product_id in sorted(applied):
+            quantity = quantities[product_id]
+            item = items.get(product_id)
+            if item is None:
+                if quantity > 0:
+                    created.append(CartItem(product_id=product_id, quantity=quantity))
+                    reserved.append(created[-1])
+            elif quantity == 0:
+                deleted.append(item.pk)
+            else:
+                if quantity != item.quantity:
+                    item.quantity = quantity
+                    item.updated_at = now
+                    updated.append(item)
+                reserved.append(item)
+
+        if created and cart is None:
+            if not session_key:
+                session.create()
+            cart, _ = Cart.objects.get_or_create(session_key=session.session_key)
+        for item in created:
+            item.cart = cart
+
+        CartItem.objects.bulk_create(created)
+        CartItem.objects.bulk_update(updated, ['quantity', 'updated_at'])
+        if deleted:
+            # 在庫確保は明細と一緒に削除される
+            CartItem.objects.filter(pk__in=deleted).delete()
+
+        # 操作した明細は、数量が変わらなくても add_to_cart と同じく確保の期限を延ばす
+        expires_at = reservation_expires_at()
+        StockReservation.objects.bulk_create(
+            [
+                StockReservation(
+                    cart_item=item, product_id=item.product_id, quantity=item.quantity,
+                    expires_at=expires_at, updated_at=now,
+                )
+                for item in reserved
+            ],
+            update_conflicts=True,
+            unique_fields=['cart_item'],
+            update_fields=['quantity', 'expires_at', 'updated_at'],
+        )
+
+    return cart, results
@@ -0,0 +1,78 @@
+from asgiref.sync import sync_to_async
+from .models import CartItem, PromoCode
+
+# ヘッダーのカートバッジに表示する商品数をセッションに保持するキー
+CART_COUNT_SESSION_KEY = 'cart_count'
+# 適用中のプロモコード（検証済みの内容）をセッションに保持するキー
+APPLIED_PROMO_SESSION_KEY = 'applied_promo'
+# 以前のバージョンでプロモコードのIDだけを保持していたキー
+LEGACY_PROMO_ID_SESSION_KEY = 'applied_promo_id'
+
+
+def get_cart_count(request):
+    """
+    カート内の商品数を返す。
+    セッションに保持している値を優先し、無い場合だけDBから数えてセッションに書き戻す。
+    """
+    session = request.session
+    # セッション未作成のユーザーはカートも持っていないので、DBもセッションも触らない
+    if not session.session_key:
+        return 0
+
+    count = session.get(CART_COUNT_SESSION_KEY)
+    if count is None:
+        count = CartItem.objects.filter(cart__session_key=session.session_key).count()
+        session[CART_COUNT_SESSION_KEY] = count
+    return count
+
+
+async def aget_cart_count(request):
+    """
+    非同期ビュー用の get_cart_count。
+    セッションの読み込み（とDBからの数え直し）をここで済ませておくので、
+    このあとテンプレート等から同期的にセッションを参照してもDBアクセスは起きない。
+    """
+    return await sync_to_async(get_cart_count)(request)
+
+
+def set_cart_count(request, count):
+    request.session[CART_COUNT_SESSION_KEY] = count
+
+
+def update_cart_count(request, cart):
+    """
+    カートを変更した直後に呼び出し、セッションの商品数を最新の状態にする（write-through）。
+    """
+    set_cart_count(request, cart.items.count())
+
+
+def get_applied_promo(request):
+    """
+    適用中のプロモコードを {'id', 'promo_code', 'discount_amount'} の辞書で返す。
+    適用時に検証した内容をセッションに保持しているので、カート表示のたびにDBを引かない。
+    使用済みかどうかの最終確認は、注文確定時の PromoCode.redeem で行う。
+    """
+    session = request.session
+    promo = session.get(APPLIED_PROMO_SESSION_KEY)
+    if promo is None and LEGACY_PROMO_ID_SESSION_KEY in session:
+        # 以前の形式のセッションは一度だけDBから読み直して新しい形式に置き換える
+        promo_code = PromoCode.objects.filter(
+            id=session.pop(LEGACY_PROMO_ID_SESSION_KEY), is_used=False
+        ).first()
+        if promo_code:
+            promo = set_applied_promo(request, promo_code)
+    return promo
+
+
+def set_applied_promo(request, promo_code):
+    promo = {
+        'id': promo_code.id,
+        'promo_code': promo_code.promo_code,
+        'discount_amount': promo_code.discount_amount,
+    }
+    request.session[APPLIED_PROMO_SESSION_KEY] = promo
+    return promo
+
+
+def clear_applied_promo(request):
+    request.session.pop(APPLIED_PROMO_SESSION_KEY, None)
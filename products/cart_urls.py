@@ -1,10 +1,17 @@
+from django.conf import settings
 from django.urls import path
-from .cart_views import CartItemList, add_to_cart, delete_cart_item, checkout, apply_promo
+
+if settings.ASYNC_VIEWS:
+    # ASGI サーバーで動かす場合は非同期版のビューを使う
+    from .async_views import CartItemList, add_to_cart, update_cart, delete_cart_item, checkout, apply_promo
+else:
+    from .cart_views import CartItemList, add_to_cart, update_cart, delete_cart_item, checkout, apply_promo
 
 
 urlpatterns = [
     path('list/', CartItemList.as_view(), name='cart_list'),
     path('add/<int:product_id>/', add_to_cart, name='add_to_cart'),
+    path('update/', update_cart, name='update_cart'),
     path('delete/<int:pk>/', delete_cart_item, name='cart_item_delete'),
     path('checkout/', checkout, name='checkout'),
     path('apply-promo/', apply_promo, name='apply_promo'),
@@ -1,16 +1,19 @@
+import json
 from django.views.generic import ListView
-from .models import Cart, CartItem, Product, OrderItem, PromoCode
+from .models import Cart, CartItem, Product, PromoCode
 from .forms import OrderForm
+from .checkout import place_order, PromoCodeUnavailableError
+from .cart_batch import CartOperationError, apply_cart_operations, parse_operations
+from .cart_session import (get_cart_count, set_cart_count, update_cart_count,
+                           get_applied_promo, set_applied_promo, clear_applied_promo)
+from .idempotency import (DuplicateCheckout, claim_checkout_key, complete_checkout_key,
+                          get_checkout_key, new_checkout_key, release_checkout_key)
+from .outbox import enqueue_order_success_mail
+from .reservations import reserve_stock
+from django.http import JsonResponse
 from django.shortcuts import redirect, get_object_or_404, render
 from django.contrib import messages
 from django.db import transaction
-from django.conf import settings
-from django.template.loader import render_to_string
-from django.core.mail import send_mail
-from django.utils import timezone
-import logging
-
-logger = logging.getLogger(__name__)
 
 
 class CartItemList(ListView):
@@ -19,14 +22,15 @@ class CartItemList(ListView):
     context_object_name = 'cart_items'
 
     def get_queryset(self):
-        if not self.request.session.session_key:
-            self.request.session.create()
+        # セッション未作成のユーザーはカートも持っていないので、セッションを作らずに空のカートを表示する
         session_key = self.request.session.session_key
+        if not session_key:
+            return CartItem.objects.none()
         try:
             cart = Cart.objects.get(session_key=session_key)
         except Cart.DoesNotExist:
             return CartItem.objects.none()
-        return CartItem.objects.filter(cart=cart).select_related('product')
+        return CartItem.objects.filter(cart=cart).with_prices()
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -34,14 +38,14 @@ class CartItemList(ListView):
         # テンプレートで {{ form }} が使えるようにフォームを追加
         context['form'] = OrderForm()
 
-        cart_items = context[self.context_object_name]
-        original_total_price = sum(item.subtotal for item in cart_items)
         applied_promo, discount, total_price = _get_promo_details_and_final_price(
-            self.request, original_total_price
+            self.request, self.object_list
         )
         context['discount'] = discount
         context['applied_promo'] = applied_promo
         context['total_price'] = total_price
+        # 購入手続きの二重送信を見分けるため、表示のたびに新しいキーをフォームに埋め込む
+        context['checkout_key'] = new_checkout_key()
         return context
 
 
@@ -60,15 +64,7 @@ def add_to_cart(request, product_id):
         messages.error(request, '無効な操作です。')
         return redirect(redirect_url)
 
-    # 2. セッションとカートの準備
-    if not request.session.session_key:
-        request.session.create()
-    session_key = request.session.session_key
-    cart, created = Cart.objects.get_or_create(session_key=session_key)
-
-    product = get_object_or_404(Product, pk=product_id)
-
-    # 3. 数量の取得 (詳細画面からの指定に対応)
+    # 2. 数量の取得 (詳細画面からの指定に対応)
     try:
         # 詳細画面からの追加はquantity、一覧からの場合は1
         quantity_to_add = int(request.POST.get('quantity', 1))
@@ -79,28 +75,45 @@ def add_to_cart(request, product_id):
         messages.error(request, '数量は半角数字で入力してください')
         return redirect(redirect_url)
 
-    # 4. 在庫チェック
-    if product.stock <= 0:
-        messages.error(request, f'{product.name} は在庫切れです')
-        return redirect(redirect_url)
+    # セッションはカートに商品が入るときまで作らない（在庫切れ等で追加できなかった場合も作らない）
+    session_key = request.session.session_key
 
-    # 5. カートアイテムの取得または作成
-    item, created = CartItem.objects.get_or_create(
-        cart=cart,
-        product=product,
-        # 新規追加時も「0 + 追加数」で計算できるよう初期値を 0 にする
-        defaults={'quantity': 0}
-    )
-
-    # 6. 合計数量が在庫を超えないかチェック
-    target_quantity = item.quantity + quantity_to_add
-    if target_quantity > product.stock:
-        messages.error(request, f'{product.name} の在庫数（{product.stock}個）を超えたためカートに追加できませんでした')
-        return redirect(redirect_url)
+    with transaction.atomic():
+        # 同じ商品の確保が同時に行われないよう商品行をロックし、販売可能数（在庫数 - 他のカートの確保数）を取得
+        product = get_object_or_404(
+            Product.objects.select_for_update().with_available_stock(exclude_session_key=session_key),
+            pk=product_id,
+        )
+
+        # 3. 在庫チェック
+        if product.available_stock <= 0:
+            messages.error(request, f'{product.name} は在庫切れです')
+            return redirect(redirect_url)
+
+        # 4. 合計数量が販売可能数を超えないかチェック
+        cart = Cart.objects.filter(session_key=session_key).first() if session_key else None
+        item = CartItem.objects.filter(cart=cart, product=product).first() if cart else None
+        target_quantity = (item.quantity if item else 0) + quantity_to_add
+        if target_quantity > product.available_stock:
+            messages.error(
+                request,
+                f'{product.name} の在庫数（{product.available_stock}個）を超えたためカートに追加できませんでした'
+            )
+            return redirect(redirect_url)
+
+        # 5. セッションとカートを用意して保存し、カートに入れた数量分の在庫を一定時間確保する
+        if cart is None:
+            if not session_key:
+                request.session.create()
+            cart, _ = Cart.objects.get_or_create(session_key=request.session.session_key)
+        if item:
+            item.quantity = target_quantity
+            item.save()
+        else:
+            item = CartItem.objects.create(cart=cart, product=product, quantity=target_quantity)
+        reserve_stock(item)
 
-    # 7. 保存
-    item.quantity = target_quantity
-    item.save()
+    update_cart_count(request, cart)
 
     messages.success(request, f'{product.name} をカートに追加しました')
     return redirect(redirect_url)
@@ -116,38 +129,84 @@ def delete_cart_item(request, pk):
 
     product_name = item.product.name
     item.delete()
+    update_cart_count(request, item.cart)
 
     messages.success(request, f'{product_name} をカートから削除しました')
     return redirect('cart_list')
 
 
-def _get_promo_details_and_final_price(request, cart_total_price):
-    promo_id = request.session.get('applied_promo_id')
-    applied_promo_code = None
-    discount = 0
-    discounted_total = cart_total_price
+def update_cart(request):
+    """
+    カートへの複数の商品の追加・数量変更・削除を、1回のリクエストでまとめて反映する。
+    JSON（{"operations": [{"product_id": 1, "quantity": 2, "mode": "set"}, ...]}）で送ると行ごとの結果を JSON で返す。
+    フォーム（product_id と quantity を同じ数だけ、mode は1つ）で送ると、結果をメッセージに表示してカートに戻る。
+    mode は add（今の数量に足す）または set（数量を置き換える。0 は削除）で、省略時は set。
+    """
+    wants_json = request.content_type == 'application/json'
+    if request.method != 'POST':
+        if wants_json:
+            return JsonResponse({'error': '無効な操作です'}, status=405)
+        return redirect('cart_list')
 
-    if promo_id:
-        applied_promo_code = PromoCode.objects.filter(id=promo_id, is_used=False).first()
-        if applied_promo_code:
-            discount = applied_promo_code.discount_amount
-            discounted_total = applied_promo_code.apply_discount(cart_total_price)
+    try:
+        if wants_json:
+            payload = json.loads(request.body)
+            raw_operations = payload.get('operations') if isinstance(payload, dict) else payload
         else:
-            # sessionに入っているのは本来有効なpromo_idにも関わらず、DBに有効なコードがない不整合状態のため、削除
-            request.session.pop('applied_promo_id', None)
+            mode = request.POST.get('mode')
+            raw_operations = [
+                {'product_id': product_id, 'quantity': quantity, 'mode': mode}
+                for product_id, quantity in zip(request.POST.getlist('product_id'), request.POST.getlist('quantity'))
+            ]
+        operations = parse_operations(raw_operations)
+    except (json.JSONDecodeError, CartOperationError) as e:
+        error = 'JSONの形式が不正です' if isinstance(e, json.JSONDecodeError) else str(e)
+        if wants_json:
+            return JsonResponse({'error': error}, status=400)
+        messages.error(request, error)
+        return redirect('cart_list')
+
+    cart, results = apply_cart_operations(request.session, operations)
+    if cart is not None:
+        update_cart_count(request, cart)
+
+    if wants_json:
+        return JsonResponse({'results': results, 'cart_count': get_cart_count(request)})
+
+    applied = sum(1 for result in results if result['ok'])
+    if applied:
+        messages.success(request, f'{applied}件の変更をカートに反映しました')
+    for result in results:
+        if not result['ok']:
+            messages.error(request, result['error'])
+    return redirect('cart_list')
+
 
-    return applied_promo_code, discount, discounted_total
+def _get_promo_details_and_final_price(request, cart_items):
+    # 適用中のプロモコードはセッションに保持した検証済みの内容を使う（DBは引かない）
+    applied_promo = get_applied_promo(request)
+    discount = applied_promo['discount_amount'] if applied_promo else 0
+
+    # 小計・合計・割引後の金額はDB側で1回の集計クエリで計算する
+    discounted_total = cart_items.totals(discount=discount)['discounted_total']
+
+    return applied_promo, discount, discounted_total
 
 
 def apply_promo(request):
     if request.method != 'POST':
         return redirect('cart_list')
 
+    # カートに商品を入れていない（セッションが無い）ユーザーのために、セッションを作ってまで保持しない
+    if not request.session.session_key:
+        messages.error(request, 'カートに商品が入っていません')
+        return redirect('cart_list')
+
     code = request.POST.get('promo_code')
     promo_code = PromoCode.find_valid_code(code)
 
     if promo_code and promo_code.is_valid:
-        request.session['applied_promo_id'] = promo_code.id
+        set_applied_promo(request, promo_code)
         messages.success(request, f'プロモーションコード「{code}」を適用しました')
     else:
         messages.error(request, '無効なプロモーションコードです')
@@ -159,19 +218,54 @@ def checkout(request):
     if request.method != 'POST':
         return redirect('cart_list')
 
+    # 同じフォームの二重送信やプロキシの再送は、カートや商品を読まずに最初のリクエストの結果を返す
+    session_key = request.session.session_key
+    key = get_checkout_key(request)
+    checkout_key = None
+    if key and session_key:
+        try:
+            checkout_key = claim_checkout_key(key, session_key)
+        except DuplicateCheckout as e:
+            return _duplicate_checkout(request, e.checkout_key)
+
+    try:
+        return _checkout(request, checkout_key)
+    finally:
+        # 注文に至らなかった場合（入力エラー・在庫不足・例外）は、同じフォームから送信し直せるようにする
+        if checkout_key is not None and checkout_key.status != checkout_key.STATUS_COMPLETED:
+            release_checkout_key(checkout_key)
+
+
+def _duplicate_checkout(request, checkout_key):
+    if checkout_key.session_key != request.session.session_key:
+        messages.error(request, '無効な操作です')
+        return redirect('cart_list')
+    if checkout_key.status == checkout_key.STATUS_COMPLETED:
+        # 最初のリクエストと同じ結果にする
+        # カートの商品数は最初のリクエストで0にしてあり、その後に追加した分は追加時に反映済みなので変更しない
+        messages.success(request, '購入ありがとうございます')
+    else:
+        messages.info(request, 'ご注文を処理しています。しばらくお待ちください')
+    return redirect('product_list')
+
+
+def _checkout(request, checkout_key):
     form = OrderForm(request.POST)
     # カートを取得
     cart = Cart.objects.filter(session_key=request.session.session_key).first()
-    applied_promo, discount, total_price = _get_promo_details_and_final_price(request, cart.total_price)
+    cart_items = CartItem.objects.filter(cart=cart).with_prices() if cart else CartItem.objects.none()
+    applied_promo, discount, total_price = _get_promo_details_and_final_price(request, cart_items)
 
     if not form.is_valid():
         # これを渡さないとカートとフォームの入力値が空になる
         context = {
-            'cart_items': cart.items.all() if cart else [],
+            'cart_items': cart_items,
             'total_price': total_price,
             'discount': discount,
             'applied_promo': applied_promo,
             'form': form,
+            # 入力エラーの場合はキーを削除するので、同じキーのまま送信し直してよい
+            'checkout_key': get_checkout_key(request) or new_checkout_key(),
         }
         return render(request, 'cart.html', context)
 
@@ -184,66 +278,36 @@ def checkout(request):
     # 注文確定処理
     try:
         with transaction.atomic():
-            # 注文を保存
+            # 注文内容をセット（保存は place_order の中で行う）
             order = form.save(commit=False)
             order.total_price = total_price
             order.discount_amount = discount
-            order.save()
-
-            # 明細を作成し、在庫を減らす
-            for item in cart.items.all():
-                product = item.product
-                # 在庫チェック
-                if product.stock < item.quantity:
-                    raise ValueError(f'{product.name}の在庫が足りません')
-
-                # 在庫を減らして保存
-                product.stock -= item.quantity
-                product.save()
-
-                # 注文明細を保存
-                OrderItem.objects.create(
-                    order=order,
-                    product=product,
-                    name_at_purchase=product.name,
-                    price_at_purchase=product.sale_price if product.sale else product.price,
-                    quantity=item.quantity
-                )
-
-            if applied_promo:
-                applied_promo.is_used = True
-                applied_promo.used_at = timezone.now()
-                applied_promo.save()
-                request.session.pop('applied_promo_id', None)
-
-            # カートを空にする
-            cart.items.all().delete()
-
-        # メール送信処理
-        try:
-            context = {
-                'order': order,
-                'order_items': order.order_items.all()
-            }
-
-            subject = f'【Daily Select】ご注文ありがとうございます（注文番号： #{order.id}）'
-            message_txt = render_to_string('mail/order_success.txt', context)
-            message_html = render_to_string('mail/order_success.html', context)
-
-            send_mail(
-                subject,
-                message_txt,
-                settings.DEFAULT_FROM_EMAIL,
-                [order.email],
-                # html_message=は省略不可
-                html_message=message_html,
-            )
-        except Exception as e:
-            logger.error(f'Failed to send mail: {e}')
+
+            # プロモコードを使用済みにし、明細を作成して在庫を減らす（行ロック＋一括更新）
+            order_items = place_order(cart, order, promo_id=applied_promo['id'] if applied_promo else None)
+
+            # 注文完了メールはアウトボックスに書き込み、送信はワーカー（send_outbox_emails）に任せる
+            enqueue_order_success_mail(order, order_items)
+
+            # 冪等キーは注文と同じトランザクションで完了にする（注文がロールバックされたら完了にならない）
+            if checkout_key is not None:
+                complete_checkout_key(checkout_key, order)
+        if checkout_key is not None:
+            checkout_key.status = checkout_key.STATUS_COMPLETED
+
+        # カートは空になったのでヘッダーの商品数も0にする
+        set_cart_count(request, 0)
+        clear_applied_promo(request)
 
         messages.success(request, '購入ありがとうございます')
         return redirect('product_list')
 
+    except PromoCodeUnavailableError as e:
+        # 他の注文で先に使われていた場合は、プロモコードを外してカートに戻す
+        clear_applied_promo(request)
+        messages.error(request, str(e))
+        return redirect('cart_list')
+
     except ValueError as e:
         messages.error(request, str(e))
         return redirect('cart_list')
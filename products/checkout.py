@@ -0,0 +1,152 @@
+from django.db import transaction
+from django.db.models import Case, F, Q, When
+from django.utils import timezone
+from .models import Product, OrderItem, PromoCode, StockMovement, StockReservation
+from .related import invalidate_related_products
+from .sales import record_order_sales
+
+
+class OutOfStockError(ValueError):
+    """
+    在庫不足の明細がある場合に送出する例外。
+    shortages には (商品, 注文数量, 販売可能数) のタプルを不足している行の分だけ格納する。
+    """
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__('、'.join(
+            f'{product.name}の在庫が足りません（残り{available}個）'
+            for product, quantity, available in shortages
+        ))
+
+
+class PromoCodeUnavailableError(ValueError):
+    """
+    適用していたプロモコードが、他の注文ですでに使用されていた場合に送出する例外。
+    """
+    def __init__(self):
+        super().__init__('このプロモーションコードはすでに使用されています')
+
+
+def place_order(cart, order, promo_id=None):
+    """
+    カートの中身を注文として確定する。
+    必ず transaction.atomic() の中から呼び出すこと。
+
+    カートの行数に関係なく、発行するクエリ数が一定になるようにしている。
+      1. カート明細と在庫確保の取得
+      2. プロモコードの使用（条件付きUPDATE）
+      3. 商品の取得（確保が切れている明細の商品だけ行ロック）
+      4. 注文の保存
+      5. 在庫の一括減算（条件付きUPDATE）
+      6. 在庫の増減の一括記録（bulk_create）
+      7. 注文明細の一括作成（bulk_create）
+      8. カートを空にする（在庫確保も一緒に削除される）
+      9. 購入した商品の関連商品のリストの削除
+    """
+    cart_items = list(cart.items.select_related('reservation').order_by('product_id'))
+    if not cart_items:
+        raise ValueError('カートに商品が入っていません')
+
+    # プロモコードは在庫より先に確定させ、使えなかった場合は商品行をロックする前に中断する
+    if promo_id is not None and not PromoCode.redeem(promo_id):
+        raise PromoCodeUnavailableError()
+
+    # カートに入れた時点で確保した在庫が有効な明細は、他のカートと取り合いにならないので行ロックは不要
+    held_ids, unheld_ids = [], []
+    for item in cart_items:
+        if _is_held(item):
+            held_ids.append(item.product_id)
+        else:
+            unheld_ids.append(item.product_id)
+
+    products = {}
+    if unheld_ids:
+        # デッドロックを防ぐため、ロックは常に商品IDの昇順で取得する
+        products.update(
+            (product.pk, product)
+            for product in Product.objects.select_for_update()
+            .with_available_stock(exclude_session_key=cart.session_key)
+            .filter(pk__in=unheld_ids)
+            .order_by('pk')
+        )
+    if held_ids:
+        products.update(
+            (product.pk, product)
+            for product in Product.objects.filter(pk__in=held_ids)
+        )
+
+    # 確保が切れている明細は、他のカートの確保分を除いた販売可能数で確認し、不足はまとめて報告する
+    shortages = [
+        (products[item.product_id], item.quantity, products[item.product_id].available_stock)
+        for item in cart_items
+        if item.product_id in unheld_ids and products[item.product_id].available_stock < item.quantity
+    ]
+    if shortages:
+        raise OutOfStockError(shortages)
+
+    order.save()
+
+    # 在庫は F() 式で1回のUPDATEにまとめて減らす
+    # stock >= 数量 の条件を付けているので、ロックが効かないDBでもマイナス在庫にはならない
+    in_stock = Q()
+    for item in cart_items:
+        in_stock |= Q(pk=item.product_id, stock__gte=item.quantity)
+    updated = Product.objects.filter(in_stock).update(
+        stock=Case(
+            *[When(pk=item.product_id, then=F('stock') - item.quantity) for item in cart_items],
+            default=F('stock'),
+            output_field=Product._meta.get_field('stock'),
+        ),
+        # update() では auto_now が効かないため明示的に更新する
+        updated_at=timezone.now(),
+    )
+    if updated != len(cart_items):
+        # ロック取得後に在庫が変わることは通常ないが、念のため不足分を再取得して報告する
+        current = Product.objects.in_bulk([item.product_id for item in cart_items])
+        raise OutOfStockError([
+            (current[item.product_id], item.quantity, current[item.product_id].stock)
+            for item in cart_items
+            if current[item.product_id].stock < item.quantity
+        ])
+
+    # 減らした在庫を増減の履歴に記録する
+    StockMovement.objects.bulk_create([
+        StockMovement(product_id=item.product_id, delta=-item.quantity, reason=StockMovement.REASON_ORDER, order=order)
+        for item in cart_items
+    ])
+
+    order_items = OrderItem.objects.bulk_create([
+        OrderItem(
+            order=order,
+            product=products[item.product_id],
+            name_at_purchase=products[item.product_id].name,
+            price_at_purchase=_unit_price(products[item.product_id]),
+            quantity=item.quantity,
+        )
+        for item in cart_items
+    ])
+
+    cart.items.all().delete()
+
+    # 一緒に購入された回数が変わるので、購入した商品の関連商品のリストを削除して次の表示時に計算し直させる
+    # （ここで計算し直すと、明細の行数に比例したクエリが購入のレスポンスに加わる）
+    invalidate_related_products(list(products))
+    # 日別の売上集計に加算する。失敗しても注文は確定済みなので、ログに残して rebuild_sales_rollups で補正する
+    transaction.on_commit(lambda: record_order_sales(order, order_items), robust=True)
+
+    return order_items
+
+
+def _is_held(cart_item):
+    try:
+        reservation = cart_item.reservation
+    except StockReservation.DoesNotExist:
+        return False
+    return reservation.is_active and reservation.quantity >= cart_item.quantity
+
+
+def _unit_price(product):
+    # セール価格があり、セールを設定している場合はセール価格、違えば通常価格
+    if product.sale and product.sale_price is not None:
+        return product.sale_price
+    return product.price
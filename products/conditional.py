@@ -0,0 +1,102 @@
+import hashlib
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.db.models import OuterRef, Subquery
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers, quote_etag
+from .cart_session import get_cart_count
+from .models import Product, RelatedProduct
+
+# 商品一覧・商品詳細の条件付きGET（If-None-Match → 304 Not Modified）
+# ページにはカートの商品数・CSRFトークン・販売可能数などユーザーごとに異なる内容が含まれるため、
+# 検証子は ETag だけを使い、その材料にユーザーごとの値も含める。
+# （Last-Modified の日時ではこれらの変化を表せないので付けない）
+# 材料はすべてDBから読んだ値にする。キャッシュに置いた値はキャッシュをプロセスごとに持つ場合にワーカー間で異なり、
+# 他のワーカーで更新があっても古いページに 304 を返してしまうため使わない。
+
+
+def make_etag(request, *parts):
+    """
+    ページの内容を決める値 parts と、ユーザーごとの表示内容から ETag を作る。
+    表示待ちのメッセージがある場合は、304 を返すとメッセージが表示されないので None を返す。
+    """
+    if len(get_messages(request)):
+        return None
+    values = [
+        get_cart_count(request),
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+        *parts,
+    ]
+    digest = hashlib.md5('|'.join(map(str, values)).encode(), usedforsecurity=False).hexdigest()
+    return quote_etag(digest)
+
+
+def not_modified(request, etag):
+    """
+    リクエストの If-None-Match が etag と一致すれば 304 のレスポンスを、そうでなければ None を返す。
+    """
+    if etag is None:
+        return None
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        add_validators(response, etag)
+    return response
+
+
+def add_validators(response, etag):
+    # ブラウザには毎回 ETag で再検証させる（内容が変わっていなければ 304 で本文を送らずに済む）
+    # ユーザーごとに内容が異なるので、共有キャッシュ（CDN）には保存させない
+    if etag is not None and (200 <= response.status_code < 300 or response.status_code == 304):
+        response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+
+def product_list_state(queryset):
+    """
+    商品一覧のページに並ぶ商品の (ID, 更新日時) のリストを取得する。
+    queryset には、ページの取得と同じシーク・件数（KeysetPaginationMixin._seek）を適用したものを渡す。
+    表示する行だけをインデックスで読むので、商品数が増えても時間は変わらない。
+    ID も含めるので、ページに商品が追加・削除されて並びが変わった場合も値が変わる。
+    """
+    return list(queryset.values_list('pk', 'updated_at'))
+
+
+async def aproduct_list_state(queryset):
+    return [row async for row in queryset.values_list('pk', 'updated_at')]
+
+
+def product_detail_state(product_id, session_key):
+    """
+    商品詳細の内容を決める値（商品の更新日時・販売可能数・関連商品のリストと、関連商品それぞれの更新日時）を取得するクエリ。
+    """
+    entries = RelatedProduct.objects.filter(product=OuterRef('pk'))
+    return (
+        Product.objects.filter(pk=product_id)
+        .with_available_stock(exclude_session_key=session_key)
+        .annotate(
+            related_updated_at=Subquery(entries.order_by('-updated_at').values('updated_at')[:1]),
+            # 関連商品として表示している商品の名前・価格等の変更
+            related_product_updated_at=Subquery(
+                entries.order_by('-related__updated_at').values('related__updated_at')[:1]
+            ),
+        )
+        .values_list('updated_at', 'available_stock', 'related_updated_at', 'related_product_updated_at')
+    )
+
+
+class ConditionalGetMixin:
+    """
+    get_etag() が返す ETag で条件付きGETに対応する、クラスベースビュー用の Mixin。
+    内容が変わっていなければ、ビューの処理やテンプレートの描画をせずに 304 を返す。
+    """
+    def get_etag(self):
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        etag = self.get_etag()
+        response = not_modified(request, etag)
+        if response is not None:
+            return response
+        response = super().get(request, *args, **kwargs)
+        return add_validators(response, etag)
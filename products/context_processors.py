@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.utils.functional import SimpleLazyObject
+from .cart_session import get_cart_count
+
+
+def cart_count(request):
+    """
+    全テンプレートで {{ cart_count }} を使えるようにする。
+    テンプレートで実際に参照されたときだけ評価するので、使わないページではセッションも読まない。
+    """
+    return {'cart_count': SimpleLazyObject(lambda: get_cart_count(request))}
+
+
+def catalog_cache(request):
+    """
+    商品カード等のフラグメントキャッシュ（{% cache %}）で使う有効期限。
+    キャッシュのキーは商品の id と updated_at だけで決まるので、キャッシュをプロセスごとに持っていても
+    商品が変更されれば、どのワーカーでも作り直される。
+    """
+    return {'catalog_cache_timeout': settings.CATALOG_CACHE_TIMEOUT}
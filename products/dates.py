@@ -0,0 +1,11 @@
+from datetime import datetime, time
+from django.utils import timezone
+
+# 日付（日本時間）で期間を指定する処理（注文の書き出し・売上の再集計）の共通関数
+
+
+def start_of_day(date):
+    """
+    日本時間（TIME_ZONE）の date の0時を aware な datetime で返す。
+    """
+    return timezone.make_aware(datetime.combine(date, time.min))
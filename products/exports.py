@@ -0,0 +1,94 @@
+import csv
+import json
+from itertools import islice
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+from .dates import start_of_day
+from .models import OrderItem
+
+# 書き出す列（カード情報は含めない）
+ORDER_EXPORT_FIELDS = [
+    'order_id', 'ordered_at', 'last_name', 'first_name', 'email', 'tel',
+    'zip_code', 'address', 'address2', 'discount_amount', 'order_total_price',
+    'product_id', 'name_at_purchase', 'price_at_purchase', 'quantity', 'subtotal',
+]
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def iter_order_rows(date_from=None, date_to=None, chunk_size=2000):
+    """
+    注文明細1行につき1件の辞書を返すジェネレーター。
+    注文は明細に JOIN して1本のクエリで取得し、iterator() で chunk_size 件ずつ読むので、
+    期間がどれだけ長くてもメモリ使用量は一定になる。
+    （ASGI のレスポンスで送る場合は、aexport_lines() で非同期ジェネレーターにすること）
+    date_from / date_to は日本時間の日付で、両端を含む。
+    """
+    queryset = OrderItem.objects.select_related('order').order_by('order_id', 'pk')
+    if date_from:
+        queryset = queryset.filter(order__created_at__gte=start_of_day(date_from))
+    if date_to:
+        queryset = queryset.filter(order__created_at__lt=start_of_day(date_to + timedelta(days=1)))
+
+    for item in queryset.iterator(chunk_size=chunk_size):
+        order = item.order
+        yield {
+            'order_id': order.id,
+            'ordered_at': timezone.localtime(order.created_at).isoformat(),
+            'last_name': order.last_name,
+            'first_name': order.first_name,
+            'email': order.email,
+            'tel': order.tel,
+            'zip_code': order.zip_code,
+            'address': order.address,
+            'address2': order.address2,
+            'discount_amount': order.discount_amount,
+            'order_total_price': order.total_price,
+            'product_id': item.product_id,
+            'name_at_purchase': item.name_at_purchase,
+            'price_at_purchase': item.price_at_purchase,
+            'quantity': item.quantity,
+            'subtotal': item.subtotal,
+        }
+
+
+class _Echo:
+    # csv.writer の書き込み先。書き込んだ1行をそのまま返す
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    # Excel で文字化けしないよう、先頭に BOM を付ける
+    yield '\ufeff'
+    writer = csv.DictWriter(_Echo(), fieldnames=ORDER_EXPORT_FIELDS)
+    yield writer.writeheader()
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def jsonl_lines(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+def export_lines(export_format, rows):
+    if export_format == 'jsonl':
+        return jsonl_lines(rows)
+    return csv_lines(rows)
+
+
+async def aexport_lines(lines, batch_size=500):
+    """
+    export_lines() の同期ジェネレーターを、ASGI で動かす場合の非同期ジェネレーターにする。
+    StreamingHttpResponse は同期のイテレーターを ASGI では全件 list にしてから送るため、
+    batch_size 行ずつスレッドで読み進めて送り、メモリ使用量を一定に保つ。
+    （sync_to_async は同じリクエストでは同じスレッドで実行するので、DBのカーソルも同じ接続のまま読める）
+    """
+    lines = iter(lines)
+    take = sync_to_async(lambda: ''.join(islice(lines, batch_size)))
+    while chunk := await take():
+        yield chunk
@@ -1,6 +1,8 @@
 from django import forms
+from django.db import transaction
 from .models import Product, Category, Order, PromoCode
 from datetime import datetime
+from .images import build_image_variants, clear_image_variants, delete_stale_image_variants, image_variant_files
 import magic
 import re
 
@@ -10,6 +12,20 @@ import re
 #     clear_checkbox_label = ''
 
 
+# 商品画像のアップロード上限
+IMAGE_MAX_UPLOAD_SIZE = 5 * 1024 * 1024
+
+
+class ProductImageField(forms.ImageField):
+    """
+    ImageField は Pillow でファイル全体を読んで検証するため、その前にサイズを確認して大きすぎるファイルは読まずに弾く。
+    """
+    def to_python(self, data):
+        if data and getattr(data, 'size', 0) > IMAGE_MAX_UPLOAD_SIZE:
+            raise forms.ValidationError('画像サイズは5MB以内にしてください', code='file_too_large')
+        return super().to_python(data)
+
+
 class ProductForm(forms.ModelForm):
     category = forms.ModelChoiceField(
         queryset=Category.objects.all(),
@@ -70,6 +86,9 @@ class ProductForm(forms.ModelForm):
             'sku': '例: PRODUCT-0000001',
             'sale': 'セールを実施する場合はこちらをチェックし、セール価格を入力してください'
         }
+        field_classes = {
+            'image': ProductImageField,
+        }
         widgets = {
             'name': forms.TextInput(attrs={'class': 'form-control'}),
             'price': forms.NumberInput(attrs={'class': 'form-control', 'min': 0}),
@@ -86,40 +105,71 @@ class ProductForm(forms.ModelForm):
         if not image:
             return image
 
-        mime = magic.from_buffer(image.read(), mime=True)
+        # サイズは ProductImageField で、ファイルを読む前に確認済み
+        # 形式の判定に必要なのは先頭の数KBだけなので、ファイル全体は読み込まない
+        mime = magic.from_buffer(image.read(2048), mime=True)
         image.seek(0)
         valid_mime_types = ['image/jpeg', 'image/png']
 
         if mime not in valid_mime_types:
             raise forms.ValidationError('画像形式が不正です。jpegまたはpng形式の画像のみアップロード可能です。')
 
-        if image.size > 5 * 1024 * 1024:
-            raise forms.ValidationError('画像サイズは5MB以内にしてください')
-
         return image
 
+    def save(self, commit=True):
+        product = super().save(commit=False)
+        self._previous_variants = []
+        # 画像が変更された場合は、表示用の縮小画像を作り直す
+        if 'image' in self.changed_data:
+            self._previous_variants = image_variant_files(product)
+            if product.image:
+                build_image_variants(product)
+            else:
+                clear_image_variants(product)
+        if commit:
+            product.save()
+            self._save_m2m()
+        return product
+
+    def _save_m2m(self):
+        # 商品を保存した後に呼ばれる（commit=False の場合は呼び出し側の save_m2m() から）
+        super()._save_m2m()
+        # 古い縮小画像は、商品の保存が確定してから削除する（ロールバックされた場合は元の画像を参照したまま）
+        previous_variants = self._previous_variants
+        if previous_variants:
+            transaction.on_commit(lambda: delete_stale_image_variants(self.instance, previous_variants))
+
     # セールにまつわるバリデーション
     def clean(self):
         cleaned = super().clean()
-        price = cleaned.get('price')
-        sale = cleaned.get('sale')
-        sale_price = cleaned.get('sale_price')
-
-        # セールにチェックが入っていないのに、セール価格を入力している場合
-        if not sale and sale_price:
-            self.add_error('sale', 'セール価格を設定する場合はセールにチェックを入れてください')
-
-        # セールにチェックを入れている場合
-        if sale:
-            # セール価格を入力していない
-            if not sale_price:
-                self.add_error('sale_price', 'セール価格を入力してください')
-        # セール価格は入力しているが、価格よりも安くない場合
-            elif price and sale_price >= price:
-                self.add_error('sale_price', 'セール価格は通常価格よりも安く設定してください')
+        for field, message in validate_sale_price(
+            cleaned.get('price'), cleaned.get('sale'), cleaned.get('sale_price')
+        ):
+            self.add_error(field, message)
         return cleaned
 
 
+def validate_sale_price(price, sale, sale_price):
+    """
+    セールにまつわるバリデーション。(フィールド名, エラーメッセージ) のリストを返す。
+    商品フォームと商品の一括インポート（import_products）で同じルールを使う。
+    """
+    errors = []
+    # セールにチェックが入っていないのに、セール価格を入力している場合
+    if not sale and sale_price:
+        errors.append(('sale', 'セール価格を設定する場合はセールにチェックを入れてください'))
+
+    # セールにチェックを入れている場合
+    if sale:
+        # セール価格を入力していない
+        if not sale_price:
+            errors.append(('sale_price', 'セール価格を入力してください'))
+        # セール価格は入力しているが、価格よりも安くない場合
+        elif price and sale_price >= price:
+            errors.append(('sale_price', 'セール価格は通常価格よりも安く設定してください'))
+    return errors
+
+
 class OrderForm(forms.ModelForm):
     class Meta:
         model = Order
@@ -253,3 +303,28 @@ class OrderForm(forms.ModelForm):
         if not re.match(r'^\d{3,4}$', cvv2):
             raise forms.ValidationError('セキュリティコードは3桁または4桁の数字で入力してください')
         return cvv2
+
+
+class DateRangeForm(forms.Form):
+    date_from = forms.DateField(required=False, label='開始日')
+    date_to = forms.DateField(required=False, label='終了日')
+
+    def clean(self):
+        cleaned = super().clean()
+        date_from = cleaned.get('date_from')
+        date_to = cleaned.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            self.add_error('date_to', '終了日は開始日以降の日付を指定してください')
+        return cleaned
+
+
+class OrderExportForm(DateRangeForm):
+    FORMAT_CHOICES = [
+        ('csv', 'CSV'),
+        ('jsonl', 'JSON Lines'),
+    ]
+
+    format = forms.ChoiceField(choices=FORMAT_CHOICES, required=False, label='形式')
+
+    def clean_format(self):
+        return self.cleaned_data.get('format') or 'csv'
@@ -0,0 +1,74 @@
+import secrets
+from datetime import timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import CheckoutKey
+
+# 購入手続きの冪等キー
+# カート画面を表示するたびに新しいキーをフォームに埋め込み、購入手続きのリクエストでは最初にキーを登録する。
+# キーの行は unique 制約で1つしか作れないので、同時に届いた二重送信も片方だけが注文処理に進む。
+CHECKOUT_KEY_FIELD = 'idempotency_key'
+CHECKOUT_KEY_HEADER = 'Idempotency-Key'
+
+
+class DuplicateCheckout(Exception):
+    """
+    同じキーの購入手続きがすでに行われている（処理中または完了）場合に送出する例外。
+    """
+    def __init__(self, checkout_key):
+        self.checkout_key = checkout_key
+        super().__init__(checkout_key.status)
+
+
+def new_checkout_key():
+    return secrets.token_urlsafe(24)
+
+
+def get_checkout_key(request):
+    # フォームの hidden フィールドのほか、API やプロキシのために Idempotency-Key ヘッダーでも受け付ける
+    key = request.headers.get(CHECKOUT_KEY_HEADER) or request.POST.get(CHECKOUT_KEY_FIELD) or ''
+    key = key.strip()
+    return key if 0 < len(key) <= CheckoutKey._meta.get_field('key').max_length else None
+
+
+def claim_checkout_key(key, session_key):
+    """
+    キーを処理中として登録し、CheckoutKey を返す。
+    すでに登録されていれば DuplicateCheckout を送出する（別のセッションのキーの場合も、結果は見せずに送出する）。
+    処理中のまま CHECKOUT_KEY_TIMEOUT_SECONDS を過ぎたキー（処理の途中でプロセスが落ちた等）は引き継いで登録し直す。
+    登録はすぐにコミットするので、ほかのリクエストからも処理中であることが見える。
+    """
+    try:
+        with transaction.atomic():
+            return CheckoutKey.objects.create(key=key, session_key=session_key)
+    except IntegrityError:
+        pass
+
+    existing = CheckoutKey.objects.get(key=key)
+    if existing.session_key != session_key:
+        raise DuplicateCheckout(existing)
+    stale_before = timezone.now() - timedelta(seconds=settings.CHECKOUT_KEY_TIMEOUT_SECONDS)
+    if existing.status == CheckoutKey.STATUS_PROCESSING and existing.updated_at < stale_before:
+        # 条件付きUPDATEなので、同時に引き継ごうとしたリクエストのうち1つだけが成功する
+        if CheckoutKey.objects.filter(
+            pk=existing.pk, status=CheckoutKey.STATUS_PROCESSING, updated_at=existing.updated_at
+        ).update(updated_at=timezone.now()):
+            return existing
+    raise DuplicateCheckout(existing)
+
+
+def complete_checkout_key(checkout_key, order):
+    """
+    キーを注文完了にする。注文と同じトランザクションの中で呼び出すこと。
+    """
+    CheckoutKey.objects.filter(pk=checkout_key.pk).update(
+        status=CheckoutKey.STATUS_COMPLETED, order=order, updated_at=timezone.now()
+    )
+
+
+def release_checkout_key(checkout_key):
+    """
+    注文に至らなかった（入力エラー・在庫不足等）キーを削除し、同じフォームから再度送信できるようにする。
+    """
+    CheckoutKey.objects.filter(pk=checkout_key.pk, status=CheckoutKey.STATUS_PROCESSING).delete()
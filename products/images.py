@@ -0,0 +1,65 @@
+import os
+from io import BytesIO
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+# アップロード時に作成する画像のサイズ違い（フィールド名: (最大幅, 最大高さ)）
+# 一覧のカードには image_thumbnail、商品詳細には image_detail を表示する
+IMAGE_VARIANTS = {
+    'image_thumbnail': (600, 600),
+    'image_detail': (1200, 1200),
+}
+IMAGE_VARIANT_FORMAT = 'WEBP'
+IMAGE_VARIANT_QUALITY = 80
+
+
+def build_image_variants(product):
+    """
+    product.image から一覧用・詳細用の WebP 画像を作成し、元画像と同じストレージに保存する。
+    モデルの保存は呼び出し側で行う。
+    """
+    product.image.seek(0)
+    with Image.open(product.image) as original:
+        # スマートフォンで撮影した画像の向きを補正する
+        image = ImageOps.exif_transpose(original)
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    stem = os.path.splitext(os.path.basename(product.image.name))[0]
+    for field_name, size in IMAGE_VARIANTS.items():
+        variant = image.copy()
+        # 縦横比を保ったまま縮小する（元画像より大きくはしない）
+        variant.thumbnail(size, Image.LANCZOS)
+        buffer = BytesIO()
+        variant.save(buffer, IMAGE_VARIANT_FORMAT, quality=IMAGE_VARIANT_QUALITY)
+        getattr(product, field_name).save(
+            f'{stem}_{field_name.removeprefix("image_")}.webp', ContentFile(buffer.getvalue()), save=False
+        )
+    product.image.seek(0)
+
+
+def clear_image_variants(product):
+    for field_name in IMAGE_VARIANTS:
+        setattr(product, field_name, '')
+
+
+def image_variant_files(product):
+    """
+    product に保存されている縮小画像の (ストレージ, ファイル名) のリストを返す。
+    """
+    files = []
+    for field_name in IMAGE_VARIANTS:
+        variant = getattr(product, field_name)
+        if variant:
+            files.append((variant.storage, variant.name))
+    return files
+
+
+def delete_stale_image_variants(product, previous_files):
+    """
+    画像の置き換え・削除で使われなくなった縮小画像（previous_files のうち、今の product が参照していないもの）を削除する。
+    ストレージによっては同じ名前で上書き保存するので、作り直した縮小画像と同じ名前のファイルは残す。
+    """
+    current = set(image_variant_files(product))
+    for storage, name in previous_files:
+        if (storage, name) not in current:
+            storage.delete(name)
@@ -4,7 +4,9 @@ from .manage_views import (ManageProductList,
                            ManageProductUpdate,
                            ManageProductDelete,
                            ManageOrderList,
-                           ManageOrderDetail)
+                           ManageOrderDetail,
+                           ManageOrderExport,
+                           ManageSalesDashboard)
 from basicauth.decorators import basic_auth_required
 
 app_name = "manage_product"
@@ -16,5 +18,7 @@ urlpatterns = [
     path('edit/<int:pk>', basic_auth_required(ManageProductUpdate.as_view()), name='edit'),
     path('delete/<int:pk>', basic_auth_required(ManageProductDelete.as_view()), name='delete'),
     path('order_list/', basic_auth_required(ManageOrderList.as_view()), name='order_list'),
-    path('order_detail/<int:pk>', basic_auth_required(ManageOrderDetail.as_view()), name='order_detail')
+    path('order_detail/<int:pk>', basic_auth_required(ManageOrderDetail.as_view()), name='order_detail'),
+    path('order_export/', basic_auth_required(ManageOrderExport.as_view()), name='order_export'),
+    path('sales/', basic_auth_required(ManageSalesDashboard.as_view()), name='sales_dashboard'),
 ]
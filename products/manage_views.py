@@ -1,14 +1,29 @@
-from django.views.generic import ListView, CreateView, UpdateView, DeleteView, DetailView
-from .models import Product, Category, Order
+from datetime import timedelta
+from django.views.generic import ListView, CreateView, UpdateView, DeleteView, DetailView, View
+from .models import Product, Category, Order, DailySales, DailyProductSales, DailyCategorySales
 from django.urls import reverse_lazy
-from .forms import ProductForm
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncMonth
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import render
+from django.utils import timezone
+from .forms import ProductForm, DateRangeForm, OrderExportForm
+from .exports import EXPORT_CONTENT_TYPES, aexport_lines, export_lines, iter_order_rows
 from django.contrib.messages.views import SuccessMessageMixin
+from .pagination import KeysetPaginationMixin
+from .stock import record_adjustment
 
 
-class ManageProductList(ListView):
+class ManageProductList(KeysetPaginationMixin, ListView):
     model = Product
     template_name = 'manage_product_list.html'
     context_object_name = 'manage_products'
+    paginate_by = 40
+
+    def get_queryset(self):
+        return Product.objects.only('id', 'name', 'price', 'sale', 'sale_price', 'image', 'image_thumbnail', 'created_at')
 
 
 class ManageProductCreate(SuccessMessageMixin, CreateView):
@@ -19,6 +34,13 @@ class ManageProductCreate(SuccessMessageMixin, CreateView):
     success_url = reverse_lazy('manage_product:list')
     success_message = '商品を追加しました'
 
+    def form_valid(self, form):
+        # 登録時の在庫数も増減の履歴に記録する
+        with transaction.atomic():
+            response = super().form_valid(form)
+            record_adjustment(self.object, self.object.stock)
+        return response
+
 
 class ManageProductUpdate(SuccessMessageMixin, UpdateView):
     model = Product
@@ -28,6 +50,14 @@ class ManageProductUpdate(SuccessMessageMixin, UpdateView):
     success_url = reverse_lazy('manage_product:list')
     success_message = '商品情報を更新しました'
 
+    def form_valid(self, form):
+        # 画面を開いてから購入で減った分も含めて記録するため、保存直前の在庫数をロックして読み、その差を記録する
+        with transaction.atomic():
+            previous = Product.objects.select_for_update().values_list('stock', flat=True).get(pk=self.object.pk)
+            response = super().form_valid(form)
+            record_adjustment(self.object, self.object.stock - previous)
+        return response
+
 
 class ManageProductDelete(SuccessMessageMixin, DeleteView):
     model = Product
@@ -52,3 +82,94 @@ class ManageOrderDetail(DetailView):
         context = super().get_context_data(**kwargs)
         context['order_items'] = self.object.order_items.all()
         return context
+
+
+class ManageOrderExport(View):
+    """
+    注文（明細単位）を CSV / JSON Lines でストリーミング出力する。
+    ?date_from=YYYY-MM-DD&date_to=YYYY-MM-DD&format=csv|jsonl
+    ASGI で動かす場合は非同期ジェネレーター（aexport_lines）で送る。
+    同期のイテレーターのままだと Django が全件を list にしてから送るため、件数に比例してメモリを使ってしまう。
+    """
+    def get(self, request, *args, **kwargs):
+        form = OrderExportForm(request.GET)
+        if not form.is_valid():
+            return HttpResponseBadRequest(form.errors.as_text())
+
+        export_format = form.cleaned_data['format']
+        rows = iter_order_rows(form.cleaned_data['date_from'], form.cleaned_data['date_to'])
+        lines = export_lines(export_format, rows)
+        if isinstance(request, ASGIRequest):
+            lines = aexport_lines(lines)
+        response = StreamingHttpResponse(lines, content_type=EXPORT_CONTENT_TYPES[export_format])
+        filename = f'orders_{timezone.localdate():%Y%m%d}.{export_format}'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+
+class ManageSalesDashboard(View):
+    """
+    期間内の売上・割引・プロモコードの利用と、商品別・カテゴリー別の売上を表示する。
+    日別の集計テーブルだけを読むので、期間が何年分でも注文・注文明細の件数によらず速く表示できる。
+    ?date_from=YYYY-MM-DD&date_to=YYYY-MM-DD（省略時は直近30日）
+    """
+    template_name = 'manage_sales_dashboard.html'
+    default_days = 30
+    # これより長い期間は、日別ではなく月別の推移を表示する
+    max_daily_rows = 92
+    top_products = 20
+
+    def get(self, request, *args, **kwargs):
+        form = DateRangeForm(request.GET)
+        if not form.is_valid():
+            return HttpResponseBadRequest(form.errors.as_text())
+
+        date_to = form.cleaned_data['date_to'] or timezone.localdate()
+        date_from = form.cleaned_data['date_from'] or date_to - timedelta(days=self.default_days - 1)
+        period = {'date__range': (date_from, date_to)}
+        totals = {'units': Sum('units'), 'gross_sales': Sum('gross_sales'), 'order_count': Sum('order_count')}
+
+        daily_sales = DailySales.objects.filter(**period)
+        summary = daily_sales.aggregate(
+            **totals,
+            discount_total=Sum('discount_total'),
+            net_sales=Sum('net_sales'),
+            promo_order_count=Sum('promo_order_count'),
+        )
+        monthly = (date_to - date_from).days >= self.max_daily_rows
+        if monthly:
+            trend = (
+                daily_sales.values(period=TruncMonth('date'))
+                .annotate(**totals, discount_total=Sum('discount_total'), net_sales=Sum('net_sales'),
+                          promo_order_count=Sum('promo_order_count'))
+                .order_by('-period')
+            )
+        else:
+            trend = daily_sales.values(
+                'units', 'gross_sales', 'order_count', 'discount_total', 'net_sales', 'promo_order_count',
+                period=F('date'),
+            ).order_by('-period')
+
+        products = (
+            DailyProductSales.objects.filter(**period)
+            .values('product_id', 'product__name')
+            .annotate(**totals)
+            .order_by('-gross_sales', 'product_id')[:self.top_products]
+        )
+        categories = (
+            DailyCategorySales.objects.filter(**period)
+            .values('category_id', 'category__name')
+            .annotate(**totals)
+            .order_by('-gross_sales', 'category_id')
+        )
+
+        return render(request, self.template_name, {
+            'form': form,
+            'date_from': date_from,
+            'date_to': date_to,
+            'summary': summary,
+            'monthly': monthly,
+            'trend': trend,
+            'products': products,
+            'categories': categories,
+        })
@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+import random
+import tempfile
+from django.db import connection
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import (
+    setup_databases, setup_test_environment, teardown_databases, teardown_test_environment,
+)
+from django.utils import timezone
+from products.benchmark import SCENARIOS, run_scenario, seed_catalog
+
+
+class Command(BaseCommand):
+    help = (
+        "テスト用のDBに合成データを作成し、商品一覧・商品詳細・カート追加・プロモコード適用・購入の"
+        "各リクエストのレイテンシ（p50/p95/p99）・スループット・クエリ数を計測するコマンド。"
+        "SQLite はDB全体で書き込みをロックするため、--concurrency を2以上にすると"
+        "カート追加・購入の一部が database is locked のエラーになる"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--endpoints', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS),
+            help='計測するリクエスト（デフォルトはすべて）'
+        )
+        parser.add_argument('--requests', type=int, default=200, help='リクエストごとの実行回数')
+        parser.add_argument('--concurrency', type=int, default=4, help='同時に実行するスレッド数')
+        parser.add_argument('--products', type=int, default=200, help='作成する商品数')
+        parser.add_argument('--seed', type=int, help='乱数のシード（同じ値を指定すると同じデータ・順序で実行する）')
+        parser.add_argument('--output', help='結果を書き出す JSON ファイルのパス')
+
+    def handle(self, *args, **options):
+        if options['requests'] <= 0 or options['concurrency'] <= 0 or options['products'] <= 0:
+            raise CommandError('--requests・--concurrency・--products は1以上を指定してください')
+        if options['seed'] is not None:
+            random.seed(options['seed'])
+        started_at = timezone.now()
+
+        # 本番・開発のデータを汚さないよう、テストランナーと同じ手順で作成したテスト用のDBに対して実行する
+        setup_test_environment()
+        if connection.vendor == 'sqlite' and not connection.settings_dict['TEST']['NAME']:
+            # SQLite のインメモリDBはスレッド間で共有するとテーブルロックのエラーになるため、一時ファイルを使う
+            connection.settings_dict['TEST']['NAME'] = os.path.join(
+                tempfile.gettempdir(), f'benchmark_{os.getpid()}.sqlite3'
+            )
+        # レプリカ（TEST の MIRROR）もテスト用のDBを向くようにする
+        old_config = setup_databases(verbosity=0, interactive=False, serialized_aliases=set())
+        # エラーになったリクエストは件数として集計するので、1件ごとのトレースバックは出力しない
+        request_logger = logging.getLogger('django.request')
+        log_level = request_logger.level
+        request_logger.setLevel(logging.CRITICAL)
+        try:
+            catalog = seed_catalog(products=options['products'])
+            results = []
+            for name in options['endpoints']:
+                result = run_scenario(
+                    name, catalog, requests=options['requests'], concurrency=options['concurrency']
+                )
+                results.append(result)
+                self._write_result(result)
+        finally:
+            request_logger.setLevel(log_level)
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        if options['output']:
+            report = {
+                'started_at': started_at.isoformat(),
+                'database': connection.vendor,
+                'products': options['products'],
+                'seed': options['seed'],
+                'results': results,
+            }
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'計測結果を {options["output"]} に書き出しました'))
+
+    def _write_result(self, result):
+        latency = result['latency_ms']
+        self.stdout.write(
+            f'{result["endpoint"]:<15} '
+            f'p50 {latency["p50"]:>8.2f}ms  p95 {latency["p95"]:>8.2f}ms  p99 {latency["p99"]:>8.2f}ms  '
+            f'{result["throughput_rps"]:>7.1f} req/s  '
+            f'クエリ {result["queries_per_request"]["mean"]:>5.1f}回/リクエスト  '
+            f'エラー {result["errors"]}/{result["requests"]}'
+        )
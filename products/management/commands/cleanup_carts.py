@@ -0,0 +1,81 @@
+from collections import Counter
+from datetime import timedelta
+from importlib import import_module
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore as DBSessionStore
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from products.models import Cart, CartItem, CheckoutKey
+
+
+class Command(BaseCommand):
+    help = "期限切れのセッションと、持ち主のセッションが無くなったカート、古い購入手続きの冪等キーを少しずつ削除するコマンド"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.SESSION_COOKIE_AGE // (60 * 60 * 24),
+            help='この日数以上更新されていないカートを削除対象にする（デフォルトはセッションの有効期限と同じ）'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='1回の DELETE で削除する件数')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size <= 0 or options['days'] < 0:
+            raise CommandError('--batch-size は1以上、--days は0以上を指定してください')
+        now = timezone.now()
+
+        cutoff = now - timedelta(days=options['days'])
+        # 一定期間更新がなく、その間に明細の追加・変更もないカート（明細は CASCADE で一緒に削除される）
+        recent_items = CartItem.objects.filter(cart=OuterRef('pk'), updated_at__gte=cutoff)
+        stale_carts = Cart.objects.filter(updated_at__lt=cutoff).filter(~Exists(recent_items))
+
+        if self._sessions_in_db():
+            # 1. 期限切れのセッション
+            expired_sessions = Session.objects.filter(expire_date__lt=now)
+            sessions_deleted = self._delete_in_batches(expired_sessions, batch_size)['sessions.Session']
+            self.stdout.write(f'期限切れのセッション: {sessions_deleted}件 削除')
+
+            # 2. 有効なセッションも残っていないカート
+            live_session = Session.objects.filter(session_key=OuterRef('session_key'), expire_date__gte=now)
+            orphaned_carts = stale_carts.filter(~Exists(live_session))
+        else:
+            # キャッシュだけにセッションを保存している場合、期限切れのセッションはキャッシュ側で消えるので
+            # セッションの有無は確認できない。一定期間使われていないカートをそのまま削除する
+            sessions_deleted = 0
+            self.stdout.write('セッションをDBに保存していないため、期限切れのセッションの削除は行いません')
+            orphaned_carts = stale_carts
+
+        deleted = self._delete_in_batches(orphaned_carts, batch_size)
+        carts_deleted, items_deleted = deleted['products.Cart'], deleted['products.CartItem']
+        self.stdout.write(f'放置されたカート: {carts_deleted}件（カート明細: {items_deleted}件） 削除')
+
+        # 3. 購入手続きの冪等キー（二重送信の判定にしか使わないので、カートと同じ期間で削除する）
+        old_keys = CheckoutKey.objects.filter(created_at__lt=cutoff)
+        keys_deleted = self._delete_in_batches(old_keys, batch_size)['products.CheckoutKey']
+        self.stdout.write(f'古い購入手続きの冪等キー: {keys_deleted}件 削除')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'合計 {sessions_deleted + carts_deleted + items_deleted + keys_deleted}行を削除しました'
+        ))
+
+    def _sessions_in_db(self):
+        # db と cached_db のセッションは django_session テーブルに保存される
+        engine = import_module(settings.SESSION_ENGINE)
+        return issubclass(engine.SessionStore, DBSessionStore)
+
+    def _delete_in_batches(self, queryset, batch_size):
+        """
+        テーブル全体を長時間ロックしないよう、主キーを batch_size 件ずつ取り出して削除する。
+        CASCADE で一緒に削除された分も含め、モデルごとの削除件数を返す。
+        """
+        model = queryset.model
+        deleted = Counter()
+        while True:
+            pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            _, per_model = model.objects.filter(pk__in=pks).delete()
+            deleted.update(per_model)
+        return deleted
@@ -0,0 +1,177 @@
+import csv
+import json
+import time
+from pathlib import Path
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from products.forms import validate_sale_price
+from products.models import Category, Product, StockMovement
+
+# ファイルから読み込む列
+IMPORT_FIELDS = ['sku', 'name', 'category', 'price', 'sale', 'sale_price', 'stock', 'description']
+# 既存の商品（SKUが一致するもの）を更新する列
+UPDATE_FIELDS = ['name', 'category', 'price', 'sale', 'sale_price', 'stock', 'description', 'updated_at']
+
+
+class Command(BaseCommand):
+    help = "CSV / JSON Lines から商品を一括登録・更新（SKUで照合）するコマンド"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='読み込むファイル（.csv または .jsonl）')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help='ファイル形式（省略時は拡張子で判定）')
+        parser.add_argument('--batch-size', type=int, default=1000, help='1回の INSERT ... ON CONFLICT で登録する件数')
+        parser.add_argument('--dry-run', action='store_true', help='検証だけを行い、DBには書き込まない')
+        parser.add_argument('--errors', help='エラーになった行を書き出す CSV ファイル')
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        import_format = options['format'] or path.suffix.lstrip('.').lower()
+        if import_format not in ('csv', 'jsonl'):
+            raise CommandError('--format に csv または jsonl を指定してください')
+        if options['batch_size'] <= 0:
+            raise CommandError('--batch-size は1以上を指定してください')
+
+        self.dry_run = options['dry_run']
+        # カテゴリーは slug → id をこのコマンドの中でキャッシュして、同じ slug を何度も引かない
+        self.category_ids = {}
+        self.errors = []
+        read = upserted = 0
+        started = time.monotonic()
+
+        self.stdout.write("商品のインポートを開始します..." + ("（dry-run）" if self.dry_run else ""))
+
+        # 同じバッチ内で SKU が重複すると一括登録できないため、SKU ごとに後の行で上書きする
+        batch = {}
+        for line_number, row in self._read_rows(path, import_format):
+            read += 1
+            product = self._build_product(line_number, row)
+            if product is None:
+                continue
+            batch[product.sku] = product
+            if len(batch) >= options['batch_size']:
+                upserted += self._upsert(batch.values())
+                batch = {}
+                self._progress(read, upserted, started)
+        if batch:
+            upserted += self._upsert(batch.values())
+
+        if options['errors']:
+            self._write_errors(options['errors'])
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'{read}行を読み込み、{upserted}件を{"検証" if self.dry_run else "登録・更新"}しました'
+            f'（エラー: {len(self.errors)}件, {elapsed:.1f}秒, {read / elapsed if elapsed else 0:,.0f}行/秒）'
+        ))
+
+    def _read_rows(self, path, import_format):
+        """
+        ファイルを1行ずつ読み、(行番号, 辞書) を返す。ファイル全体はメモリに読み込まない。
+        """
+        with path.open(encoding='utf-8-sig', newline='') as f:
+            if import_format == 'csv':
+                reader = csv.DictReader(f)
+                for row in reader:
+                    yield reader.line_num, row
+            else:
+                for line_number, line in enumerate(f, start=1):
+                    if not line.strip():
+                        continue
+                    try:
+                        yield line_number, json.loads(line)
+                    except json.JSONDecodeError as e:
+                        self.errors.append((line_number, '', f'JSONの形式が不正です: {e}'))
+
+    def _build_product(self, line_number, row):
+        """
+        1行分を検証して Product を作る。エラーがあればエラー一覧に追加して None を返す。
+        """
+        values = {field: row.get(field) for field in IMPORT_FIELDS}
+        sku = str(values['sku'] or '').strip()
+        errors = []
+
+        category_id = self._category_id(str(values['category'] or '').strip())
+        if category_id is None:
+            errors.append(f'category: カテゴリー「{values["category"]}」が存在しません')
+
+        product = Product(
+            sku=sku,
+            name=values['name'] or '',
+            category_id=category_id,
+            price=values['price'],
+            sale=_to_bool(values['sale']),
+            sale_price=values['sale_price'] if values['sale_price'] not in (None, '') else None,
+            stock=values['stock'] if values['stock'] not in (None, '') else 0,
+            description=values['description'] or '',
+        )
+        try:
+            # 型変換と、最大文字数・価格や在庫数の範囲などモデルに定義したルールの検証
+            product.clean_fields(exclude=['category', 'image', 'image_thumbnail', 'image_detail'])
+        except ValidationError as e:
+            for field, messages in e.message_dict.items():
+                errors.extend(f'{field}: {message}' for message in messages)
+        else:
+            # 商品フォームと同じセール価格のルール
+            errors.extend(
+                f'{field}: {message}'
+                for field, message in validate_sale_price(product.price, product.sale, product.sale_price)
+            )
+
+        if errors:
+            self.errors.append((line_number, sku, ' / '.join(errors)))
+            return None
+        return product
+
+    def _category_id(self, slug):
+        if slug not in self.category_ids:
+            self.category_ids[slug] = Category.objects.filter(slug=slug).values_list('pk', flat=True).first()
+        return self.category_ids[slug]
+
+    def _upsert(self, products):
+        products = list(products)
+        if not self.dry_run:
+            with transaction.atomic():
+                # 更新前の在庫数をロックして読み、変わった分を在庫の増減として記録する（新規の商品は0から）
+                previous = dict(
+                    Product.objects.select_for_update()
+                    .filter(sku__in=[product.sku for product in products])
+                    .order_by('pk')
+                    .values_list('sku', 'stock')
+                )
+                Product.objects.bulk_create(
+                    products,
+                    update_conflicts=True,
+                    unique_fields=['sku'],
+                    update_fields=UPDATE_FIELDS,
+                )
+                deltas = {
+                    product.sku: product.stock - previous.get(product.sku, 0)
+                    for product in products
+                    if product.stock != previous.get(product.sku, 0)
+                }
+                if deltas:
+                    # 一括登録では新規の商品の id が分からないので、SKU から引き直す
+                    product_ids = dict(Product.objects.filter(sku__in=deltas).values_list('sku', 'pk'))
+                    StockMovement.objects.bulk_create([
+                        StockMovement(product_id=product_ids[sku], delta=delta, reason=StockMovement.REASON_IMPORT)
+                        for sku, delta in deltas.items()
+                    ])
+        return len(products)
+
+    def _progress(self, read, upserted, started):
+        elapsed = time.monotonic() - started
+        self.stdout.write(f'{read}行 読み込み / {upserted}件 処理済み（{read / elapsed:,.0f}行/秒）')
+
+    def _write_errors(self, path):
+        with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['line', 'sku', 'errors'])
+            writer.writerows(self.errors)
+        self.stdout.write(f'エラーになった行を {path} に書き出しました')
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or '').strip().lower() in ('1', 'true', 't', 'yes', 'y', 'on')
@@ -1,38 +1,71 @@
 import random
 import string
-from django.core.management.base import BaseCommand
+import time
+from django.core.management.base import BaseCommand, CommandError
 from products.models import PromoCode
 
 
 class Command(BaseCommand):
-    help = "ランダムな7桁英数字のプロモーションコードを10個生成するコマンド"
+    help = "ランダムな7桁英数字のプロモーションコードを指定数（デフォルト10個）生成するコマンド"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=10, help='生成するコードの数')
+        parser.add_argument(
+            '--amount-range', type=int, nargs=2, default=[100, 1000], metavar=('MIN', 'MAX'),
+            help='割引額の範囲（100〜1000円）'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='1回の INSERT で登録する件数')
 
     def handle(self, *args, **options):
         # コードの長さ
         length = 7
         # 生成するコードの数
-        num_of_code = 10
+        num_of_code = options['count']
+        batch_size = options['batch_size']
+        min_amount, max_amount = options['amount_range']
+        if num_of_code <= 0 or batch_size <= 0:
+            raise CommandError('--count と --batch-size は1以上を指定してください')
+        if not 100 <= min_amount <= max_amount <= 1000:
+            raise CommandError('--amount-range は100〜1000の範囲で「最小 最大」の順に指定してください')
         # コードの文字列（英数字）
         chars = string.ascii_uppercase + string.digits
-        # DBにある既存のコードを格納
-        existing_codes = set(PromoCode.objects.values_list('promo_code', flat=True))
-        promo_list = []
-        # ループ内の重複チェック用
-        new_generated_codes = set()
 
         self.stdout.write("コード生成を開始します...")
+        started = time.monotonic()
+        created = 0
+
+        # 既存コードをメモリに読み込まず、重複チェックはDBのユニーク制約に任せる
+        # 重複して登録できなかった分は、次のバッチで生成し直す
+        while created < num_of_code:
+            size = min(batch_size, num_of_code - created)
+            # バッチ内の重複はここで除く
+            codes = set()
+            while len(codes) < size:
+                codes.add(''.join(random.choices(chars, k=length)))
 
-        while len(promo_list) < num_of_code:
-            new_code = ''.join(random.choices(chars, k=length))
+            promo_list = [
+                PromoCode(promo_code=code, discount_amount=random.randint(min_amount, max_amount))
+                for code in codes
+            ]
+            PromoCode.objects.bulk_create(promo_list, ignore_conflicts=True)
 
-            # すでに今回生成済みでないか、すでにDBに登録のあるコードでないかチェック
-            if new_code not in new_generated_codes and new_code not in existing_codes:
-                promo_list.append(PromoCode(
-                    promo_code=new_code,
-                    discount_amount=random.randint(100, 1000)
-                ))
-                new_generated_codes.add(new_code)
+            # ignore_conflicts では登録できた件数が返らないため、
+            # 作成日時が今回セットした値と一致するものを今回登録できたコードとして数える
+            created_at = {promo.promo_code: promo.created_at for promo in promo_list}
+            inserted = sum(
+                1 for code, db_created_at in
+                PromoCode.objects.filter(promo_code__in=codes).values_list('promo_code', 'created_at')
+                if created_at[code] == db_created_at
+            )
+            created += inserted
 
-        PromoCode.objects.bulk_create(promo_list)
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                f'{created}/{num_of_code}個 生成済み'
+                f'（重複による再生成: {size - inserted}個, {created / elapsed:,.0f}個/秒）'
+            )
 
-        self.stdout.write(self.style.SUCCESS(f'{num_of_code}個のプロモコードを生成しました'))
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'{num_of_code}個のプロモコードを生成しました（{elapsed:.1f}秒, {num_of_code / elapsed:,.0f}個/秒）'
+        ))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from products.models import Product
+from products.related import build_related_products
+
+
+class Command(BaseCommand):
+    help = "全商品の関連商品（商品詳細に表示するリスト）を計算し直すコマンド"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='一度に読み込む商品数')
+
+    def handle(self, *args, **options):
+        self.stdout.write("関連商品の再計算を開始します...")
+
+        count = 0
+        for product in Product.objects.only('id', 'category_id').iterator(chunk_size=options['chunk_size']):
+            build_related_products(product)
+            count += 1
+
+        self.stdout.write(self.style.SUCCESS(f'{count}個の商品の関連商品を計算し直しました'))
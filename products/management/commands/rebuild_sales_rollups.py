@@ -0,0 +1,43 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+from products.forms import DateRangeForm
+from products.models import Order
+from products.sales import rebuild_sales
+
+
+class Command(BaseCommand):
+    help = "日別の売上集計（売上ダッシュボードで使う）を注文から計算し直すコマンド"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='開始日（YYYY-MM-DD、この日を含む）。省略時は最初の注文の日')
+        parser.add_argument('--until', help='終了日（YYYY-MM-DD、この日を含む）。省略時は今日')
+        parser.add_argument('--days', type=int, default=31, help='1回のトランザクションで計算し直す日数')
+
+    def handle(self, *args, **options):
+        form = DateRangeForm({'date_from': options['since'], 'date_to': options['until']})
+        if not form.is_valid():
+            raise CommandError(form.errors.as_text())
+        if options['days'] < 1:
+            raise CommandError('--days には1以上を指定してください')
+
+        date_to = form.cleaned_data['date_to'] or timezone.localdate()
+        date_from = form.cleaned_data['date_from']
+        if date_from is None:
+            first_order = Order.objects.aggregate(first=Min('created_at'))['first']
+            if first_order is None:
+                self.stdout.write("注文がないため、計算し直す売上はありません")
+                return
+            date_from = timezone.localdate(first_order)
+
+        # 長い期間でもロックやトランザクションが大きくならないよう、days 日ずつ区切って作り直す
+        days = 0
+        start = date_from
+        while start <= date_to:
+            end = min(start + timedelta(days=options['days'] - 1), date_to)
+            days += rebuild_sales(start, end)
+            self.stdout.write(f'{start}〜{end} を計算し直しました')
+            start = end + timedelta(days=1)
+
+        self.stdout.write(self.style.SUCCESS(f'{date_from}〜{date_to} のうち、注文のあった{days}日分の売上を集計しました'))
@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from products.models import Product, StockMovement, StockSnapshot
+from products.stock import with_expected_stock
+
+
+class Command(BaseCommand):
+    help = (
+        "商品の在庫数が、最新のスナップショットとそれ以降の増減履歴から計算した在庫数と一致するか確認するコマンド。"
+        "--checkpoint を付けると、一致した商品の現在の在庫数を新しいスナップショットとして記録する（定期実行用）"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkpoint', action='store_true', help='一致した商品のスナップショットを記録する')
+        parser.add_argument('--fix', action='store_true', help='一致しない商品は、差を「照合による補正」として記録する')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='DBから一度に読み込む商品数')
+
+    def handle(self, *args, **options):
+        self.stdout.write("在庫数の照合を開始します...")
+
+        now = timezone.now()
+        checked = 0
+        mismatches = []
+        checkpoint_ids = []
+        # 在庫数と、履歴から計算した在庫数は1つのクエリで同時に読むので、照合中の購入で食い違うことはない
+        rows = (
+            with_expected_stock()
+            .order_by('pk')
+            .values_list('pk', 'sku', 'name', 'stock', 'expected_stock', 'snapshot_movement_id', 'last_movement_id')
+        )
+        for pk, sku, name, stock, expected, snapshot_movement_id, last_movement_id in rows.iterator(
+            chunk_size=options['chunk_size']
+        ):
+            checked += 1
+            if stock != expected:
+                mismatches.append((pk, stock - expected))
+                self.stdout.write(self.style.WARNING(
+                    f'{sku} {name}: 在庫数 {stock} / 履歴からの計算 {expected}（差 {stock - expected:+d}）'
+                ))
+            elif options['checkpoint'] and last_movement_id > snapshot_movement_id:
+                # 前回のスナップショット以降に増減があった商品だけ記録する
+                checkpoint_ids.append(pk)
+
+        snapshots = 0
+        for start in range(0, len(checkpoint_ids), options['chunk_size']):
+            snapshots += self.checkpoint(checkpoint_ids[start:start + options['chunk_size']], now)
+
+        if options['fix']:
+            StockMovement.objects.bulk_create([
+                StockMovement(product_id=pk, delta=delta, reason=StockMovement.REASON_CORRECTION, created_at=now)
+                for pk, delta in mismatches
+            ], batch_size=options['chunk_size'])
+
+        if snapshots:
+            self.stdout.write(f'{snapshots}個の商品のスナップショットを記録しました')
+        if mismatches and not options['fix']:
+            raise CommandError(f'{checked}個の商品のうち、{len(mismatches)}個の在庫数が履歴と一致しません')
+        if mismatches:
+            self.stdout.write(self.style.WARNING(f'{len(mismatches)}個の商品の差を補正として記録しました'))
+        self.stdout.write(self.style.SUCCESS(f'{checked}個の商品の在庫数を照合しました'))
+
+    def checkpoint(self, product_ids, now):
+        """
+        商品の行をロックしてから在庫数と増減を読み直し、一致した商品のスナップショットを記録する。記録した件数を返す。
+        照合のクエリの時点では、id の小さい増減がまだコミットされていない（大きい id が先にコミットされた）ことがあり、
+        見えている最大の id までを反映済みとして記録すると、あとからコミットされた増減が照合から漏れてしまう。
+        在庫数を変える処理は商品の行を更新（ロック）したまま増減を記録してコミットするので、
+        ロックを取れた時点で、その商品の増減はすべてコミット済みになっている。
+        """
+        with transaction.atomic():
+            # デッドロックを防ぐため、ロックは購入手続きと同じく商品IDの昇順で取得する
+            list(Product.objects.select_for_update().filter(pk__in=product_ids).order_by('pk').values_list('pk'))
+            # ロックを待つ前のクエリの結果は使わず、ロック後に読み直す
+            rows = (
+                with_expected_stock(Product.objects.filter(pk__in=product_ids))
+                .values_list('pk', 'stock', 'expected_stock', 'snapshot_movement_id', 'last_movement_id')
+            )
+            snapshots = [
+                StockSnapshot(product_id=pk, stock=stock, last_movement_id=last_movement_id, created_at=now)
+                for pk, stock, expected, snapshot_movement_id, last_movement_id in rows
+                if stock == expected and last_movement_id > snapshot_movement_id
+            ]
+            StockSnapshot.objects.bulk_create(snapshots)
+        return len(snapshots)
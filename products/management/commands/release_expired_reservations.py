@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+from products.reservations import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = "期限切れになったカートの在庫確保を削除するコマンド"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='1回の DELETE で削除する件数')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] <= 0:
+            raise CommandError('--batch-size は1以上を指定してください')
+
+        deleted = release_expired_reservations(options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(f'{deleted}件の期限切れの在庫確保を削除しました'))
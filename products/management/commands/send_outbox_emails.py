@@ -0,0 +1,32 @@
+import time
+from django.core.management.base import BaseCommand
+from products.outbox import send_pending_emails
+
+
+class Command(BaseCommand):
+    help = "アウトボックスに溜まった送信待ちのメールをまとめて送信するコマンド"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='1回のSMTP接続で送信する最大件数')
+        parser.add_argument('--max-attempts', type=int, default=None, help='送信失敗として諦めるまでの試行回数')
+        parser.add_argument('--loop', action='store_true', help='終了せずに送信待ちのメールを監視し続ける')
+        parser.add_argument('--interval', type=float, default=5, help='--loop 指定時、送信待ちが無い場合の待機秒数')
+
+    def handle(self, *args, **options):
+        total_sent = total_failed = 0
+
+        while True:
+            sent, failed = send_pending_emails(options['batch_size'], options['max_attempts'])
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                self.stdout.write(f'送信: {sent}件 / 失敗: {failed}件')
+
+            # 1バッチ分まるごと処理した場合は、まだ残っている可能性があるので続けて処理する
+            if sent + failed >= options['batch_size']:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(self.style.SUCCESS(f'{total_sent}件のメールを送信しました（失敗: {total_failed}件）'))
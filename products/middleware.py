@@ -0,0 +1,265 @@
+import json
+import logging
+import random
+import time
+from collections import Counter
+from contextlib import ExitStack
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from whitenoise.middleware import WhiteNoiseMiddleware
+from .routers import replica_aliases, use_primary, wrote_to_primary
+
+logger = logging.getLogger('products.timing')
+
+
+class QueryRecorder:
+    """
+    connection.execute_wrapper に渡して、リクエスト中に実行したSQLの件数と時間を記録する。
+    パラメーターを除いたSQLが同じ SELECT は、N+1 の可能性があるので重複として数える。
+    """
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            # BEGIN や SAVEPOINT 等のトランザクション制御は重複の対象外
+            if sql.lstrip()[:6].upper() == 'SELECT':
+                self.statements[sql] += 1
+
+    @property
+    def duplicates(self):
+        return sum(count - 1 for count in self.statements.values() if count > 1)
+
+    def most_duplicated(self, limit=3):
+        return [(sql, count) for sql, count in self.statements.most_common(limit) if count > 1]
+
+
+class RequestTimingMiddleware:
+    """
+    リクエストごとのSQLの件数・時間と、ビュー・テンプレートの処理時間を計測し、
+    Server-Timing ヘッダーと products.timing ロガーに出力する。
+
+    REQUEST_TIMING_SAMPLE_RATE（0〜1）の割合のリクエストだけを計測する。0 の場合はミドルウェア自体を読み込まない。
+    テンプレートの時間は TemplateResponse を返すビュー（クラスベースビュー）だけ分けて計測し、
+    render() を使う関数ビューではビューの時間に含まれる。
+    ASGI では非同期のまま動くので、ビューや他のミドルウェアがスレッドに切り替えられることはない。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = settings.REQUEST_TIMING_SAMPLE_RATE
+        if self.sample_rate <= 0:
+            raise MiddlewareNotUsed()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+            # フックも非同期にしないと、Django が呼び出しのたびにスレッドに切り替える
+            self.process_view = self._aprocess_view
+            self.process_template_response = self._aprocess_template_response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        recorder = QueryRecorder()
+        request._timing = {}
+        started = time.perf_counter()
+        with self._record_queries(recorder):
+            response = self.get_response(request)
+        return self._record(request, response, recorder, started)
+
+    async def __acall__(self, request):
+        if random.random() >= self.sample_rate:
+            return await self.get_response(request)
+
+        recorder = QueryRecorder()
+        request._timing = {}
+        started = time.perf_counter()
+        # DBの接続はスレッドごとなので、非同期ORMや同期ビューがSQLを実行するスレッド（リクエストごとに同じ）で記録を始める
+        stack = await sync_to_async(self._record_queries)(recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        return self._record(request, response, recorder, started)
+
+    @staticmethod
+    def _record_queries(recorder):
+        # レプリカ等のDBを追加した場合も含め、すべての接続のSQLを記録する
+        stack = ExitStack()
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(recorder))
+        return stack
+
+    def _record(self, request, response, recorder, started):
+        timing = request._timing
+        total = time.perf_counter() - started
+
+        view = timing.get('view_end', started + total) - timing.get('view_start', started)
+        template = timing['render_end'] - timing['view_end'] if 'render_end' in timing else None
+
+        metrics = [
+            f'db;dur={recorder.duration * 1000:.1f};desc="{recorder.count} queries"',
+            f'dup;desc="{recorder.duplicates} duplicate queries"',
+            f'view;dur={view * 1000:.1f}',
+        ]
+        if template is not None:
+            metrics.append(f'tpl;dur={template * 1000:.1f}')
+        metrics.append(f'total;dur={total * 1000:.1f}')
+        response['Server-Timing'] = ', '.join(metrics)
+
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'view': getattr(request.resolver_match, 'view_name', None),
+            'total_ms': round(total * 1000, 1),
+            'view_ms': round(view * 1000, 1),
+            'template_ms': round(template * 1000, 1) if template is not None else None,
+            'db_ms': round(recorder.duration * 1000, 1),
+            'queries': recorder.count,
+            'duplicate_queries': recorder.duplicates,
+            'most_duplicated': [
+                {'sql': sql[:200], 'count': count} for sql, count in recorder.most_duplicated()
+            ],
+        }, ensure_ascii=False))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, '_timing'):
+            request._timing['view_start'] = time.perf_counter()
+
+    def process_template_response(self, request, response):
+        # TemplateResponse はこのあとで描画されるので、ここまでをビューの時間、描画完了までをテンプレートの時間とする
+        if hasattr(request, '_timing'):
+            request._timing['view_end'] = time.perf_counter()
+            response.add_post_render_callback(lambda response: self._render_end(request))
+        return response
+
+    async def _aprocess_view(self, request, view_func, view_args, view_kwargs):
+        return RequestTimingMiddleware.process_view(self, request, view_func, view_args, view_kwargs)
+
+    async def _aprocess_template_response(self, request, response):
+        return RequestTimingMiddleware.process_template_response(self, request, response)
+
+    def _render_end(self, request):
+        request._timing['render_end'] = time.perf_counter()
+
+
+class ReplicaStickinessMiddleware:
+    """
+    書き込みをしたブラウザからの読み取りを、REPLICA_STICKY_SECONDS の間プライマリに固定する。
+    カートに追加した直後のページで、レプリカの反映遅れにより追加した商品が見えない、といったことを防ぐ。
+    レプリカを設定していない場合は読み込まれない。
+    """
+    cookie_name = 'use_primary'
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if not replica_aliases():
+            raise MiddlewareNotUsed()
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        sticky = use_primary.set(self.cookie_name in request.COOKIES)
+        wrote = wrote_to_primary.set(False)
+        try:
+            return self._stick(request, self.get_response(request))
+        finally:
+            wrote_to_primary.reset(wrote)
+            use_primary.reset(sticky)
+
+    async def __acall__(self, request):
+        # 同期のコード（sync_to_async）で変更したコンテキスト変数は呼び出し元に戻されるので、書き込みも検出できる
+        sticky = use_primary.set(self.cookie_name in request.COOKIES)
+        wrote = wrote_to_primary.set(False)
+        try:
+            return self._stick(request, await self.get_response(request))
+        finally:
+            wrote_to_primary.reset(wrote)
+            use_primary.reset(sticky)
+
+    def _stick(self, request, response):
+        # GET 以外のリクエストは、実際に書き込んだかどうかにかかわらず書き込みとみなす
+        if wrote_to_primary.get() or request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            response.set_cookie(
+                self.cookie_name, '1', max_age=settings.REPLICA_STICKY_SECONDS, httponly=True, samesite='Lax'
+            )
+        return response
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """
+    WSGI（runserver 等）では WhiteNoise で静的ファイルを返す。
+    ASGI では StaticFilesApplication がミドルウェアより前で返すので読み込まない。
+    WhiteNoiseMiddleware は同期専用で、チェーンに残すとすべてのリクエストがスレッドで処理されてしまう。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        if iscoroutinefunction(get_response):
+            raise MiddlewareNotUsed()
+        super().__init__(get_response, settings)
+
+
+class StaticFilesApplication:
+    """
+    ASGI アプリケーション（config/asgi.py）の前に置き、静的ファイルを Django のミドルウェアを通さずに返す。
+    返すファイル・ヘッダー（キャッシュ・圧縮・Range）は StaticFilesMiddleware と同じく WhiteNoise の設定に従う。
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, application):
+        self.application = application
+        self.whitenoise = WhiteNoiseMiddleware()
+
+    async def __call__(self, scope, receive, send):
+        static_file = None
+        if scope['type'] == 'http':
+            path = scope['path']
+            if self.whitenoise.autorefresh:
+                static_file = await sync_to_async(self.whitenoise.find_file, thread_sensitive=False)(path)
+            else:
+                static_file = self.whitenoise.files.get(path)
+        if static_file is None:
+            return await self.application(scope, receive, send)
+
+        # WhiteNoise は WSGI の environ の形式でリクエストヘッダーを読む
+        environ = {
+            'HTTP_' + name.decode('latin1').upper().replace('-', '_'): value.decode('latin1')
+            for name, value in scope['headers']
+        }
+        response = static_file.get_response(scope['method'], environ)
+        await send({
+            'type': 'http.response.start',
+            'status': int(response.status),
+            'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in response.headers],
+        })
+        if response.file is None:
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        read = sync_to_async(response.file.read, thread_sensitive=False)
+        try:
+            while chunk := await read(self.chunk_size):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            response.file.close()
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0009_outboxemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='image_detail',
+            field=models.ImageField(blank=True, editable=False, upload_to='products/variants/'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='image_thumbnail',
+            field=models.ImageField(blank=True, editable=False, upload_to='products/variants/'),
+        ),
+    ]
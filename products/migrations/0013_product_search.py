@@ -0,0 +1,103 @@
+from django.db import migrations
+
+# 検索用のカラム・インデックス・トリガー
+# 適用済みのマイグレーションの内容が変わらないよう、SQL は products.search から import せずにここに書いておく
+# （post_migrate で SQLite のトリガーを作り直す処理は products.search に同じ内容を持っている）
+
+POSTGRESQL_INSTALL = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'ALTER TABLE products_product ADD COLUMN search_vector tsvector',
+    # 商品名・SKU・説明が変わったときだけ tsvector を計算し直す
+    """
+    CREATE FUNCTION products_product_search_vector_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := setweight(to_tsvector('simple', coalesce(NEW.name, '')), 'A')
+            || setweight(to_tsvector('simple', coalesce(NEW.sku, '')), 'A')
+            || setweight(to_tsvector('simple', coalesce(NEW.description, '')), 'B');
+        RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER products_product_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF name, sku, description ON products_product
+    FOR EACH ROW EXECUTE FUNCTION products_product_search_vector_update()
+    """,
+    # 既存の商品はトリガーを発火させて計算する
+    'UPDATE products_product SET name = name',
+    'CREATE INDEX product_search_vector_idx ON products_product USING GIN (search_vector)',
+    'CREATE INDEX product_name_trgm_idx ON products_product USING GIN (name gin_trgm_ops)',
+]
+
+POSTGRESQL_UNINSTALL = [
+    'DROP INDEX IF EXISTS product_name_trgm_idx',
+    'DROP INDEX IF EXISTS product_search_vector_idx',
+    'DROP TRIGGER IF EXISTS products_product_search_vector_trigger ON products_product',
+    'DROP FUNCTION IF EXISTS products_product_search_vector_update()',
+    'ALTER TABLE products_product DROP COLUMN IF EXISTS search_vector',
+]
+
+# 商品テーブルの内容を参照する（本文を重複して持たない）FTS5 テーブル
+SQLITE_INSTALL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS products_product_fts USING fts5("
+    "name, description, sku, content='products_product', content_rowid='id', tokenize='trigram')",
+    """
+    CREATE TRIGGER IF NOT EXISTS products_product_fts_insert AFTER INSERT ON products_product BEGIN
+        INSERT INTO products_product_fts(rowid, name, description, sku)
+        VALUES (new.id, new.name, new.description, new.sku);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_product_fts_delete AFTER DELETE ON products_product BEGIN
+        INSERT INTO products_product_fts(products_product_fts, rowid, name, description, sku)
+        VALUES ('delete', old.id, old.name, old.description, old.sku);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_product_fts_update
+    AFTER UPDATE OF name, description, sku ON products_product BEGIN
+        INSERT INTO products_product_fts(products_product_fts, rowid, name, description, sku)
+        VALUES ('delete', old.id, old.name, old.description, old.sku);
+        INSERT INTO products_product_fts(rowid, name, description, sku)
+        VALUES (new.id, new.name, new.description, new.sku);
+    END
+    """,
+    # 既存の商品の索引を作る
+    "INSERT INTO products_product_fts(products_product_fts) VALUES ('rebuild')",
+]
+
+SQLITE_UNINSTALL = [
+    'DROP TRIGGER IF EXISTS products_product_fts_insert',
+    'DROP TRIGGER IF EXISTS products_product_fts_delete',
+    'DROP TRIGGER IF EXISTS products_product_fts_update',
+    'DROP TABLE IF EXISTS products_product_fts',
+]
+
+STATEMENTS = {
+    'postgresql': (POSTGRESQL_INSTALL, POSTGRESQL_UNINSTALL),
+    'sqlite': (SQLITE_INSTALL, SQLITE_UNINSTALL),
+}
+
+
+def install_search(apps, schema_editor):
+    # 検索の仕組みはDBごとに異なるため、DBの種類を見て作成する（その他のDBは部分一致で検索する）
+    install, uninstall = STATEMENTS.get(schema_editor.connection.vendor, ([], []))
+    for sql in install:
+        schema_editor.execute(sql)
+
+
+def uninstall_search(apps, schema_editor):
+    install, uninstall = STATEMENTS.get(schema_editor.connection.vendor, ([], []))
+    for sql in uninstall:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0012_stockreservation'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search, uninstall_search),
+    ]
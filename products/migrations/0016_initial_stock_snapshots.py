@@ -0,0 +1,31 @@
+from django.db import migrations
+
+
+def create_initial_snapshots(apps, schema_editor):
+    # 既存の商品は、現在の在庫数を最初のスナップショットにする（これ以降の増減を StockMovement に記録する）
+    Product = apps.get_model('products', 'Product')
+    StockSnapshot = apps.get_model('products', 'StockSnapshot')
+    db_alias = schema_editor.connection.alias
+    batch = []
+    for product_id, stock in Product.objects.using(db_alias).values_list('pk', 'stock').iterator(chunk_size=2000):
+        batch.append(StockSnapshot(product_id=product_id, stock=stock))
+        if len(batch) >= 2000:
+            StockSnapshot.objects.using(db_alias).bulk_create(batch)
+            batch = []
+    StockSnapshot.objects.using(db_alias).bulk_create(batch)
+
+
+def delete_snapshots(apps, schema_editor):
+    StockSnapshot = apps.get_model('products', 'StockSnapshot')
+    StockSnapshot.objects.using(schema_editor.connection.alias).all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0015_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_initial_snapshots, delete_snapshots),
+    ]
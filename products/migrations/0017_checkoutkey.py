@@ -0,0 +1,29 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0016_initial_stock_snapshots'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckoutKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('session_key', models.CharField(max_length=40)),
+                ('status', models.CharField(choices=[('processing', '処理中'), ('completed', '注文完了')], default='processing', max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='checkout_keys', to='products.order')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='checkout_key_created_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def delete_empty_markers(apps, schema_editor):
+    # 戻す前に、related が空の行（候補が無かった商品の印）を削除する。リストは次の表示時に計算し直される
+    RelatedProduct = apps.get_model('products', 'RelatedProduct')
+    RelatedProduct.objects.filter(related__isnull=True).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0017_checkoutkey'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='relatedproduct',
+            name='related',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='products.product'),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, delete_empty_markers),
+    ]
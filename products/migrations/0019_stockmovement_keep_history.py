@@ -0,0 +1,26 @@
+# Generated by Django 4.2.5 on 2026-10-18 06:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def delete_orphaned_movements(apps, schema_editor):
+    # 戻す前に、削除済みの商品の増減履歴を削除する（以前のスキーマでは商品と一緒に削除されていたもの）
+    StockMovement = apps.get_model('products', 'StockMovement')
+    StockMovement.objects.filter(product__isnull=True).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0018_relatedproduct_empty_marker'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stockmovement',
+            name='product',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_movements', to='products.product'),
+        ),
+        migrations.RunPython(migrations.RunPython.noop, delete_orphaned_movements),
+    ]
@@ -1,5 +1,8 @@
 from django.db import models
+from django.db.models import Case, Count, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
 from django.core.validators import MaxValueValidator, MinValueValidator
+from django.utils import timezone
 
 
 # categoryを使った機能は後ほど拡張予定
@@ -11,6 +14,30 @@ class Category(models.Model):
         return self.name
 
 
+class ProductQuerySet(models.QuerySet):
+    def with_available_stock(self, exclude_session_key=None):
+        """
+        販売可能数（available_stock = 在庫数 - 有効なカートの確保数）を付与する。
+        exclude_session_key を指定すると、そのセッションのカートが確保している分は差し引かない。
+        """
+        reservations = StockReservation.objects.filter(
+            product=OuterRef('pk'), expires_at__gt=timezone.now()
+        )
+        if exclude_session_key:
+            reservations = reservations.exclude(cart_item__cart__session_key=exclude_session_key)
+        reserved = Coalesce(
+            Subquery(
+                reservations.values('product').annotate(total=Sum('quantity')).values('total'),
+                output_field=models.IntegerField(),
+            ),
+            Value(0),
+        )
+        return self.annotate(
+            reserved_stock=reserved,
+            available_stock=ExpressionWrapper(F('stock') - reserved, output_field=models.IntegerField()),
+        )
+
+
 class Product(models.Model):
     name = models.CharField(max_length=50,)
     # categoryを使った機能は後ほど拡張予定
@@ -37,9 +64,22 @@ class Product(models.Model):
     )
     description = models.CharField(max_length=255, blank=True)
     image = models.ImageField(upload_to='products/', blank=True)
+    # image から自動生成する表示用の縮小画像（products/images.py）
+    image_thumbnail = models.ImageField(upload_to='products/variants/', blank=True, editable=False)
+    image_detail = models.ImageField(upload_to='products/variants/', blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # 商品一覧のキーセットページネーション用（新しい順）
+            models.Index(fields=['created_at', 'id'], name='product_created_at_id_idx'),
+            # カテゴリーで絞り込んだ場合のキーセットページネーション用
+            models.Index(fields=['category', 'created_at', 'id'], name='product_category_created_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -48,6 +88,29 @@ class Product(models.Model):
         return self.stock > 0  # type: ignore
 
 
+class RelatedProduct(models.Model):
+    """
+    商品詳細の「関連商品」を事前計算して保持するテーブル。
+    同じカテゴリーの商品を優先し、その中で一緒に購入された回数が多い順、新しい順に並べる。
+    """
+    product = models.ForeignKey(Product, related_name='related_entries', on_delete=models.CASCADE)
+    # 関連商品の候補が1つも無かった商品には、related が空の行を1行だけ保存する（表示のたびに計算し直さないため）
+    related = models.ForeignKey(Product, related_name='+', on_delete=models.CASCADE, null=True, blank=True)
+    rank = models.PositiveSmallIntegerField()
+    # 一緒に購入された注文数
+    co_purchase_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # 詳細画面では product + rank の順に1回のインデックス検索で取得する
+            models.UniqueConstraint(fields=['product', 'rank'], name='unique_related_product_rank'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.related_id} (#{self.rank})"
+
+
 class Cart(models.Model):
     session_key = models.CharField(max_length=40, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -55,7 +118,7 @@ class Cart(models.Model):
 
     @property
     def total_price(self):
-        return sum(item.subtotal for item in self.items.all())
+        return self.items.totals()['total_price']
 
     @property
     def is_empty(self):
@@ -65,6 +128,54 @@ class Cart(models.Model):
         return self.session_key
 
 
+class CartItemQuerySet(models.QuerySet):
+    # セール価格があり、セールを設定している場合はセール価格、違えば通常価格
+    unit_price = Case(
+        When(
+            Q(product__sale=True, product__sale_price__isnull=False),
+            then=F('product__sale_price'),
+        ),
+        default=F('product__price'),
+        output_field=models.DecimalField(max_digits=7, decimal_places=0),
+    )
+    line_total = ExpressionWrapper(
+        unit_price * F('quantity'),
+        output_field=models.DecimalField(max_digits=12, decimal_places=0),
+    )
+
+    def with_prices(self):
+        """
+        明細ごとの単価（unit_price）と小計（line_total）をDB側で計算して付与する。
+        """
+        return self.select_related('product').annotate(
+            unit_price=self.unit_price,
+            line_total=self.line_total,
+        )
+
+    def totals(self, discount=0):
+        """
+        カートの合計金額・明細数・合計数量・割引後の合計金額を1回の集計クエリで返す。
+        """
+        return self.aggregate(**self._totals(discount))
+
+    async def atotals(self, discount=0):
+        return await self.aaggregate(**self._totals(discount))
+
+    def _totals(self, discount):
+        total_price = Coalesce(Sum(self.line_total), Value(0), output_field=self.line_total.output_field)
+        return {
+            'total_price': total_price,
+            'item_count': Count('pk'),
+            'total_quantity': Coalesce(Sum('quantity'), Value(0)),
+            # 割引後の金額は0未満にならないようにする
+            'discounted_total': Greatest(
+                total_price - Value(discount),
+                Value(0),
+                output_field=self.line_total.output_field,
+            ),
+        }
+
+
 class CartItem(models.Model):
     cart = models.ForeignKey('Cart', related_name='items', on_delete=models.CASCADE)
     product = models.ForeignKey('Product', on_delete=models.CASCADE)
@@ -72,6 +183,8 @@ class CartItem(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = CartItemQuerySet.as_manager()
+
     @property
     def subtotal(self):
         # セール価格があり、セールを設定している場合はセール価格、違えば通常価格
@@ -94,6 +207,34 @@ class CartItem(models.Model):
         return f"{self.product.name} ({self.quantity}個) in Cart ({self.cart.session_key})"
 
 
+class StockReservation(models.Model):
+    """
+    カートに入れた商品の在庫の一時確保。expires_at を過ぎたものは無効になる。
+    販売可能数は「在庫数 - 有効な確保数の合計」で、(product, expires_at) のインデックスで集計する。
+    """
+    cart_item = models.OneToOneField(CartItem, related_name='reservation', on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, related_name='reservations', on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # 商品ごとの有効な確保数の集計用
+            models.Index(fields=['product', 'expires_at'], name='reservation_product_exp_idx'),
+            # 期限切れの確保を削除するコマンド用
+            models.Index(fields=['expires_at'], name='reservation_expires_idx'),
+        ]
+
+    @property
+    def is_active(self):
+        return self.expires_at > timezone.now()
+
+    def __str__(self):
+        return f"{self.product_id} x {self.quantity} (~{self.expires_at})"
+
+
 class Order(models.Model):
     last_name = models.CharField(max_length=20)
     first_name = models.CharField(max_length=20)
@@ -118,6 +259,12 @@ class Order(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # 注文の期間指定（エクスポート等）で使う
+            models.Index(fields=['created_at'], name='order_created_at_idx'),
+        ]
+
     @property
     def cc_last_four_number(self):
         # カード番号が~19桁まであるので末尾4桁だけ
@@ -167,9 +314,204 @@ class PromoCode(models.Model):
     def is_valid(self):
         return not self.is_used
 
+    @classmethod
+    def redeem(cls, promo_id):
+        """
+        未使用の場合だけ使用済みにする。条件付きのUPDATE 1回で行うので、
+        同じコードを同時に使おうとしても成功するのは1件だけ。使用できた場合は True を返す。
+        """
+        return cls.objects.filter(pk=promo_id, is_used=False).update(
+            is_used=True, used_at=timezone.now()
+        ) == 1
+
     def apply_discount(self, cart_total_price):
         # 合計金額に対して割引適用後額を返却（0以下にならないように）
         return max(cart_total_price - self.discount_amount, 0)
 
     def __str__(self):
         return f"{self.promo_code} (¥{self.discount_amount})"
+
+
+class OutboxEmail(models.Model):
+    """
+    送信待ちのメール（トランザクショナルアウトボックス）。
+    注文と同じトランザクションで書き込み、send_outbox_emails コマンドがまとめて送信する。
+    """
+    STATUS_PENDING = 'pending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, '送信待ち'),
+        (STATUS_SENT, '送信済み'),
+        (STATUS_FAILED, '送信失敗'),
+    ]
+
+    order = models.ForeignKey(Order, related_name='emails', on_delete=models.SET_NULL, null=True, blank=True)
+    subject = models.CharField(max_length=255)
+    body_text = models.TextField()
+    body_html = models.TextField(blank=True)
+    from_email = models.CharField(max_length=254)
+    to = models.EmailField(max_length=254)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    # 送信を試みた回数
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # この時刻を過ぎたら送信（再送）対象になる
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # 送信待ちのメールを古い順に取り出すため
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_status_next_attempt_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {self.to} ({self.status})"
+
+
+class SalesRollup(models.Model):
+    """
+    日別の売上集計テーブルの共通部分。
+    注文の確定時に sales.record_order_sales() で加算し、過去分は rebuild_sales_rollups コマンドで作り直す。
+    金額は購入時の単価 × 数量（割引前）で集計する。
+    """
+    date = models.DateField()
+    units = models.PositiveIntegerField(default=0)
+    gross_sales = models.PositiveBigIntegerField(default=0)
+    # その日にこの行の対象（商品・カテゴリー）を含んでいた注文の件数
+    order_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        abstract = True
+
+
+class DailySales(SalesRollup):
+    # 日ごとの売上全体。割引とプロモコードの利用は注文単位なのでここにだけ持つ
+    discount_total = models.PositiveBigIntegerField(default=0)
+    # 割引後の合計（Order.total_price の合計）
+    net_sales = models.PositiveBigIntegerField(default=0)
+    promo_order_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date'], name='unique_daily_sales_date'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} ¥{self.net_sales:,} ({self.order_count}件)"
+
+
+class DailyProductSales(SalesRollup):
+    product = models.ForeignKey(Product, related_name='daily_sales', on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            # 期間での絞り込みは date から始まるこのインデックスで行う
+            models.UniqueConstraint(fields=['date', 'product'], name='unique_daily_product_sales'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} product={self.product_id} x {self.units}"
+
+
+class DailyCategorySales(SalesRollup):
+    # 集計した時点で商品が属していたカテゴリー
+    category = models.ForeignKey(Category, related_name='daily_sales', on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'category'], name='unique_daily_category_sales'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} category={self.category_id} x {self.units}"
+
+
+class StockMovement(models.Model):
+    """
+    在庫数の増減の履歴（追記のみ）。Product.stock を変更する処理は、同じトランザクションで増減を記録する。
+    最新の StockSnapshot の在庫数に、それ以降の増減を足した値が Product.stock と一致する（reconcile_stock コマンドで確認する）。
+    """
+    REASON_ORDER = 'order'
+    REASON_ADJUSTMENT = 'adjustment'
+    REASON_IMPORT = 'import'
+    REASON_CORRECTION = 'correction'
+    REASON_CHOICES = [
+        (REASON_ORDER, '注文'),
+        (REASON_ADJUSTMENT, '管理画面での変更'),
+        (REASON_IMPORT, 'インポート'),
+        (REASON_CORRECTION, '照合による補正'),
+    ]
+
+    # 商品を削除しても履歴は残す（追記のみの記録なので、商品と一緒に消さない）
+    product = models.ForeignKey(
+        Product, related_name='stock_movements', on_delete=models.SET_NULL, null=True, blank=True
+    )
+    # 増えた場合は正、減った場合は負の数
+    delta = models.IntegerField()
+    reason = models.CharField(max_length=10, choices=REASON_CHOICES)
+    order = models.ForeignKey(Order, related_name='stock_movements', on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # 商品ごとに、スナップショット以降（id が大きいもの）の増減だけを読むため
+            models.Index(fields=['product', 'id'], name='stock_movement_product_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} {self.delta:+d} ({self.reason})"
+
+
+class StockSnapshot(models.Model):
+    """
+    ある時点の在庫数のチェックポイント。
+    last_movement_id までの増減を反映した在庫数を持つので、照合ではそれより後の増減だけを足せばよい。
+    """
+    product = models.ForeignKey(Product, related_name='stock_snapshots', on_delete=models.CASCADE)
+    stock = models.IntegerField()
+    # この在庫数に反映済みの最後の StockMovement の id（増減がまだない場合は 0）
+    last_movement_id = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            # 商品ごとの最新のスナップショットを1回のインデックス検索で取得するため
+            models.Index(fields=['product', '-id'], name='stock_snapshot_product_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} = {self.stock} (~#{self.last_movement_id})"
+
+
+class CheckoutKey(models.Model):
+    """
+    購入手続きの冪等キー（カート画面のフォームごとに発行する）。
+    同じキーでの二重送信・再送は、最初のリクエストの結果（処理中または注文完了）を返し、注文処理を繰り返さない。
+    """
+    STATUS_PROCESSING = 'processing'
+    STATUS_COMPLETED = 'completed'
+    STATUS_CHOICES = [
+        (STATUS_PROCESSING, '処理中'),
+        (STATUS_COMPLETED, '注文完了'),
+    ]
+
+    key = models.CharField(max_length=64, unique=True)
+    # キーを使ったセッション。他のセッションからは同じキーを使えない
+    session_key = models.CharField(max_length=40)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PROCESSING)
+    order = models.ForeignKey(Order, related_name='checkout_keys', on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # 古いキーを削除するコマンド（cleanup_carts）用
+            models.Index(fields=['created_at'], name='checkout_key_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.key} ({self.status})"
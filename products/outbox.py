@@ -0,0 +1,103 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+from .models import OutboxEmail
+
+
+def enqueue_order_success_mail(order, order_items):
+    """
+    注文完了メールをアウトボックスに書き込む。
+    checkout のトランザクションの中で呼び出すので、注文が確定した場合だけ送信される。
+    """
+    context = {
+        'order': order,
+        'order_items': order_items,
+    }
+    return OutboxEmail.objects.create(
+        order=order,
+        subject=f'【Daily Select】ご注文ありがとうございます（注文番号： #{order.id}）',
+        body_text=render_to_string('mail/order_success.txt', context),
+        body_html=render_to_string('mail/order_success.html', context),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=order.email,
+    )
+
+
+def claim_pending_emails(batch_size):
+    """
+    送信対象のメールを取り出し、他のワーカーが同時に拾わないように次回送信時刻を先に延ばしておく。
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        emails = list(
+            OutboxEmail.objects.select_for_update(skip_locked=True)
+            .filter(status=OutboxEmail.STATUS_PENDING, next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'pk')[:batch_size]
+        )
+        OutboxEmail.objects.filter(pk__in=[email.pk for email in emails]).update(
+            next_attempt_at=now + timedelta(seconds=settings.OUTBOX_LEASE_SECONDS)
+        )
+    return emails
+
+
+def send_pending_emails(batch_size=100, max_attempts=None):
+    """
+    送信待ちのメールを1回分（batch_size 件まで）送信し、(送信数, 失敗数) を返す。
+    SMTP の接続はバッチ全体で1本を使い回す。
+    """
+    if max_attempts is None:
+        max_attempts = settings.OUTBOX_MAX_ATTEMPTS
+
+    emails = claim_pending_emails(batch_size)
+    if not emails:
+        return 0, 0
+
+    sent = failed = 0
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        # SMTPサーバーに接続できない場合は、バッチ全体を再送待ちに戻す
+        for email in emails:
+            _record_failure(email, e, max_attempts)
+        failed = len(emails)
+    else:
+        try:
+            for email in emails:
+                message = EmailMultiAlternatives(
+                    email.subject, email.body_text, email.from_email, [email.to], connection=connection
+                )
+                if email.body_html:
+                    message.attach_alternative(email.body_html, 'text/html')
+                try:
+                    connection.send_messages([message])
+                except Exception as e:
+                    _record_failure(email, e, max_attempts)
+                    failed += 1
+                else:
+                    email.attempts += 1
+                    email.status = OutboxEmail.STATUS_SENT
+                    email.sent_at = timezone.now()
+                    email.last_error = ''
+                    sent += 1
+        finally:
+            connection.close()
+
+    OutboxEmail.objects.bulk_update(
+        emails, ['status', 'attempts', 'next_attempt_at', 'last_error', 'sent_at']
+    )
+    return sent, failed
+
+
+def _record_failure(email, error, max_attempts):
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= max_attempts:
+        email.status = OutboxEmail.STATUS_FAILED
+    else:
+        # 失敗するたびに待ち時間を倍にして再送する
+        delay = settings.OUTBOX_RETRY_BASE_SECONDS * 2 ** (email.attempts - 1)
+        email.next_attempt_at = timezone.now() + timedelta(seconds=delay)
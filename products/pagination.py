@@ -0,0 +1,151 @@
+import base64
+from datetime import datetime
+from django.db.models import Q
+from django.http import Http404
+
+
+class KeysetPage:
+    """
+    キーセット（シーク）方式のページ。
+    テンプレートからは Paginator の Page と同じ感覚で has_next / has_previous を使えるようにしている。
+    """
+    def __init__(self, object_list, next_query=None, previous_query=None):
+        self.object_list = object_list
+        self.next_query = next_query
+        self.previous_query = previous_query
+
+    def has_next(self):
+        return self.next_query is not None
+
+    def has_previous(self):
+        return self.previous_query is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(obj):
+    value = f'{obj.created_at.isoformat()}|{obj.pk}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except ValueError:
+        raise Http404('無効なページです')
+
+
+class KeysetPaginationMixin:
+    """
+    ListView 用のキーセットページネーション。
+    OFFSET を使わず (created_at, id) の複合インデックスを直接シークするので、
+    何ページ目を表示しても1ページ分の行しか読まない。
+    並び順は新しい順（created_at, id の降順）で固定。
+    ?after=<cursor> で次のページ、?before=<cursor> で前のページを表示する。
+    """
+    paginate_by = 20
+
+    def paginate_queryset(self, queryset, page_size):
+        queryset, backward = self._seek(queryset, page_size)
+        return self._build_page(list(queryset), page_size, backward)
+
+    async def apaginate_queryset(self, queryset, page_size):
+        # 非同期ビュー用。クエリの組み立てと結果の扱いは paginate_queryset と同じ
+        queryset, backward = self._seek(queryset, page_size)
+        return self._build_page([obj async for obj in queryset], page_size, backward)
+
+    def _seek(self, queryset, page_size):
+        # 1件多く取得して、前後のページがあるかどうかを判定する
+        before = self.request.GET.get('before')
+        if before:
+            created_at, pk = decode_cursor(before)
+            # 前のページは昇順で取得し、表示用に並べ直す
+            queryset = (
+                queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, pk__gt=pk))
+                .order_by('created_at', 'pk')
+            )
+            return queryset[:page_size + 1], True
+
+        queryset = queryset.order_by('-created_at', '-pk')
+        after = self.request.GET.get('after')
+        if after:
+            created_at, pk = decode_cursor(after)
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk))
+        return queryset[:page_size + 1], False
+
+    def _build_page(self, rows, page_size, backward):
+        if backward:
+            has_previous = len(rows) > page_size
+            object_list = rows[:page_size][::-1]
+            has_next = True
+        else:
+            has_next = len(rows) > page_size
+            object_list = rows[:page_size]
+            has_previous = bool(self.request.GET.get('after'))
+
+        page = KeysetPage(
+            object_list,
+            next_query=self._page_query('after', object_list[-1]) if has_next and object_list else None,
+            previous_query=self._page_query('before', object_list[0]) if has_previous and object_list else None,
+        )
+        return None, page, object_list, page.has_other_pages()
+
+    def _page_query(self, direction, obj):
+        # カテゴリー等の他の絞り込み条件はそのまま引き継ぐ
+        params = self.request.GET.copy()
+        params.pop('after', None)
+        params.pop('before', None)
+        params[direction] = encode_cursor(obj)
+        return params.urlencode()
+
+
+class OffsetPaginationMixin:
+    """
+    検索結果のように created_at 順ではない一覧用の、?page=<番号> によるページネーション。
+    件数（COUNT）は数えず、1件多く取得して次のページがあるかどうかだけを判定する。
+    OFFSET が大きくなるほど遅くなるため、max_pages より後のページは表示しない。
+    """
+    paginate_by = 20
+    max_pages = 50
+
+    def paginate_queryset(self, queryset, page_size):
+        offset = (self._page_number() - 1) * page_size
+        return self._build_page(list(queryset[offset:offset + page_size + 1]), page_size)
+
+    async def apaginate_queryset(self, queryset, page_size):
+        offset = (self._page_number() - 1) * page_size
+        return self._build_page([obj async for obj in queryset[offset:offset + page_size + 1]], page_size)
+
+    def _page_number(self):
+        try:
+            number = int(self.request.GET.get('page', 1))
+        except ValueError:
+            raise Http404('無効なページです')
+        if not 1 <= number <= self.max_pages:
+            raise Http404('無効なページです')
+        return number
+
+    def _build_page(self, rows, page_size):
+        number = self._page_number()
+        object_list = rows[:page_size]
+        has_next = len(rows) > page_size and number < self.max_pages
+        page = KeysetPage(
+            object_list,
+            next_query=self._page_query(number + 1) if has_next else None,
+            previous_query=self._page_query(number - 1) if number > 1 else None,
+        )
+        return None, page, object_list, page.has_other_pages()
+
+    def _page_query(self, number):
+        # 検索語等の他の条件はそのまま引き継ぐ
+        params = self.request.GET.copy()
+        params['page'] = number
+        return params.urlencode()
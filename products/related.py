@@ -0,0 +1,110 @@
+from django.db import transaction
+from django.db.models import Count
+from .models import Product, OrderItem, RelatedProduct
+from .routers import not_sticky
+
+# 商品詳細に表示する関連商品の件数
+RELATED_PRODUCTS_LIMIT = 4
+# 一緒に購入された商品の候補として見る件数
+CO_PURCHASE_CANDIDATES = 50
+
+
+def get_related_products(product):
+    """
+    事前計算済みの関連商品を返す。まだ計算されていない場合はその場で計算して保存する。
+    """
+    entries = list(_entries(product))
+    if entries:
+        return _related(entries)
+    # 表示のついでの保存なので、このブラウザの読み取りをプライマリに固定しない
+    with not_sticky():
+        return build_related_products(product, only_missing=True)
+
+
+def _entries(product):
+    return RelatedProduct.objects.filter(product=product).select_related('related').order_by('rank')
+
+
+def _related(entries):
+    # 候補が無かったことを表す行（related が空）は除く
+    return [entry.related for entry in entries if entry.related is not None]
+
+
+def build_related_products(product, only_missing=False):
+    """
+    1商品分の関連商品を計算し直して保存する。
+    並び順は「同じカテゴリー → 一緒に購入された回数 → 新しい順」。
+    保存は商品の行をロックして行うので、同じ商品のリストを同時に作っても (product, rank) が重複しない。
+    only_missing を指定すると、ロックを待つ間に他のリクエストが保存したリストがあればそれを返す（詳細画面から呼ぶ場合）。
+    """
+    # この商品と同じ注文で購入された商品と、その注文数
+    co_purchase = dict(
+        OrderItem.objects.filter(order__order_items__product=product)
+        .exclude(product=product)
+        .values('product')
+        .annotate(orders=Count('order', distinct=True))
+        .order_by('-orders')
+        .values_list('product', 'orders')[:CO_PURCHASE_CANDIDATES]
+    )
+    others = Product.objects.exclude(pk=product.pk).order_by('-created_at', '-pk')
+    same_category_ids = others.filter(category_id=product.category_id).values_list('pk', flat=True)
+    recent_ids = others.values_list('pk', flat=True)
+
+    candidate_ids = (
+        set(co_purchase)
+        | set(same_category_ids[:RELATED_PRODUCTS_LIMIT])
+        | set(recent_ids[:RELATED_PRODUCTS_LIMIT])
+    )
+    candidates = sorted(
+        Product.objects.filter(pk__in=candidate_ids),
+        key=lambda candidate: (
+            candidate.category_id != product.category_id,
+            -co_purchase.get(candidate.pk, 0),
+            -candidate.created_at.timestamp(),
+            -candidate.pk,
+        ),
+    )[:RELATED_PRODUCTS_LIMIT]
+
+    with transaction.atomic():
+        if not Product.objects.select_for_update().filter(pk=product.pk).exists():
+            # 計算中に削除された商品
+            return []
+        if only_missing:
+            entries = list(_entries(product))
+            if entries:
+                return _related(entries)
+        RelatedProduct.objects.filter(product=product).delete()
+        RelatedProduct.objects.bulk_create([
+            RelatedProduct(
+                product=product,
+                related=candidate,
+                rank=rank,
+                co_purchase_count=co_purchase.get(candidate.pk, 0),
+            )
+            for rank, candidate in enumerate(candidates)
+        ] or [RelatedProduct(product=product, related=None, rank=0)])
+    return candidates
+
+
+def invalidate_related_products(product_ids):
+    """
+    指定した商品の関連商品のリストを1回の DELETE で削除する（注文確定時など、一緒に購入された回数が変わったときに使う）。
+    削除されたリストは、次に詳細画面が表示されたとき（または rebuild_related_products コマンド）に計算し直される。
+    """
+    RelatedProduct.objects.filter(product_id__in=product_ids).delete()
+
+
+def invalidate_empty_lists():
+    """
+    候補が無かった商品のリスト（related が空の行）を削除する。商品が追加されて候補ができたときに使う。
+    """
+    RelatedProduct.objects.filter(related__isnull=True).delete()
+
+
+def invalidate_lists_containing(product):
+    """
+    指定した商品を関連商品として表示している商品のリストを削除する。
+    削除されたリストは、次に詳細画面が表示されたときに計算し直される。
+    """
+    product_ids = RelatedProduct.objects.filter(related=product).values('product_id')
+    RelatedProduct.objects.filter(product_id__in=product_ids).delete()
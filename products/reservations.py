@@ -0,0 +1,40 @@
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .models import StockReservation
+
+
+def reservation_expires_at():
+    return timezone.now() + timedelta(seconds=settings.CART_RESERVATION_SECONDS)
+
+
+def reserve_stock(cart_item):
+    """
+    カート明細の数量分の在庫を確保する（すでに確保していれば数量と期限を更新する）。
+    呼び出し側で、商品行をロックしたうえで販売可能数を確認しておくこと。
+    """
+    StockReservation.objects.update_or_create(
+        cart_item=cart_item,
+        defaults={
+            'product_id': cart_item.product_id,
+            'quantity': cart_item.quantity,
+            'expires_at': reservation_expires_at(),
+        },
+    )
+
+
+def release_expired_reservations(batch_size=1000):
+    """
+    期限切れの確保を batch_size 件ずつ削除し、削除した件数を返す。
+    期限切れの確保はもともと販売可能数の計算から外れているので、削除しなくても在庫は正しく計算される。
+    """
+    deleted = 0
+    while True:
+        pks = list(
+            StockReservation.objects.filter(expires_at__lte=timezone.now())
+            .order_by('expires_at')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        if not pks:
+            return deleted
+        deleted += StockReservation.objects.filter(pk__in=pks).delete()[0]
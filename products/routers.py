@@ -0,0 +1,77 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# レプリカに振り分けてよいモデル（商品の閲覧と管理画面の一覧・エクスポート・売上集計で読むもの）
+# カート・在庫確保・プロモコード・セッション等は、書き込んだ直後に読むのでプライマリから読む
+REPLICA_MODELS = {
+    'products.category',
+    'products.product',
+    'products.relatedproduct',
+    'products.order',
+    'products.orderitem',
+    'products.dailysales',
+    'products.dailyproductsales',
+    'products.dailycategorysales',
+}
+
+# 直前のリクエストで書き込みがあり、プライマリから読むべきかどうか（ReplicaStickinessMiddleware が設定する）
+use_primary = ContextVar('use_primary', default=False)
+# このリクエスト（コマンドの場合はプロセス）で書き込みをしたかどうか
+wrote_to_primary = ContextVar('wrote_to_primary', default=False)
+
+
+@contextmanager
+def not_sticky():
+    """
+    ブロック内の書き込みを、以降の読み取りをプライマリに固定する書き込みとして扱わない。
+    表示のついでに保存する計算結果（関連商品のリスト等）のように、ブラウザに見せる内容が変わらない書き込みに使う。
+    """
+    token = wrote_to_primary.set(wrote_to_primary.get())
+    try:
+        yield
+    finally:
+        wrote_to_primary.reset(token)
+
+
+def replica_aliases():
+    # TEST の MIRROR に default を指定しているDBをレプリカとして扱う
+    return [
+        alias for alias, database in settings.DATABASES.items()
+        if database.get('TEST', {}).get('MIRROR') == DEFAULT_DB_ALIAS
+    ]
+
+
+class ReplicaRouter:
+    """
+    商品・注文の読み取りをレプリカ（DATABASE_REPLICA_URLS）に振り分け、書き込みはすべてプライマリに送る。
+    次の場合は、レプリカの反映遅れで古いデータを読まないようプライマリから読む。
+      - トランザクションの中（select_for_update や、読んだ値を使った更新）
+      - 書き込みをしたリクエストの残りの処理と、その後しばらくの同じブラウザからのリクエスト
+        （ReplicaStickinessMiddleware）
+    """
+    def __init__(self):
+        self.replicas = replica_aliases()
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas or model._meta.label_lower not in REPLICA_MODELS:
+            return DEFAULT_DB_ALIAS
+        if use_primary.get() or wrote_to_primary.get() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(self.replicas)
+
+    def db_for_write(self, model, **hints):
+        # 以降の読み取りは、いま書き込んだ内容が見えるプライマリから行う
+        # （セッションの保存は商品・注文の表示に関係しないので対象外）
+        if model._meta.app_label != 'sessions':
+            wrote_to_primary.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # レプリカはプライマリと同じデータなので、どのDBから読んだオブジェクト同士でも関連付けてよい
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,125 @@
+from collections import defaultdict
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Case, Count, F, Q, Sum, When
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+from .dates import start_of_day
+from .models import DailyCategorySales, DailyProductSales, DailySales, Order, OrderItem
+
+# 日別の売上集計テーブル（DailySales / DailyProductSales / DailyCategorySales）の更新処理
+# 管理画面の売上ダッシュボードはこの集計テーブルだけを読み、注文・注文明細は読まない。
+# 日付は日本時間（TIME_ZONE）の日付で集計する。
+
+
+def record_order_sales(order, order_items):
+    """
+    確定した注文1件分を集計テーブルに加算する。
+    checkout の transaction.on_commit から呼び出すので、注文がロールバックされた場合は加算されない。
+    商品・カテゴリーの行数に関係なく、テーブルごとに INSERT（無ければ0の行を作る）と UPDATE の2クエリで済む。
+    """
+    day = timezone.localdate(order.created_at)
+    products = defaultdict(lambda: [0, 0])
+    categories = defaultdict(lambda: [0, 0])
+    for item in order_items:
+        subtotal = item.price_at_purchase * item.quantity
+        for totals in (products[item.product_id], categories[item.product.category_id]):
+            totals[0] += item.quantity
+            totals[1] += subtotal
+
+    with transaction.atomic():
+        DailySales.objects.bulk_create([DailySales(date=day)], ignore_conflicts=True)
+        DailySales.objects.filter(date=day).update(
+            units=F('units') + sum(units for units, gross in products.values()),
+            gross_sales=F('gross_sales') + sum(gross for units, gross in products.values()),
+            order_count=F('order_count') + 1,
+            discount_total=F('discount_total') + order.discount_amount,
+            net_sales=F('net_sales') + order.total_price,
+            promo_order_count=F('promo_order_count') + (1 if order.discount_amount else 0),
+            updated_at=timezone.now(),
+        )
+        _increment(DailyProductSales, 'product_id', day, products)
+        _increment(DailyCategorySales, 'category_id', day, categories)
+
+
+def _increment(model, key, day, totals):
+    # まだ行が無い組み合わせは0で作成してから、F() 式で1回のUPDATEにまとめて加算する
+    model.objects.bulk_create(
+        [model(date=day, **{key: pk}) for pk in totals], ignore_conflicts=True
+    )
+    model.objects.filter(date=day, **{f'{key}__in': list(totals)}).update(
+        units=Case(
+            *[When(**{key: pk}, then=F('units') + units) for pk, (units, gross) in totals.items()],
+            default=F('units'),
+            output_field=model._meta.get_field('units'),
+        ),
+        gross_sales=Case(
+            *[When(**{key: pk}, then=F('gross_sales') + gross) for pk, (units, gross) in totals.items()],
+            default=F('gross_sales'),
+            output_field=model._meta.get_field('gross_sales'),
+        ),
+        order_count=F('order_count') + 1,
+        updated_at=timezone.now(),
+    )
+
+
+def rebuild_sales(date_from, date_to):
+    """
+    date_from〜date_to（両端を含む）の集計を注文・注文明細から計算し直す。
+    集計の取りこぼし（on_commit の処理に失敗した等）や、過去の注文の取り込みに使う。
+    期間内の集計行を削除してから作り直すので、同じ期間で何度実行しても結果は同じになる。
+    作成した DailySales の行数を返す。
+    """
+    start, end = start_of_day(date_from), start_of_day(date_to + timedelta(days=1))
+    orders = Order.objects.filter(created_at__gte=start, created_at__lt=end)
+    items = OrderItem.objects.filter(order__created_at__gte=start, order__created_at__lt=end)
+
+    daily_orders = (
+        orders.annotate(day=TruncDate('created_at')).values('day')
+        .annotate(
+            order_count=Count('pk'),
+            discount_total=Sum('discount_amount'),
+            net_sales=Sum('total_price'),
+            promo_order_count=Count('pk', filter=Q(discount_amount__gt=0)),
+        )
+    )
+    item_totals = {
+        'units': Sum('quantity'),
+        'gross_sales': Sum(F('price_at_purchase') * F('quantity')),
+        'order_count': Count('order_id', distinct=True),
+    }
+    daily_items = {
+        row.pop('day'): row
+        for row in items.annotate(day=TruncDate('order__created_at')).values('day').annotate(**item_totals)
+    }
+    product_rows = (
+        items.annotate(day=TruncDate('order__created_at')).values('day', 'product_id').annotate(**item_totals)
+    )
+    # 再集計の場合も、カテゴリーは現在の商品のカテゴリーで集計する
+    category_rows = (
+        items.annotate(day=TruncDate('order__created_at'))
+        .values('day', category_id=F('product__category_id')).annotate(**item_totals)
+    )
+
+    with transaction.atomic():
+        for model in (DailySales, DailyProductSales, DailyCategorySales):
+            model.objects.filter(date__range=(date_from, date_to)).delete()
+        created = DailySales.objects.bulk_create([
+            DailySales(
+                date=row['day'],
+                order_count=row['order_count'],
+                discount_total=row['discount_total'],
+                net_sales=row['net_sales'],
+                promo_order_count=row['promo_order_count'],
+                units=daily_items.get(row['day'], {}).get('units') or 0,
+                gross_sales=daily_items.get(row['day'], {}).get('gross_sales') or 0,
+            )
+            for row in daily_orders
+        ])
+        DailyProductSales.objects.bulk_create(
+            [DailyProductSales(date=row.pop('day'), **row) for row in product_rows], batch_size=1000
+        )
+        DailyCategorySales.objects.bulk_create(
+            [DailyCategorySales(date=row.pop('day'), **row) for row in category_rows], batch_size=1000
+        )
+    return len(created)
@@ -0,0 +1,135 @@
+from django.db import connections
+from django.db.models import BooleanField, Case, FloatField, Q, Value, When
+from django.db.models.expressions import RawSQL
+from .models import Product
+
+# 検索用のインデックス・トリガーはマイグレーション（0013_product_search）で作成する
+# PostgreSQL: products_product.search_vector（tsvector）と GIN インデックス、商品名のトライグラムインデックス
+# SQLite: FTS5 の仮想テーブル（trigram トークナイザー）
+SEARCH_VECTOR_COLUMN = 'search_vector'
+FTS_TABLE = 'products_product_fts'
+# SQLite の trigram トークナイザーは3文字未満の語を検索できないため、それより短い語は部分一致で探す
+FTS_MIN_TERM_LENGTH = 3
+# SQLite で関連度順に取得する件数の上限（検索結果のページ数の上限 × 1ページの件数以上にしておく）
+SQLITE_MAX_RESULTS = 1000
+
+
+def search_products(query, queryset=None):
+    """
+    商品名・説明・SKU で商品を検索し、関連度（rank）の高い順に並べた QuerySet を返す。
+    DBが PostgreSQL なら全文検索とトライグラム類似度（typo や部分一致）、SQLite なら FTS5 を使う。
+    SQLite の場合はこの関数の中でDBにアクセスするので、非同期ビューからは sync_to_async で呼び出すこと。
+    """
+    queryset = Product.objects.all() if queryset is None else queryset
+    query = ' '.join(query.split())
+    if not query:
+        return queryset.none()
+
+    vendor = connections[queryset.db].vendor
+    if vendor == 'postgresql':
+        return _search_postgresql(queryset, query)
+    if vendor == 'sqlite' and all(len(term) >= FTS_MIN_TERM_LENGTH for term in query.split()):
+        return _search_sqlite(queryset, query)
+    return _search_like(queryset, query)
+
+
+def _search_postgresql(queryset, query):
+    table = Product._meta.db_table
+    # 全文検索（語の一致）と、商品名のトライグラム類似度（typo や語の一部）のどちらかに当てはまるものを探す
+    # どちらの条件も GIN インデックスで絞り込める
+    matches = RawSQL(
+        f"({table}.{SEARCH_VECTOR_COLUMN} @@ websearch_to_tsquery('simple', %s) OR %s <%% {table}.name)",
+        (query, query),
+        output_field=BooleanField(),
+    )
+    rank = RawSQL(
+        f"ts_rank({table}.{SEARCH_VECTOR_COLUMN}, websearch_to_tsquery('simple', %s))"
+        f" + word_similarity(%s, {table}.name)",
+        (query, query),
+        output_field=FloatField(),
+    )
+    return queryset.filter(matches).annotate(rank=rank).order_by('-rank', '-created_at', '-pk')
+
+
+def _search_sqlite(queryset, query):
+    # 入力をそのまま MATCH に渡すと FTS5 の構文として解釈されるため、語ごとにフレーズとして囲む
+    match = ' '.join('"{}"'.format(term.replace('"', '""')) for term in query.split())
+    # FTS5 の rank（bm25）は MATCH と同じクエリでしか使えないため、先に関連度順のIDを取得しておく
+    # rank は小さいほど関連度が高いので、符号を反転して PostgreSQL と向きを揃える
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute(
+            f'SELECT rowid, -rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s ORDER BY rank LIMIT %s',
+            [match, SQLITE_MAX_RESULTS],
+        )
+        ranks = cursor.fetchall()
+    if not ranks:
+        return queryset.none()
+    rank = Case(*[When(pk=pk, then=Value(score)) for pk, score in ranks], output_field=FloatField())
+    return (
+        queryset.filter(pk__in=[pk for pk, score in ranks])
+        .annotate(rank=rank)
+        .order_by('-rank', '-created_at', '-pk')
+    )
+
+
+def _search_like(queryset, query):
+    # インデックスを使えない部分一致。短い語の検索とその他のDB用
+    for term in query.split():
+        queryset = queryset.filter(
+            Q(name__icontains=term) | Q(description__icontains=term) | Q(sku__iexact=term)
+        )
+    return queryset.annotate(rank=Value(0.0, output_field=FloatField())).order_by('-created_at', '-pk')
+
+
+# 以下は post_migrate から使う、SQLite の検索用のテーブル・トリガーの作成処理
+# マイグレーション（0013_product_search）は同じ内容を自分で持っているので、ここを変えても適用済みのマイグレーションは変わらない
+
+# 商品テーブルの内容を参照する（本文を重複して持たない）FTS5 テーブル
+SQLITE_FTS_TABLE = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    "name, description, sku, content='products_product', content_rowid='id', tokenize='trigram')"
+)
+
+SQLITE_FTS_TRIGGERS = {
+    'products_product_fts_insert': f"""
+        CREATE TRIGGER IF NOT EXISTS products_product_fts_insert AFTER INSERT ON products_product BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, name, description, sku)
+            VALUES (new.id, new.name, new.description, new.sku);
+        END
+    """,
+    'products_product_fts_delete': f"""
+        CREATE TRIGGER IF NOT EXISTS products_product_fts_delete AFTER DELETE ON products_product BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, description, sku)
+            VALUES ('delete', old.id, old.name, old.description, old.sku);
+        END
+    """,
+    'products_product_fts_update': f"""
+        CREATE TRIGGER IF NOT EXISTS products_product_fts_update
+        AFTER UPDATE OF name, description, sku ON products_product BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, description, sku)
+            VALUES ('delete', old.id, old.name, old.description, old.sku);
+            INSERT INTO {FTS_TABLE}(rowid, name, description, sku)
+            VALUES (new.id, new.name, new.description, new.sku);
+        END
+    """,
+}
+
+
+def install_sqlite_search(connection):
+    """
+    SQLite の FTS5 テーブルとトリガーを作成する（作成済みなら何もしない）。
+    SQLite ではマイグレーションで商品テーブルを作り直すとトリガーが消えるため、
+    post_migrate から呼び出し、トリガーを作り直した場合は索引も作り直す。
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(SQLITE_FTS_TABLE)
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'products_product'"
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        missing = [name for name in SQLITE_FTS_TRIGGERS if name not in existing]
+        for name in missing:
+            cursor.execute(SQLITE_FTS_TRIGGERS[name])
+        if missing:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
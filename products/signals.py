@@ -0,0 +1,33 @@
+from django.db import connections, transaction
+from django.db.models.signals import post_migrate, post_save, pre_delete
+from django.dispatch import receiver
+from .models import Product
+from .related import build_related_products, invalidate_empty_lists, invalidate_lists_containing
+from .search import FTS_TABLE, install_sqlite_search
+
+
+@receiver(post_save, sender=Product)
+def update_related_products(sender, instance, created, **kwargs):
+    # カテゴリー等が変わった可能性があるので、この商品を含む他商品のリストは作り直させる
+    if not created:
+        invalidate_lists_containing(instance)
+    else:
+        # 他の商品が無く、関連商品が空だった商品のリストも作り直させる
+        invalidate_empty_lists()
+    transaction.on_commit(lambda: build_related_products(instance))
+
+
+@receiver(pre_delete, sender=Product)
+def discard_related_products(sender, instance, **kwargs):
+    # 削除される商品を含むリストは件数が減ってしまうので、作り直させる
+    invalidate_lists_containing(instance)
+
+
+@receiver(post_migrate)
+def repair_sqlite_search(sender, using, **kwargs):
+    # SQLite ではマイグレーションで商品テーブルを作り直すと FTS5 のトリガーが消えるので、作り直す
+    connection = connections[using]
+    if sender.name != 'products' or connection.vendor != 'sqlite':
+        return
+    if FTS_TABLE in connection.introspection.table_names():
+        install_sqlite_search(connection)
@@ -0,0 +1,38 @@
+from django.db.models import F, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from .models import Product, StockMovement, StockSnapshot
+
+# 在庫の増減履歴（StockMovement）とスナップショット（StockSnapshot）の処理
+# Product.stock を変更したら、同じトランザクションの中で増減を記録すること。
+
+
+def record_adjustment(product, delta, reason=StockMovement.REASON_ADJUSTMENT):
+    """
+    商品1件の在庫の増減を記録する。増減がない場合は何もしない。
+    """
+    if delta:
+        StockMovement.objects.create(product=product, delta=delta, reason=reason)
+
+
+def with_expected_stock(queryset=None):
+    """
+    商品ごとに、最新のスナップショットとそれ以降の増減から計算した在庫数（expected_stock）と、
+    反映した最後の増減の id（last_movement_id）を付けた QuerySet を返す。
+    どちらも (product, id) のインデックスで、スナップショット以降の増減だけを読むサブクエリで計算する。
+    """
+    queryset = Product.objects.all() if queryset is None else queryset
+    latest = StockSnapshot.objects.filter(product=OuterRef('pk')).order_by('-id')
+    movements = StockMovement.objects.filter(product=OuterRef('pk'), id__gt=OuterRef('snapshot_movement_id'))
+    delta = movements.values('product').annotate(total=Sum('delta')).values('total')
+    last_movement = movements.order_by('-id').values('id')[:1]
+    return (
+        queryset
+        .annotate(
+            snapshot_stock=Coalesce(Subquery(latest.values('stock')[:1]), Value(0)),
+            snapshot_movement_id=Coalesce(Subquery(latest.values('last_movement_id')[:1]), Value(0)),
+        )
+        .annotate(
+            expected_stock=F('snapshot_stock') + Coalesce(Subquery(delta, output_field=IntegerField()), Value(0)),
+            last_movement_id=Coalesce(Subquery(last_movement), F('snapshot_movement_id')),
+        )
+    )
@@ -1,3 +1,915 @@
-from django.test import TestCase
+import csv
+import tempfile
+import warnings
+from io import BytesIO, StringIO
+from pathlib import Path
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.messages import get_messages
+from django.core import mail
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from .cart_session import get_cart_count
+from .checkout import OutOfStockError, place_order
+from .forms import ProductForm
+from .management.commands.reconcile_stock import Command as ReconcileStockCommand
+from .middleware import ReplicaStickinessMiddleware
+from .models import (Cart, CartItem, Category, CheckoutKey, DailyCategorySales, DailyProductSales, DailySales, Order,
+                     OutboxEmail, Product, RelatedProduct, StockMovement, StockReservation, StockSnapshot)
+from .outbox import send_pending_emails
+from .reservations import reserve_stock
+from .sales import rebuild_sales
+from .stock import record_adjustment
+from .related import build_related_products, get_related_products
+from .routers import not_sticky, wrote_to_primary
 
-# Create your tests here.
+
+# ページを描画するテスト用。collectstatic のマニフェストが無くても静的ファイルのURLを作れるようにする
+plain_static_storage = override_settings(STORAGES={
+    **settings.STORAGES,
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+})
+
+
+class CountingEmailBackend(LocmemEmailBackend):
+    """接続を開いた回数を数える locmem バックエンド"""
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return True
+
+
+class BrokenEmailBackend(LocmemEmailBackend):
+    """宛先に broken が含まれるメールだけ送信に失敗するバックエンド"""
+    def send_messages(self, messages):
+        if any('broken' in address for message in messages for address in message.to):
+            raise OSError('送信に失敗しました')
+        return super().send_messages(messages)
+
+
+class UnreachableEmailBackend(LocmemEmailBackend):
+    """SMTPサーバーに接続できないバックエンド"""
+    def open(self):
+        raise OSError('接続できません')
+
+
+def create_product(category, number, stock=10, **kwargs):
+    return Product.objects.create(
+        name=f'商品{number}', category=category, price=1000, sku=f'SKU-{number}', stock=stock, **kwargs
+    )
+
+
+class ReplicaRouterTests(TransactionTestCase):
+    """
+    SQLite のDBを2つ（プライマリと、TEST の MIRROR に default を指定したレプリカ）設定した状態での振り分けを確認する。
+    テスト時のレプリカはプライマリと同じDBなので、どちらから読んだかは QuerySet.db（ルーターの判定）で確認する。
+    TestCase はテスト全体をトランザクションで囲み、すべての読み取りがプライマリに振り分けられるため使わない。
+    """
+    replica_databases = {
+        **settings.DATABASES,
+        'replica1': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': settings.BASE_DIR / 'replica1.sqlite3',
+            'TEST': {'MIRROR': 'default'},
+        },
+    }
+
+    def setUp(self):
+        # ルーターとミドルウェアは作成時にレプリカの一覧を読むので、DATABASE_ROUTERS も設定し直して作り直させる
+        replica_settings = override_settings(
+            DATABASES=self.replica_databases, DATABASE_ROUTERS=settings.DATABASE_ROUTERS
+        )
+        with warnings.catch_warnings():
+            # DATABASES の上書きに対する警告（接続は作り直されない）。ここではルーターの判定にだけ使う
+            warnings.simplefilter('ignore')
+            replica_settings.enable()
+        self.addCleanup(replica_settings.disable)
+
+        self.category = Category.objects.create(name='雑貨', slug='zakka')
+        self.product = create_product(self.category, 1)
+        # テストデータの作成も書き込みとして記録されるので、リクエストの開始時と同じ状態に戻す
+        token = wrote_to_primary.set(False)
+        self.addCleanup(wrote_to_primary.reset, token)
+
+    def read_database(self, request):
+        """
+        ReplicaStickinessMiddleware を通したリクエストの中で、商品を読むDBを返す。
+        """
+        databases = []
+
+        def get_response(request):
+            databases.append(Product.objects.all().db)
+            return HttpResponse()
+
+        ReplicaStickinessMiddleware(get_response)(request)
+        return databases[0]
+
+    def test_catalog_reads_go_to_replica(self):
+        self.assertEqual(Product.objects.all().db, 'replica1')
+        self.assertEqual(Category.objects.all().db, 'replica1')
+        # カートは書き込んだ直後に読むので、常にプライマリから読む
+        self.assertEqual(Cart.objects.all().db, 'default')
+
+    def test_reads_in_transaction_go_to_primary(self):
+        with transaction.atomic():
+            self.assertEqual(Product.objects.all().db, 'default')
+        self.assertEqual(Product.objects.all().db, 'replica1')
+
+        # select_for_update は書き込み用の QuerySet になるので、以降の読み取りもプライマリになる
+        with transaction.atomic():
+            self.assertEqual(Product.objects.select_for_update().db, 'default')
+        self.assertEqual(Product.objects.all().db, 'default')
+
+    def test_reads_after_write_go_to_primary(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=5)
+        self.assertEqual(Product.objects.all().db, 'default')
+
+    def test_not_sticky_writes_keep_reading_from_replica(self):
+        with not_sticky():
+            Product.objects.filter(pk=self.product.pk).update(stock=5)
+        self.assertEqual(Product.objects.all().db, 'replica1')
+
+    def test_write_request_sticks_browser_to_primary(self):
+        response = self.client.post(f'/cart/add/{self.product.pk}/', {'quantity': 1})
+        self.assertEqual(response.status_code, 302)
+        cookie = response.cookies[ReplicaStickinessMiddleware.cookie_name]
+        self.assertEqual(cookie['max-age'], settings.REPLICA_STICKY_SECONDS)
+        self.assertEqual(wrote_to_primary.get(), False)
+
+        factory = RequestFactory()
+        self.assertEqual(self.read_database(factory.get('/product/list/')), 'replica1')
+        sticky_request = factory.get('/product/list/')
+        sticky_request.COOKIES[cookie.key] = cookie.value
+        self.assertEqual(self.read_database(sticky_request), 'default')
+
+    async def test_async_middleware_detects_writes_in_threads(self):
+        async def read_only(request):
+            return HttpResponse()
+
+        async def write(request):
+            # 同期のビューやORMは sync_to_async でスレッドから実行される
+            await sync_to_async(Product.objects.filter(pk=self.product.pk).update)(stock=5)
+            return HttpResponse()
+
+        factory = AsyncRequestFactory()
+        response = await ReplicaStickinessMiddleware(read_only)(factory.get('/product/list/'))
+        self.assertNotIn(ReplicaStickinessMiddleware.cookie_name, response.cookies)
+        response = await ReplicaStickinessMiddleware(write)(factory.get('/product/list/'))
+        self.assertIn(ReplicaStickinessMiddleware.cookie_name, response.cookies)
+
+    def test_middleware_not_used_without_replicas(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with override_settings(DATABASES={'default': settings.DATABASES['default']}):
+                with self.assertRaises(MiddlewareNotUsed):
+                    ReplicaStickinessMiddleware(lambda request: HttpResponse())
+
+
+class PlaceOrderTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='雑貨', slug='zakka')
+        self.cart = Cart.objects.create(session_key='a' * 32)
+
+    def add_item(self, product, quantity, held=False):
+        item = CartItem.objects.create(cart=self.cart, product=product, quantity=quantity)
+        if held:
+            reserve_stock(item)
+        return item
+
+    def place_order(self):
+        order = Order(
+            last_name='山田', first_name='太郎', email='taro@example.com', tel='09012345678', zip_code='1000001',
+            address='東京都千代田区', cc_name='TARO YAMADA', cc_number='4111111111111111', cc_expiration='12/34',
+            cc_cvv2='123', total_price=0,
+        )
+        with transaction.atomic():
+            return place_order(self.cart, order)
+
+    def assert_stock(self, product, stock):
+        product.refresh_from_db()
+        self.assertEqual(product.stock, stock)
+
+    def test_decrements_stock_and_creates_order_items(self):
+        first = create_product(self.category, 1, stock=5)
+        second = create_product(self.category, 2, stock=3, sale=True, sale_price=800)
+        self.add_item(first, 2)
+        self.add_item(second, 3, held=True)
+
+        order_items = self.place_order()
+
+        self.assertEqual([(item.product, item.quantity, item.price_at_purchase) for item in order_items],
+                         [(first, 2, 1000), (second, 3, 800)])
+        self.assert_stock(first, 3)
+        self.assert_stock(second, 0)
+        self.assertFalse(self.cart.items.exists())
+        self.assertEqual(StockMovement.objects.filter(reason=StockMovement.REASON_ORDER).count(), 2)
+
+    def test_reports_every_short_line(self):
+        short = create_product(self.category, 1, stock=1)
+        enough = create_product(self.category, 2, stock=5)
+        sold_out = create_product(self.category, 3, stock=0)
+        self.add_item(short, 2)
+        self.add_item(enough, 1)
+        self.add_item(sold_out, 3)
+
+        with self.assertRaises(OutOfStockError) as raised:
+            self.place_order()
+
+        self.assertEqual(raised.exception.shortages, [(short, 2, 1), (sold_out, 3, 0)])
+        self.assertEqual(Order.objects.count(), 0)
+        self.assert_stock(short, 1)
+        self.assert_stock(enough, 5)
+
+    def test_unheld_line_excludes_other_carts_reservations(self):
+        product = create_product(self.category, 1, stock=3)
+        other_cart = Cart.objects.create(session_key='b' * 32)
+        reserve_stock(CartItem.objects.create(cart=other_cart, product=product, quantity=2))
+        item = self.add_item(product, 2, held=True)
+        # 確保の期限が切れた明細は行ロックして、他のカートの確保を除いた販売可能数（1個）で確認する
+        StockReservation.objects.filter(cart_item=item).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        with self.assertRaises(OutOfStockError) as raised:
+            self.place_order()
+
+        self.assertEqual(raised.exception.shortages, [(product, 2, 1)])
+        self.assert_stock(product, 3)
+
+    def test_held_line_skips_availability_check(self):
+        product = create_product(self.category, 1, stock=3)
+        self.add_item(product, 2, held=True)
+        # 確保した後に他のカートが確保した分は、確保済みの明細の購入を妨げない
+        other_cart = Cart.objects.create(session_key='b' * 32)
+        reserve_stock(CartItem.objects.create(cart=other_cart, product=product, quantity=2))
+
+        self.place_order()
+
+        self.assert_stock(product, 1)
+
+    def test_stock_never_goes_negative(self):
+        enough = create_product(self.category, 1, stock=5)
+        product = create_product(self.category, 2, stock=3)
+        self.add_item(enough, 1)
+        self.add_item(product, 2, held=True)
+        # 確保した後に管理画面で在庫数が減らされた場合など、在庫の確認後に在庫が数量を下回ったとき
+        Product.objects.filter(pk=product.pk).update(stock=1)
+
+        with self.assertRaises(OutOfStockError) as raised:
+            self.place_order()
+
+        self.assertEqual(raised.exception.shortages, [(product, 2, 1)])
+        self.assertEqual(Order.objects.count(), 0)
+        self.assert_stock(product, 1)
+        self.assert_stock(enough, 5)
+
+    def test_query_count_does_not_depend_on_line_count(self):
+        def count_queries(lines, held):
+            Cart.objects.filter(pk=self.cart.pk).delete()
+            self.cart = Cart.objects.create(session_key='a' * 32)
+            for number in range(lines):
+                self.add_item(create_product(self.category, f'{lines}{held:d}-{number}'), 1, held=held)
+            with CaptureQueriesContext(connection) as queries:
+                self.place_order()
+            return len(queries)
+
+        for held in (False, True):
+            with self.subTest(held=held):
+                self.assertEqual(count_queries(1, held), count_queries(10, held))
+
+
+@plain_static_storage
+class CheckoutIdempotencyTests(TestCase):
+    order_data = {
+        'last_name': '山田', 'first_name': '太郎', 'email': 'taro@example.com', 'tel': '09012345678',
+        'zip_code': '1000001', 'address': '東京都千代田区', 'cc_name': 'TARO YAMADA',
+        'cc_number': '4111111111111111', 'cc_expiration': '12/34', 'cc_cvv2': '123',
+    }
+
+    def setUp(self):
+        category = Category.objects.create(name='雑貨', slug='zakka')
+        self.product = create_product(category, 1, stock=5)
+        self.add_to_cart(self.client)
+
+    def add_to_cart(self, client):
+        client.post(f'/cart/add/{self.product.pk}/', {'quantity': 1})
+        return client.session.session_key
+
+    def checkout(self, client=None, key='checkout-key', **data):
+        return (client or self.client).post('/cart/checkout/', {**self.order_data, 'idempotency_key': key, **data})
+
+    def last_message(self, response):
+        # リダイレクト先を表示しないので、カートに追加したときのメッセージも残っている
+        return [str(message) for message in get_messages(response.wsgi_request)][-1]
+
+    def assert_stock(self, stock):
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, stock)
+
+    def test_duplicate_returns_first_result(self):
+        first = self.checkout()
+        self.assertRedirects(first, '/product/list/', fetch_redirect_response=False)
+        order = Order.objects.get()
+
+        # カートを入れ直しても、同じキーの送信は注文にならない
+        self.add_to_cart(self.client)
+        second = self.checkout()
+
+        self.assertRedirects(second, '/product/list/', fetch_redirect_response=False)
+        self.assertEqual(self.last_message(second), '購入ありがとうございます')
+        self.assertEqual(list(Order.objects.all()), [order])
+        self.assert_stock(4)
+        self.assertEqual(CheckoutKey.objects.get(key='checkout-key').order, order)
+        # 入れ直した商品はカートに残っているので、ヘッダーの商品数も残す
+        self.assertEqual(get_cart_count(second.wsgi_request), 1)
+
+    def test_key_from_another_session_is_rejected(self):
+        self.checkout()
+        other = Client()
+        self.add_to_cart(other)
+
+        response = self.checkout(client=other)
+
+        self.assertRedirects(response, '/cart/list/', fetch_redirect_response=False)
+        self.assertEqual(self.last_message(response), '無効な操作です')
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertTrue(Cart.objects.get(session_key=other.session.session_key).items.exists())
+
+    def test_invalid_form_releases_key(self):
+        response = self.checkout(cc_number='')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['checkout_key'], 'checkout-key')
+        self.assertFalse(CheckoutKey.objects.exists())
+
+        # 入力を直して同じキーのまま送信し直せる
+        self.checkout()
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(CheckoutKey.objects.get().status, CheckoutKey.STATUS_COMPLETED)
+
+    def test_processing_key_is_not_ordered_twice(self):
+        CheckoutKey.objects.create(key='checkout-key', session_key=self.client.session.session_key)
+
+        response = self.checkout()
+
+        self.assertEqual(self.last_message(response), 'ご注文を処理しています。しばらくお待ちください')
+        self.assertEqual(Order.objects.count(), 0)
+        self.assert_stock(5)
+
+    def test_stale_key_is_taken_over(self):
+        checkout_key = CheckoutKey.objects.create(key='checkout-key', session_key=self.client.session.session_key)
+        # 処理中のまま期限を過ぎたキー（処理の途中でプロセスが落ちた等）
+        CheckoutKey.objects.filter(pk=checkout_key.pk).update(
+            updated_at=timezone.now() - timedelta(seconds=settings.CHECKOUT_KEY_TIMEOUT_SECONDS + 1)
+        )
+
+        response = self.checkout()
+
+        self.assertEqual(self.last_message(response), '購入ありがとうございます')
+        checkout_key.refresh_from_db()
+        self.assertEqual(checkout_key.status, CheckoutKey.STATUS_COMPLETED)
+        self.assertEqual(checkout_key.order, Order.objects.get())
+        self.assert_stock(4)
+
+
+@plain_static_storage
+class ProductListConditionalGetTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='雑貨', slug='zakka')
+        # 1ページ（20件）と次のページの有無の判定に使う1件より古い商品が4件ある
+        self.products = [create_product(self.category, number) for number in range(25)]
+        # 最初のレスポンスで CSRF の Cookie が設定されて ETag が変わるので、先に1回表示しておく
+        self.client.get('/product/list/')
+
+    def get(self, url='/product/list/?category=zakka', **headers):
+        return self.client.get(url, headers=headers)
+
+    def test_not_modified_reads_only_the_page(self):
+        etag = self.get()['ETag']
+        create_product(Category.objects.create(name='食器', slug='dish'), 100)
+        self.products[0].save()
+
+        # カテゴリーの取得と、ページに並ぶ行だけのシーク
+        with self.assertNumQueries(2):
+            response = self.get(if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_changes_on_the_page_are_modified(self):
+        etag = self.get()['ETag']
+        product = self.products[-1]
+        product.name = '新しい名前'
+        product.save()
+        response = self.get(if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        # 商品カードのフラグメントキャッシュも、キーの updated_at が変わるので作り直される
+        self.assertContains(response, '新しい名前')
+
+        etag = self.get()['ETag']
+        create_product(self.category, 100)
+        self.assertEqual(self.get(if_none_match=etag).status_code, 200)
+
+    def test_category_rename_is_modified(self):
+        etag = self.get()['ETag']
+        self.category.name = '生活雑貨'
+        self.category.save()
+
+        response = self.get(if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '生活雑貨')
+
+    def test_unknown_category_is_not_found(self):
+        self.assertEqual(self.get('/product/list/?category=unknown').status_code, 404)
+
+
+class RelatedProductsTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='雑貨', slug='zakka')
+        self.product = create_product(self.category, 1)
+
+    def test_product_without_candidates_is_not_rebuilt(self):
+        self.assertEqual(get_related_products(self.product), [])
+        self.assertTrue(RelatedProduct.objects.filter(product=self.product, related__isnull=True).exists())
+
+        # 空のリストも保存済みとして扱い、表示のたびに計算し直さない
+        with self.assertNumQueries(1):
+            self.assertEqual(get_related_products(self.product), [])
+
+    def test_new_product_replaces_empty_list(self):
+        get_related_products(self.product)
+        other = create_product(self.category, 2)
+
+        self.assertEqual(get_related_products(self.product), [other])
+        self.assertFalse(RelatedProduct.objects.filter(related__isnull=True).exists())
+
+    def test_build_keeps_list_saved_while_waiting_for_lock(self):
+        other = create_product(self.category, 2)
+        build_related_products(self.product)
+        saved = list(RelatedProduct.objects.filter(product=self.product).values_list('pk', 'related'))
+
+        # 詳細画面からの計算は、ロックを取った時点でリストがあれば保存し直さない
+        self.assertEqual(build_related_products(self.product, only_missing=True), [other])
+        self.assertEqual(list(RelatedProduct.objects.filter(product=self.product).values_list('pk', 'related')), saved)
+
+        # 商品の変更時等の計算し直しは、リストを置き換える
+        build_related_products(self.product)
+        self.assertNotEqual(
+            list(RelatedProduct.objects.filter(product=self.product).values_list('pk', 'related')), saved
+        )
+
+
+class ReconcileStockTests(TestCase):
+    def setUp(self):
+        self.product = create_product(Category.objects.create(name='雑貨', slug='zakka'), 1, stock=10)
+        record_adjustment(self.product, 10)
+
+    def reconcile(self, *args):
+        call_command('reconcile_stock', *args, stdout=StringIO())
+
+    def test_checkpoint_records_matching_products(self):
+        self.reconcile('--checkpoint')
+        snapshot = StockSnapshot.objects.get(product=self.product)
+        self.assertEqual(snapshot.stock, 10)
+        self.assertEqual(snapshot.last_movement_id, StockMovement.objects.get().pk)
+
+        # 増減がなければ次のスナップショットは記録しない
+        self.reconcile('--checkpoint')
+        self.assertEqual(StockSnapshot.objects.count(), 1)
+
+    def test_checkpoint_rereads_after_locking(self):
+        # 照合のクエリの後、ロックを取るまでの間に在庫数と増減が変わった場合
+        Product.objects.filter(pk=self.product.pk).update(stock=7)
+        movement = StockMovement.objects.create(product=self.product, delta=-3, reason=StockMovement.REASON_ORDER)
+        self.assertEqual(ReconcileStockCommand().checkpoint([self.product.pk], timezone.now()), 1)
+        self.assertEqual(
+            StockSnapshot.objects.values_list('stock', 'last_movement_id').get(), (7, movement.pk)
+        )
+
+        # 読み直した時点で一致しない商品は記録しない
+        Product.objects.filter(pk=self.product.pk).update(stock=6)
+        self.assertEqual(ReconcileStockCommand().checkpoint([self.product.pk], timezone.now()), 0)
+
+    def test_mismatch_fails_unless_fixed(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=8)
+        with self.assertRaises(CommandError):
+            self.reconcile('--checkpoint')
+        self.assertFalse(StockSnapshot.objects.exists())
+
+        self.reconcile('--fix')
+        self.assertEqual(StockMovement.objects.get(reason=StockMovement.REASON_CORRECTION).delta, -2)
+        self.reconcile()
+
+    def test_movements_outlive_deleted_product(self):
+        self.product.delete()
+        self.assertEqual(list(StockMovement.objects.values_list('product', 'delta')), [(None, 10)])
+
+
+class OutboxTests(TestCase):
+    order_data = CheckoutIdempotencyTests.order_data
+
+    def setUp(self):
+        category = Category.objects.create(name='雑貨', slug='zakka')
+        self.product = create_product(category, 1, stock=5)
+
+    def checkout(self, quantity=1):
+        self.client.post(f'/cart/add/{self.product.pk}/', {'quantity': quantity})
+        return self.client.post('/cart/checkout/', self.order_data)
+
+    def create_email(self, to='taro@example.com', **kwargs):
+        return OutboxEmail.objects.create(
+            subject='件名', body_text='本文', body_html='<p>本文</p>', from_email='shop@example.com', to=to, **kwargs
+        )
+
+    def make_due(self):
+        OutboxEmail.objects.update(next_attempt_at=timezone.now())
+
+    def test_checkout_enqueues_mail_without_sending(self):
+        self.checkout()
+
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.order, Order.objects.get())
+        self.assertEqual(email.to, 'taro@example.com')
+        self.assertEqual(email.status, OutboxEmail.STATUS_PENDING)
+        self.assertIn(f'#{email.order.pk}', email.subject)
+        # 送信はワーカーに任せるので、リクエストの中では送らない
+        self.assertEqual(mail.outbox, [])
+
+    def test_failed_checkout_enqueues_nothing(self):
+        # 在庫不足で注文がロールバックされた場合は、メールも書き込まれない
+        Product.objects.filter(pk=self.product.pk).update(stock=0)
+        self.checkout()
+
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OutboxEmail.objects.exists())
+
+    @override_settings(EMAIL_BACKEND='products.tests.CountingEmailBackend')
+    def test_batch_is_sent_on_one_connection(self):
+        CountingEmailBackend.opened = 0
+        for number in range(3):
+            self.create_email(to=f'user{number}@example.com')
+        # まだ送信時刻になっていないメールは対象外
+        self.create_email(next_attempt_at=timezone.now() + timedelta(minutes=1))
+
+        self.assertEqual(send_pending_emails(batch_size=10), (3, 0))
+
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['user0@example.com', 'user1@example.com', 'user2@example.com'])
+        self.assertEqual(mail.outbox[0].alternatives, [('<p>本文</p>', 'text/html')])
+        self.assertEqual(OutboxEmail.objects.filter(status=OutboxEmail.STATUS_SENT, attempts=1).count(), 3)
+        self.assertEqual(send_pending_emails(batch_size=10), (0, 0))
+
+    @override_settings(EMAIL_BACKEND='products.tests.BrokenEmailBackend',
+                       OUTBOX_RETRY_BASE_SECONDS=60, OUTBOX_MAX_ATTEMPTS=3)
+    def test_failure_backs_off_until_failed(self):
+        sent = self.create_email()
+        broken = self.create_email(to='broken@example.com')
+
+        # 1通の失敗は同じバッチの他のメールを止めない
+        before = timezone.now()
+        self.assertEqual(send_pending_emails(), (1, 1))
+        sent.refresh_from_db()
+        broken.refresh_from_db()
+        self.assertEqual(sent.status, OutboxEmail.STATUS_SENT)
+        self.assertEqual((broken.status, broken.attempts, broken.last_error),
+                         (OutboxEmail.STATUS_PENDING, 1, '送信に失敗しました'))
+        self.assertGreaterEqual(broken.next_attempt_at, before + timedelta(seconds=60))
+
+        # 再送時刻までは送信しない
+        self.assertEqual(send_pending_emails(), (0, 0))
+
+        # 失敗するたびに待ち時間が倍になる
+        self.make_due()
+        before = timezone.now()
+        self.assertEqual(send_pending_emails(), (0, 1))
+        broken.refresh_from_db()
+        self.assertEqual(broken.attempts, 2)
+        self.assertGreaterEqual(broken.next_attempt_at, before + timedelta(seconds=120))
+        self.assertLess(broken.next_attempt_at, before + timedelta(seconds=240))
+
+        # 上限回数に達したら送信失敗にして、以降は送信しない
+        self.make_due()
+        self.assertEqual(send_pending_emails(), (0, 1))
+        broken.refresh_from_db()
+        self.assertEqual((broken.status, broken.attempts), (OutboxEmail.STATUS_FAILED, 3))
+        self.make_due()
+        self.assertEqual(send_pending_emails(), (0, 0))
+        self.assertEqual([message.to for message in mail.outbox], [['taro@example.com']])
+
+    @override_settings(EMAIL_BACKEND='products.tests.UnreachableEmailBackend')
+    def test_connection_failure_retries_whole_batch(self):
+        self.create_email()
+        self.create_email(to='hanako@example.com')
+
+        self.assertEqual(send_pending_emails(), (0, 2))
+
+        self.assertEqual(
+            list(OutboxEmail.objects.values_list('status', 'attempts', 'last_error').distinct()),
+            [(OutboxEmail.STATUS_PENDING, 1, '接続できません')],
+        )
+        self.assertEqual(mail.outbox, [])
+
+
+class UpdateCartTests(TestCase):
+    def setUp(self):
+        category = Category.objects.create(name='雑貨', slug='zakka')
+        self.first = create_product(category, 1, stock=5)
+        self.second = create_product(category, 2, stock=3)
+        self.third = create_product(category, 3, stock=2)
+
+    def update(self, *operations):
+        return self.client.post(
+            '/cart/update/', {'operations': [
+                {'product_id': product.pk, 'quantity': quantity, 'mode': mode}
+                for product, quantity, mode in operations
+            ]}, content_type='application/json',
+        ).json()
+
+    def cart_quantities(self):
+        return dict(CartItem.objects.values_list('product__sku', 'quantity'))
+
+    def test_add_set_and_delete(self):
+        self.update((self.first, 2, 'add'), (self.second, 1, 'set'))
+        result = self.update((self.first, 1, 'add'), (self.second, 3, 'set'), (self.third, 1, 'add'))
+        self.assertEqual([(line['ok'], line['quantity']) for line in result['results']], [(True, 3), (True, 3), (True, 1)])
+        self.assertEqual(self.cart_quantities(), {'SKU-1': 3, 'SKU-2': 3, 'SKU-3': 1})
+        self.assertEqual(result['cart_count'], 3)
+
+        # set の 0 はカートから削除し、確保も一緒に消える
+        result = self.update((self.second, 0, 'set'))
+        self.assertEqual(result['results'], [{'product_id': self.second.pk, 'ok': True, 'quantity': 0, 'error': None}])
+        self.assertEqual(self.cart_quantities(), {'SKU-1': 3, 'SKU-3': 1})
+        self.assertFalse(StockReservation.objects.filter(product=self.second).exists())
+        self.assertEqual(result['cart_count'], 2)
+
+    def test_same_product_twice_applies_in_order(self):
+        result = self.update((self.first, 2, 'add'), (self.first, 1, 'add'), (self.first, 4, 'add'))
+
+        # 3件目は1・2件目を反映した数量（3個）に足すと在庫（5個）を超える
+        self.assertEqual([(line['ok'], line['quantity']) for line in result['results']],
+                         [(True, 2), (True, 3), (False, 3)])
+        self.assertEqual(self.cart_quantities(), {'SKU-1': 3})
+        self.assertEqual(StockReservation.objects.get().quantity, 3)
+
+    def test_line_over_stock_fails_while_others_apply(self):
+        result = self.update((self.first, 1, 'set'), (self.second, 4, 'set'), (self.third, 2, 'set'))
+
+        self.assertEqual([line['ok'] for line in result['results']], [True, False, True])
+        self.assertEqual(result['results'][1]['error'], '商品2 の在庫数（3個）を超えています')
+        self.assertEqual(self.cart_quantities(), {'SKU-1': 1, 'SKU-3': 2})
+
+    def test_session_is_created_only_when_item_is_inserted(self):
+        # 在庫超過や存在しない明細の削除だけでは、セッションもカートも作らない
+        result = self.update((self.first, 6, 'add'), (self.second, 0, 'set'))
+        self.assertEqual([line['ok'] for line in result['results']], [False, True])
+        self.assertEqual(result['cart_count'], 0)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+        self.assertFalse(Cart.objects.exists())
+
+        self.update((self.first, 1, 'add'))
+        self.assertIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+        self.assertEqual(Cart.objects.get().session_key, self.client.session.session_key)
+
+    def test_reservations_are_refreshed_in_place(self):
+        self.update((self.first, 2, 'set'), (self.second, 1, 'set'))
+        reservations = dict(StockReservation.objects.values_list('product', 'pk'))
+        StockReservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        # 数量が変わらない明細も、確保の期限だけ延ばす
+        self.update((self.first, 3, 'set'), (self.second, 1, 'set'))
+
+        self.assertEqual(dict(StockReservation.objects.values_list('product', 'pk')), reservations)
+        self.assertEqual(
+            dict(StockReservation.objects.filter(expires_at__gt=timezone.now()).values_list('product', 'quantity')),
+            {self.first.pk: 3, self.second.pk: 1},
+        )
+
+    def test_query_count_does_not_depend_on_lines(self):
+        self.update((self.first, 1, 'set'), (self.second, 1, 'set'), (self.third, 1, 'set'))
+
+        def count_queries(*operations):
+            with CaptureQueriesContext(connection) as queries:
+                self.update(*operations)
+            return len(queries)
+
+        one_line = count_queries((self.first, 2, 'set'))
+        three_lines = count_queries((self.first, 3, 'set'), (self.second, 2, 'set'), (self.third, 2, 'set'))
+        self.assertEqual(three_lines, one_line)
+        self.assertEqual(self.cart_quantities(), {'SKU-1': 3, 'SKU-2': 2, 'SKU-3': 2})
+
+
+class ImportProductsTests(TestCase):
+    header = 'sku,name,category,price,sale,sale_price,stock,description\n'
+
+    def setUp(self):
+        self.category = Category.objects.create(name='雑貨', slug='zakka')
+        self.existing = create_product(self.category, 1, stock=10)
+        record_adjustment(self.existing, 10)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+
+    def import_csv(self, rows, *args):
+        path = self.directory / 'products.csv'
+        path.write_text(self.header + rows, encoding='utf-8')
+        call_command('import_products', str(path), *args, stdout=StringIO())
+
+    def test_updates_existing_sku_and_creates_new_one(self):
+        self.import_csv(
+            'SKU-1,商品1（改）,zakka,1200,,,7,説明\n'
+            'SKU-9,新商品,zakka,500,true,400,3,\n'
+        )
+
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.name, self.existing.price, self.existing.stock), ('商品1（改）', 1200, 7))
+        created = Product.objects.get(sku='SKU-9')
+        self.assertEqual((created.name, created.category, created.sale, created.sale_price, created.stock),
+                         ('新商品', self.category, True, 400, 3))
+        self.assertEqual(Product.objects.count(), 2)
+
+    def test_records_stock_changes_as_import_movements(self):
+        self.import_csv(
+            'SKU-1,商品1,zakka,1000,,,7,\n'
+            'SKU-2,商品2,zakka,1000,,,4,\n'
+            'SKU-3,商品3,zakka,1000,,,0,\n'
+        )
+
+        self.assertEqual(
+            sorted(StockMovement.objects.filter(reason=StockMovement.REASON_IMPORT).values_list('product__sku', 'delta')),
+            [('SKU-1', -3), ('SKU-2', 4)],
+        )
+        # 在庫数が変わらなければ増減は記録しない
+        self.import_csv('SKU-1,商品1,zakka,1000,,,7,\n')
+        self.assertEqual(StockMovement.objects.filter(reason=StockMovement.REASON_IMPORT).count(), 2)
+
+    def test_invalid_rows_are_written_to_error_csv(self):
+        errors = self.directory / 'errors.csv'
+        self.import_csv(
+            'SKU-2,商品2,zakka,1000,,,4,\n'
+            'SKU-3,商品3,unknown,1000,,,4,\n'
+            'SKU-4,商品4,zakka,abc,,,4,\n'
+            'SKU-5,商品5,zakka,1000,true,,4,\n',
+            '--errors', str(errors),
+        )
+
+        self.assertEqual(sorted(Product.objects.values_list('sku', flat=True)), ['SKU-1', 'SKU-2'])
+        with errors.open(encoding='utf-8-sig', newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], ['line', 'sku', 'errors'])
+        self.assertEqual([row[:2] for row in rows[1:]], [['3', 'SKU-3'], ['4', 'SKU-4'], ['5', 'SKU-5']])
+        self.assertIn('カテゴリー「unknown」が存在しません', rows[1][2])
+        self.assertTrue(rows[2][2].startswith('price:'))
+        self.assertTrue(rows[3][2].startswith('sale_price:'))
+
+    def test_dry_run_writes_nothing(self):
+        self.import_csv(
+            'SKU-1,商品1（改）,zakka,1200,,,7,\n'
+            'SKU-9,新商品,zakka,500,,,3,\n',
+            '--dry-run',
+        )
+
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.name, self.existing.stock), ('商品1', 10))
+        self.assertFalse(Product.objects.filter(sku='SKU-9').exists())
+        self.assertEqual(StockMovement.objects.count(), 1)
+
+
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        zakka = Category.objects.create(name='雑貨', slug='zakka')
+        food = Category.objects.create(name='食品', slug='food')
+        self.products = [
+            create_product(zakka, 1), create_product(zakka, 2, sale=True, sale_price=700), create_product(food, 3),
+        ]
+
+    def place_order(self, lines, discount=0):
+        cart = Cart.objects.create(session_key=f'{Cart.objects.count():032d}')
+        for product, quantity in lines:
+            CartItem.objects.create(cart=cart, product=product, quantity=quantity)
+        order = Order(
+            last_name='山田', first_name='太郎', email='taro@example.com', tel='09012345678', zip_code='1000001',
+            address='東京都千代田区', cc_name='TARO YAMADA', cc_number='4111111111111111', cc_expiration='12/34',
+            cc_cvv2='123', total_price=0, discount_amount=discount,
+        )
+        # 注文の確定後（on_commit）に集計テーブルへ加算される
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                order_items = place_order(cart, order)
+                order.total_price = sum(item.price_at_purchase * item.quantity for item in order_items) - discount
+                order.save(update_fields=['total_price'])
+
+    def rollups(self):
+        fields = ['date', 'units', 'gross_sales', 'order_count']
+        return (
+            list(DailySales.objects.values_list(*fields, 'discount_total', 'net_sales', 'promo_order_count')),
+            sorted(DailyProductSales.objects.values_list(*fields, 'product_id')),
+            sorted(DailyCategorySales.objects.values_list(*fields, 'category_id')),
+        )
+
+    def test_incremental_rollups_match_rebuild(self):
+        first, second, third = self.products
+        self.place_order([(first, 2), (second, 1)])
+        self.place_order([(second, 3), (third, 1)], discount=500)
+        self.place_order([(third, 4)])
+
+        incremental = self.rollups()
+        self.assertEqual(incremental[0][0][1:], (11, 9800, 3, 500, 9300, 1))
+
+        today = timezone.localdate()
+        self.assertEqual(rebuild_sales(today, today), 1)
+        self.assertEqual(self.rollups(), incremental)
+
+
+def uploaded_image(name='photo.png', image_format='PNG', size=(800, 600)):
+    buffer = BytesIO()
+    Image.new('RGB', size, 'white').save(buffer, image_format)
+    return SimpleUploadedFile(name, buffer.getvalue())
+
+
+@plain_static_storage
+class ProductImageTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media = override_settings(MEDIA_ROOT=media_root.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.category = Category.objects.create(name='雑貨', slug='zakka')
+
+    def product_data(self, **kwargs):
+        return {
+            'name': '商品1', 'category': self.category.pk, 'price': 1000, 'sku': 'SKU-1', 'sale_price': '',
+            'stock': 10, 'description': '', **kwargs,
+        }
+
+    def save_form(self, instance=None, image=None):
+        form = ProductForm(self.product_data(), {'image': image}, instance=instance)
+        self.assertTrue(form.is_valid(), form.errors)
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                return form.save()
+
+    def variant_names(self, product):
+        return [product.image_thumbnail.name, product.image_detail.name]
+
+    def assert_files_exist(self, product, names, exists=True):
+        for name in names:
+            self.assertEqual(product.image.storage.exists(name), exists, name)
+
+    def test_replacing_image_deletes_old_variants(self):
+        product = self.save_form(image=uploaded_image())
+        old_variants = self.variant_names(product)
+        self.assert_files_exist(product, old_variants)
+
+        product = self.save_form(Product.objects.get(pk=product.pk), image=uploaded_image('other.png'))
+
+        self.assertTrue(all(self.variant_names(product)))
+        self.assertNotEqual(self.variant_names(product), old_variants)
+        self.assert_files_exist(product, self.variant_names(product))
+        self.assert_files_exist(product, old_variants, exists=False)
+
+    def test_clearing_image_deletes_variants(self):
+        product = self.save_form(image=uploaded_image())
+        old_variants = self.variant_names(product)
+
+        product = self.save_form(Product.objects.get(pk=product.pk), image=False)
+
+        self.assertEqual(self.variant_names(product), ['', ''])
+        self.assert_files_exist(product, old_variants, exists=False)
+
+    def test_variants_are_kept_when_save_rolls_back(self):
+        product = self.save_form(image=uploaded_image())
+        old_variants = self.variant_names(product)
+
+        form = ProductForm(self.product_data(), {'image': uploaded_image('other.png')},
+                           instance=Product.objects.get(pk=product.pk))
+        self.assertTrue(form.is_valid(), form.errors)
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                form.save()
+                raise RuntimeError
+
+        self.assert_files_exist(product, old_variants)
+
+    def test_admin_uses_product_form(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+        response = self.client.post('/admin/products/product/add/', self.product_data(image=uploaded_image()))
+        self.assertEqual(response.status_code, 302)
+        product = Product.objects.get()
+        self.assert_files_exist(product, self.variant_names(product))
+        self.assertEqual(StockMovement.objects.get(product=product).delta, 10)
+
+        # jpeg / png 以外の画像はフォームと同じく受け付けない
+        response = self.client.post(
+            '/admin/products/product/add/', self.product_data(sku='SKU-2', image=uploaded_image('photo.gif', 'GIF'))
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('画像形式が不正です', response.context['adminform'].form.errors['image'][0])
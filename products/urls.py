@@ -1,8 +1,15 @@
+from django.conf import settings
 from django.urls import path
-from .views import ProductList, ProductDetail
+
+if settings.ASYNC_VIEWS:
+    # ASGI サーバーで動かす場合は非同期版のビューを使う
+    from .async_views import ProductList, ProductSearch, ProductDetail
+else:
+    from .views import ProductList, ProductSearch, ProductDetail
 
 
 urlpatterns = [
     path('list/', ProductList.as_view(), name='product_list'),
+    path('search/', ProductSearch.as_view(), name='product_search'),
     path('detail/<int:pk>/', ProductDetail.as_view(), name='product_detail')
 ]
@@ -1,44 +1,84 @@
+from django.shortcuts import get_object_or_404
+from django.utils.functional import cached_property
 from django.views.generic import ListView, DetailView
-from .models import Product, Cart
+from .conditional import ConditionalGetMixin, make_etag, product_detail_state, product_list_state
+from .models import Product, Category
+from .pagination import KeysetPaginationMixin, OffsetPaginationMixin
+from .related import get_related_products
+from .search import search_products
 
+# 一覧のカードで使う列（description などは読まない）
+PRODUCT_CARD_FIELDS = (
+    'id', 'name', 'price', 'sale', 'sale_price', 'image', 'image_thumbnail', 'created_at', 'updated_at'
+)
 
-class CartCountMixin:
-    """
-    他ビューで共通してカート内の商品数を取得するためのMixin。
-    ヘッダーのカートアイコン等に数字を表示するために使用する。
-    """
-    def get_cart_count(self):
-        session_key = self.request.session.session_key
-        if not session_key:
-            return 0
-        try:
-            cart = Cart.objects.get(session_key=session_key)
-            return cart.items.count()
-        # カートが未作成（まだ何も追加していない）ユーザーでも
-        # エラーを出さず「0」として処理を続行させるため
-        except Cart.DoesNotExist:
-            return 0
+
+class ProductList(ConditionalGetMixin, KeysetPaginationMixin, ListView):
+    model = Product
+    template_name = 'product_list.html'
+    context_object_name = 'products'
+    paginate_by = 20
+
+    @cached_property
+    def category(self):
+        # ?category=<slug> でカテゴリーの絞り込み
+        slug = self.request.GET.get('category')
+        return get_object_or_404(Category, slug=slug) if slug else None
+
+    def get_queryset(self):
+        # 一覧のカードで使う列だけを読み込む
+        queryset = Product.objects.only(*PRODUCT_CARD_FIELDS)
+        if self.category:
+            queryset = queryset.filter(category=self.category)
+        return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        # 共通の処理として cart_count をコンテキストに追加
-        context['cart_count'] = self.get_cart_count()
+        context['category'] = self.category
         return context
 
+    def get_etag(self):
+        # 表示するページと同じシーク・件数で、ページに並ぶ商品の ID と更新日時だけを読む
+        state = product_list_state(self._seek(self.get_queryset(), self.paginate_by)[0])
+        category = (self.category.pk, self.category.name) if self.category else None
+        return make_etag(self.request, category, state)
 
-class ProductList(CartCountMixin, ListView):
-    model = Product
+
+class ProductSearch(OffsetPaginationMixin, ListView):
+    """
+    ?q=<検索語> で商品名・説明・SKU を検索し、関連度の高い順に表示する。
+    """
     template_name = 'product_list.html'
     context_object_name = 'products'
+    paginate_by = 20
+
+    def get_queryset(self):
+        self.query = self.request.GET.get('q', '').strip()
+        return search_products(self.query, Product.objects.only(*PRODUCT_CARD_FIELDS))
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.query
+        return context
 
 
-class ProductDetail(CartCountMixin, DetailView):
+class ProductDetail(ConditionalGetMixin, DetailView):
     model = Product
     template_name = 'product_detail.html'
     context_object_name = 'product'
 
-    # 自分以外の最新の商品を4件、related_products としてテンプレートに渡す処理
+    # 他のカートに確保されている分を除いた販売可能数を available_stock として表示する
+    def get_queryset(self):
+        return Product.objects.with_available_stock(exclude_session_key=self.request.session.session_key)
+
+    # 事前計算済みの関連商品（同じカテゴリー・一緒に購入された商品を優先）を related_products としてテンプレートに渡す処理
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['related_products'] = (Product.objects.exclude(pk=self.object.pk).order_by('-created_at')[:4])
+        context['related_products'] = get_related_products(self.object)
         return context
+
+    def get_etag(self):
+        state = product_detail_state(self.kwargs['pk'], self.request.session.session_key).first()
+        # 商品が無い場合は条件付きGETにせず、通常どおり 404 を返す
+        return make_etag(self.request, *state) if state else None
+